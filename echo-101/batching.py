@@ -0,0 +1,232 @@
+'''
+Batched and pipelined requests for the persister bridge: many
+publish/get/subscribe operations per websocket message, with several
+messages in flight per connection.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import asyncio
+import struct
+import logging
+
+from hypergolix.persisters import PersisterBridgeClient
+
+
+logger = logging.getLogger(__name__)
+
+
+# Request code for a batch. The body is a sequence of sub-requests; the
+# response is a sequence of results, in the same order.
+BATCH_CODE = b'BT'
+# Sub-request header: request code, body length.
+_REQUEST = struct.Struct('>2sI')
+# Result header: success flag, body length. Failure bodies are a 2-byte
+# error code followed by a utf-8 description.
+_RESULT = struct.Struct('>?I')
+
+# Stay comfortably under the websockets default 1 MiB message limit.
+DEFAULT_BATCH_BYTES = 512 * 1024
+
+
+def pack_batch(requests):
+    ''' Packs an iterable of (request code, body) into a batch body.
+    '''
+    return b''.join(
+        _REQUEST.pack(code, len(body)) + body for code, body in requests
+    )
+
+
+def unpack_batch(data):
+    ''' Yields (request code, body) from a batch body.
+    '''
+    data = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        code, length = _REQUEST.unpack_from(data, offset)
+        offset += _REQUEST.size
+        if offset + length > len(data):
+            raise ValueError('Truncated batch request.')
+        yield code, bytes(data[offset:offset + length])
+        offset += length
+
+
+def pack_results(results):
+    ''' Packs an iterable of (success, body) into a batch response.
+    '''
+    return b''.join(
+        _RESULT.pack(success, len(body)) + body for success, body in results
+    )
+
+
+def unpack_results(data):
+    ''' Returns a list of (success, body) from a batch response.
+    '''
+    data = memoryview(data)
+    results = []
+    offset = 0
+    while offset < len(data):
+        success, length = _RESULT.unpack_from(data, offset)
+        offset += _RESULT.size
+        results.append((success, bytes(data[offset:offset + length])))
+        offset += length
+    return results
+
+
+class BatchingBridgeClient(PersisterBridgeClient):
+    ''' PersisterBridgeClient that can send many operations per round
+    trip, and keep several round trips in flight at once.
+
+    Operations are (name, argument) tuples:
+        ('publish', packed)
+        ('get', ghid)
+        ('query', ghid)
+        ('subscribe', (ghid, callback))
+
+    Results come back in order: True for publish and subscribe, the
+    object data for get, a bool for query. A failed operation doesn't
+    fail the rest; its result is the exception instead.
+    '''
+    REQUEST_CODES = dict(PersisterBridgeClient.REQUEST_CODES, batch=BATCH_CODE)
+
+    def _encode(self, name, arg):
+        if name == 'publish':
+            body = bytes(arg)
+        elif name == 'subscribe':
+            body = bytes(arg[0])
+        elif name in ('get', 'query'):
+            body = bytes(arg)
+        else:
+            raise ValueError('Cannot batch ' + repr(name) + ' operations.')
+        return self.REQUEST_CODES[name], body
+
+    def _decode(self, name, arg, success, body):
+        if not success:
+            try:
+                exc = self.error_lookup[body[:2]]
+            except KeyError:
+                exc = RuntimeError
+            return exc(body[2:].decode('utf-8'))
+
+        if name == 'get':
+            return body
+        elif name == 'query':
+            return body == b'\x01'
+        elif name == 'subscribe':
+            ghid, callback = arg
+            self._subscriptions[ghid].add(callback)
+        return True
+
+    def _chunk(self, operations, max_bytes):
+        ''' Splits operations into batches of at most max_bytes (though a
+        single oversized operation still gets a batch to itself).
+        '''
+        chunk = []
+        size = 0
+        for name, arg in operations:
+            code, body = self._encode(name, arg)
+            length = _REQUEST.size + len(body)
+            if chunk and size + length > max_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append((name, arg, code, body))
+            size += length
+
+        if chunk:
+            yield chunk
+
+    async def _send_batch(self, session, chunk):
+        response = await self.send(
+            session = session,
+            msg = pack_batch((code, body) for __, __, code, body in chunk),
+            request_code = BATCH_CODE
+        )
+        results = unpack_results(response)
+        if len(results) != len(chunk):
+            raise RuntimeError('Batch response does not match request.')
+
+        return [
+            self._decode(name, arg, success, body)
+            for (name, arg, __, __), (success, body) in zip(chunk, results)
+        ]
+
+    async def _pipeline(self, chunks, window):
+        session = self.any_session
+        limiter = asyncio.Semaphore(window)
+
+        async def send_chunk(chunk):
+            async with limiter:
+                return await self._send_batch(session, chunk)
+
+        batches = await asyncio.gather(
+            *(send_chunk(chunk) for chunk in chunks)
+        )
+        return [result for batch in batches for result in batch]
+
+    def pipeline(self, operations, window=8, max_bytes=DEFAULT_BATCH_BYTES):
+        ''' Sends operations as batches of up to max_bytes, keeping up to
+        window batches in flight at once. Blocks until every result is
+        in, and returns them in order.
+
+        Operations within a batch are applied in order, but batches in
+        flight at the same time are not ordered relative to each other.
+        If one operation depends on another (eg a container on its
+        binding), send them in the same batch(), or in separate calls.
+        '''
+        self.await_session_threadsafe()
+        chunks = list(self._chunk(operations, max_bytes))
+        return asyncio.run_coroutine_threadsafe(
+            self._pipeline(chunks, window),
+            self._loop
+        ).result()
+
+    def batch(self, operations):
+        ''' Sends operations in one round trip, applied in order. They
+        must fit in a single websocket message.
+        '''
+        return self.pipeline(operations, window=1, max_bytes=float('inf'))
+
+    def publish_many(self, packed_objects, window=8):
+        ''' Publishes packed_objects, returning True (or the exception)
+        for each. Only strictly ordered with window=1; see pipeline().
+        '''
+        return self.pipeline(
+            (('publish', packed) for packed in packed_objects),
+            window = window
+        )
+
+    def get_many(self, ghids, window=8):
+        ''' Gets every ghid, returning their data (or exceptions) in
+        order.
+        '''
+        return self.pipeline((('get', ghid) for ghid in ghids), window=window)
@@ -0,0 +1,803 @@
+'''
+Server-side persister bridge for the demo persistence server.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import asyncio
+import collections
+import time
+import traceback
+import logging
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
+from golix import Ghid
+
+from hypergolix.persisters import PersisterBridgeServer
+
+from batching import BATCH_CODE
+from batching import unpack_batch
+from batching import pack_results
+from sharding import EXPORT_CODE
+from sharding import IDENTITIES_CODE
+from sharding import EVICT_CODE
+from sharding import unpack_export
+from sharding import unpack_identities
+from sharding import pack_ghids
+from sharding import unpack_ghids
+from sharding import export_range
+from sharding import page_export
+from sharding import export_identities
+from sharding import evict
+from stats import RollingPercentiles
+
+
+logger = logging.getLogger(__name__)
+
+
+# Request code -> operation name, for metrics labels.
+_OPERATIONS = {
+    b'??': 'ping',
+    b'PB': 'publish',
+    b'GT': 'get',
+    b'+S': 'subscribe',
+    b'xS': 'unsubscribe',
+    b'LS': 'list_subs',
+    b'LB': 'list_bindings',
+    b'LD': 'list_debindings',
+    b'QE': 'query',
+    b'XX': 'disconnect',
+    BATCH_CODE: 'batch',
+    EXPORT_CODE: 'export',
+    IDENTITIES_CODE: 'export_identities',
+    EVICT_CODE: 'evict',
+}
+
+# Operations that can be part of a batch.
+_BATCHABLE = {b'??', b'PB', b'GT', b'+S', b'xS', b'LB', b'LD', b'QE'}
+
+# What to do with a notification for a session whose outbox is full.
+OVERFLOW_POLICIES = ('coalesce', 'drop-oldest', 'disconnect')
+
+# The hypergolix release series that _BridgeInternals was written against.
+_HYPERGOLIX_SERIES = '0.0.'
+
+
+def _hypergolix_version():
+    if pkg_resources is None:
+        return None
+    try:
+        return pkg_resources.get_distribution('hypergolix').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def _require(obj, names, what):
+    missing = [name for name in names if not hasattr(obj, name)]
+    if missing:
+        raise RuntimeError(
+            what + ' has no ' + ', '.join(missing) + ' (hypergolix ' +
+            str(_hypergolix_version()) + '). The demo bridge needs ' +
+            'hypergolix ' + _HYPERGOLIX_SERIES + 'x.'
+        )
+
+
+class _BridgeInternals:
+    ''' Everything DemoBridgeServer needs from PersisterBridgeServer
+    (and its sessions) that isn't public API, in one place. These are
+    hypergolix internals that can change under us, so the version is
+    checked on import, and every attribute we use is checked to exist
+    on the class, the server or the session as soon as we have one,
+    instead of failing at the first request that needs it.
+    '''
+    CLASS_ATTRS = (
+        '_close_session',
+        '_handle_autoresponder_complete',
+        '_cleanup_ignored_response',
+    )
+    SERVER_ATTRS = ('_loop', '_session_lookup', '_connection_lookup')
+    SESSION_ATTRS = ('_subscriptions', '_silenced')
+
+    @classmethod
+    def check_version(cls):
+        version = _hypergolix_version()
+        if version is not None and not version.startswith(_HYPERGOLIX_SERIES):
+            logger.warning(
+                'The demo bridge was written against hypergolix ' +
+                _HYPERGOLIX_SERIES + 'x, not ' + version + '.'
+            )
+        _require(
+            PersisterBridgeServer,
+            cls.CLASS_ATTRS,
+            'PersisterBridgeServer'
+        )
+
+    def __init__(self, server):
+        _require(server, self.SERVER_ATTRS, type(server).__name__)
+        self._server = server
+
+    def check_session(self, session):
+        _require(session, self.SESSION_ATTRS, type(session).__name__)
+
+    @property
+    def loop(self):
+        return self._server._loop
+
+    def session_for(self, connection):
+        ''' The connection's session, or None if it doesn't have one.
+        '''
+        return self._server._session_lookup.get(connection)
+
+    def connection_for(self, session):
+        ''' Raises KeyError or ReferenceError if the connection is gone.
+        '''
+        return self._server._connection_lookup[session]
+
+    def close_connection(self, session):
+        ''' Closes the session's connection, in the connector's event
+        loop. Does nothing if it's already gone.
+        '''
+        try:
+            connection = self.connection_for(session)
+            asyncio.run_coroutine_threadsafe(
+                connection.close(),
+                connection._loop
+            )
+        except (KeyError, ReferenceError):
+            pass
+
+    @staticmethod
+    def subscriptions(session):
+        ''' Lookup <ghid>: <notifier> that the session keeps for its
+        subscriptions.
+        '''
+        return session._subscriptions
+
+    @staticmethod
+    def silenced(session):
+        ''' Notification ghids not to deliver to the session, because it
+        just published them.
+        '''
+        return session._silenced
+
+    def watch_request(self, fut):
+        ''' Logs anything the autoresponder future raises.
+        '''
+        fut.add_done_callback(self._server._handle_autoresponder_complete)
+
+    def ignore_response(self, fut):
+        ''' Logs anything the (unawaited) response future raises.
+        '''
+        fut.add_done_callback(self._server._cleanup_ignored_response)
+
+    def on_close(self, callback):
+        ''' Calls callback(session) before the server closes a session,
+        by wrapping its (private) _close_session.
+        '''
+        close_session = self._server._close_session
+
+        async def _close_session(connection):
+            session = self.session_for(connection)
+            if session is not None:
+                callback(session)
+            await close_session(connection)
+
+        self._server._close_session = _close_session
+
+
+_BridgeInternals.check_version()
+
+
+class _TimedHandlers(dict):
+    ''' Request handler lookup that wraps every handler it hands out
+    with timed(req_code, handler).
+    '''
+    def __init__(self, handlers, timed):
+        super().__init__(handlers)
+        self._timed = timed
+
+    def __getitem__(self, req_code):
+        return self._timed(req_code, super().__getitem__(req_code))
+
+
+class DemoBridgeServer(PersisterBridgeServer):
+    ''' PersisterBridgeServer with an explicit subscription index.
+
+    Instead of one persister callback per (session, ghid) that blocks the
+    mail run while it round-trips into the event loop, we register one
+    callback per subscribed ghid. It just hands the notification to the
+    event loop, which queues it on every subscribed session's outbox.
+    Outboxes are flushed once per loop tick, one drain task per session,
+    without waiting for the client to ack each update.
+
+    Also accepts batch requests (see batching.py), so that clients can
+    send many operations per round trip, and the export/evict requests
+    that sharding.py uses to move objects between shards.
+
+    Outboxes are bounded to outbox_limit notifications. When one is
+    full, the overflow policy either coalesces the update into the one
+    already queued for the same ghid (falling back to dropping the
+    oldest), drops the oldest, or disconnects the session. Separately,
+    once a connection has high_watermark requests in flight, we stop
+    reading from it until they drain to low_watermark.
+
+    If a metrics.Registry is passed, requests, traffic and fan-out are
+    instrumented into it. If a verification.VerificationPool is passed,
+    published objects are verified in it before being ingested, so that
+    signature checks for concurrent publishes (and every publish in a
+    batch) run on several cores at once.
+    '''
+    def __init__(self, persister, metrics=None, outbox_limit=1024,
+                overflow='coalesce', high_watermark=64, low_watermark=16,
+                verifier=None, *args, **kwargs):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: ' + repr(overflow))
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError('Need 0 <= low_watermark < high_watermark.')
+
+        self._backend = persister
+        self.outbox_limit = outbox_limit
+        self.overflow = overflow
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.verifier = verifier
+
+        # Lookup <subscribed ghid>: set(<session>)
+        self._subscribers = {}
+        # Lookup <subscribed ghid>: <persister callback>. The persister only
+        # holds weak references to these, so we need to keep them alive.
+        self._notifiers = {}
+        # Sessions with something in their outbox since the last flush
+        self._dirty = set()
+        self._flush_handle = None
+        # Lookup <ring ranges>: <export_range() listing being paged through>
+        self._exports = {}
+
+        # Seconds from the persister's mail run to the update being handed
+        # to the connection, per delivered notification.
+        self.fanout_latency = RollingPercentiles()
+
+        self.metrics = metrics
+        if metrics is not None:
+            self._instrument(metrics)
+
+        super().__init__(persister=persister, *args, **kwargs)
+        self._internals = _BridgeInternals(self)
+        self._internals.on_close(self._drop_session)
+
+        # Subclasses add their handlers after this, so time them on lookup.
+        if metrics is not None:
+            self.req_handlers = _TimedHandlers(self.req_handlers, self._timed)
+        self.req_handlers[BATCH_CODE] = self.batch_wrapper
+        self.req_handlers[EXPORT_CODE] = self.export_wrapper
+        self.req_handlers[IDENTITIES_CODE] = self.export_identities_wrapper
+        self.req_handlers[EVICT_CODE] = self.evict_wrapper
+
+    @property
+    def loop(self):
+        ''' The event loop that requests are handled in.
+        '''
+        return self._internals.loop
+
+    def _instrument(self, registry):
+        self._requests = registry.counter(
+            'requests_total',
+            'Requests handled, by operation.',
+            ('op',)
+        )
+        self._failures = registry.counter(
+            'request_failures_total',
+            'Requests that raised (and were NAKed), by operation.',
+            ('op',)
+        )
+        self._latency = registry.histogram(
+            'request_duration_seconds',
+            'Time spent handling requests, by operation.',
+            ('op',)
+        )
+        self._bytes_in = registry.counter(
+            'received_bytes_total',
+            'Websocket message bytes received.'
+        )
+        self._bytes_out = registry.counter(
+            'sent_bytes_total',
+            'Websocket message bytes sent.'
+        )
+        registry.gauge(
+            'open_connections',
+            'Currently connected sessions.',
+            callback = lambda: len(self._sessions())
+        )
+        registry.gauge(
+            'subscriptions',
+            'Current (ghid, session) subscription pairs.',
+            callback = lambda: self.subscriber_count
+        )
+        registry.gauge(
+            'subscribed_ghids',
+            'Distinct ghids with at least one subscriber.',
+            callback = lambda: len(self._subscribers)
+        )
+        registry.summary(
+            'fanout_latency_seconds',
+            'Time from persister notification to handoff to the connection.',
+            self.fanout_latency
+        )
+        registry.gauge(
+            'outbox_depth_max',
+            'Deepest per-connection notification outbox.',
+            callback = lambda: max(
+                (len(session.outbox) for session in self._sessions()),
+                default = 0
+            )
+        )
+        registry.gauge(
+            'outbox_depth_total',
+            'Notifications queued across all connections.',
+            callback = lambda: sum(
+                len(session.outbox) for session in self._sessions()
+            )
+        )
+        registry.gauge(
+            'requests_in_flight',
+            'Requests being handled across all connections.',
+            callback = lambda: sum(
+                session.inflight for session in self._sessions()
+            )
+        )
+        self._overflows = registry.counter(
+            'outbox_overflows_total',
+            'Notifications hitting a full outbox, by action taken.',
+            ('action',)
+        )
+        self._read_pauses = registry.counter(
+            'read_pauses_total',
+            'Times we stopped reading from a connection at the high '
+            'watermark.'
+        )
+
+    def _timed(self, req_code, handler):
+        ''' Wraps a request handler with timing.
+        '''
+        op = _OPERATIONS.get(bytes(req_code), 'other')
+
+        async def timed_handler(session, request_body):
+            start = time.monotonic()
+            try:
+                return await handler(session, request_body)
+            except Exception:
+                self._failures.inc(op=op)
+                raise
+            finally:
+                self._requests.inc(op=op)
+                self._latency.observe(time.monotonic() - start, op=op)
+
+        return timed_handler
+
+    def _sessions(self):
+        return list(self.sessions)
+
+    def _describe(self, session):
+        try:
+            connid = self._internals.connection_for(session).connid
+        except (KeyError, ReferenceError):
+            connid = None
+        return 'connection ' + str(connid)
+
+    async def receiver(self, connection, msg):
+        ''' Called from the connector's event loop for every message.
+        Not returning stops the connection from reading any more, so if
+        the session has too much in flight, wait for it to catch up.
+        '''
+        if self.metrics is not None:
+            self._bytes_in.inc(len(msg))
+        await super().receiver(connection, msg)
+
+        session = self._internals.session_for(connection)
+        if session is not None and session.inflight >= self.high_watermark:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                self._await_low_watermark(session),
+                self.loop
+            ))
+
+    async def spawn_handler(self, connection, msg):
+        ''' Creates a task to handle the message from the connection,
+        counting it against the session's in-flight requests.
+        '''
+        session = self._internals.session_for(connection)
+        fut = asyncio.ensure_future(self.autoresponder(connection, msg))
+        self._internals.watch_request(fut)
+
+        if session is not None:
+            session.inflight += 1
+            fut.add_done_callback(
+                lambda fut, session=session: self._request_done(session)
+            )
+
+    def _request_done(self, session):
+        session.inflight -= 1
+        if (session.resume is not None and
+            session.inflight <= self.low_watermark):
+                session.resume.set()
+                session.resume = None
+
+    async def _await_low_watermark(self, session):
+        if session.inflight < self.high_watermark:
+            return
+
+        logger.info(
+            'Pausing reads from ' + self._describe(session) + ' with ' +
+            str(session.inflight) + ' requests in flight.'
+        )
+        if self.metrics is not None:
+            self._read_pauses.inc()
+
+        if session.resume is None:
+            session.resume = asyncio.Event()
+        await session.resume.wait()
+
+    async def send(self, session, msg, request_code, await_reply=True):
+        if self.metrics is not None:
+            self._bytes_out.inc(len(msg))
+        return await super().send(session, msg, request_code, await_reply)
+
+    def session_factory(self):
+        ''' Adds the notification outbox and flow control state to the
+        session.
+        '''
+        session = super().session_factory()
+        self._internals.check_session(session)
+        # [subscribed ghid, notification ghid, monotonic time queued]
+        session.outbox = collections.deque()
+        # Lookup <subscribed ghid>: <newest outbox entry for it>
+        session.pending = {}
+        session.draining = False
+        session.overflowing = False
+        # Requests being handled, and the event to resume reading on
+        session.inflight = 0
+        session.resume = None
+        return session
+
+    @property
+    def subscriber_count(self):
+        ''' Total (ghid, session) subscription pairs.
+        '''
+        return sum(len(sessions) for sessions in self._subscribers.values())
+
+    def _make_notifier(self):
+        ''' Creates the per-ghid persister callback. This may be called
+        from the mail run thread, so it only hops into the event loop.
+        '''
+        loop = self.loop
+        enqueue = self._enqueue
+
+        def notifier(subscribed_ghid, notification_ghid):
+            loop.call_soon_threadsafe(
+                enqueue, subscribed_ghid, notification_ghid, time.monotonic()
+            )
+
+        return notifier
+
+    def _enqueue(self, subscribed_ghid, notification_ghid, queued):
+        ''' Fans the notification out to every subscribed session's
+        outbox, and makes sure a flush is scheduled for this tick.
+        '''
+        # Copy, since the overflow policy might disconnect sessions.
+        for session in list(self._subscribers.get(subscribed_ghid, ())):
+            # Don't re-deliver updates for objects the session just sent us.
+            if notification_ghid in self._internals.silenced(session):
+                continue
+            if self._offer(session, subscribed_ghid, notification_ghid,
+                        queued):
+                self._dirty.add(session)
+
+        if self._dirty and self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush)
+
+    def _offer(self, session, subscribed_ghid, notification_ghid, queued):
+        ''' Queues the notification on the session's outbox, applying
+        the overflow policy if it's full. Returns False if the session
+        was disconnected instead.
+        '''
+        outbox = session.outbox
+        if len(outbox) >= self.outbox_limit:
+            if not session.overflowing:
+                session.overflowing = True
+                logger.warning(
+                    'Outbox full for ' + self._describe(session) + ' (' +
+                    str(len(outbox)) + ' queued); applying ' +
+                    self.overflow + ' policy.'
+                )
+
+            if self.overflow == 'disconnect':
+                self._count_overflow('disconnected')
+                self._disconnect(session)
+                return False
+
+            if self.overflow == 'coalesce':
+                entry = session.pending.get(subscribed_ghid)
+                if entry is not None:
+                    entry[1] = notification_ghid
+                    self._count_overflow('coalesced')
+                    return True
+
+            self._forget(session, outbox.popleft())
+            self._count_overflow('dropped_oldest')
+
+        entry = [subscribed_ghid, notification_ghid, queued]
+        outbox.append(entry)
+        session.pending[subscribed_ghid] = entry
+        return True
+
+    def _count_overflow(self, action):
+        if self.metrics is not None:
+            self._overflows.inc(action=action)
+
+    @staticmethod
+    def _forget(session, entry):
+        ''' Call whenever an entry leaves the outbox.
+        '''
+        if session.pending.get(entry[0]) is entry:
+            del session.pending[entry[0]]
+
+    def _disconnect(self, session):
+        ''' Drops the session and closes its connection (which lives in
+        the connector's event loop).
+        '''
+        logger.warning(
+            'Disconnecting ' + self._describe(session) + ': outbox full.'
+        )
+        self._drop_session(session)
+        self._internals.close_connection(session)
+
+    def _flush(self):
+        self._flush_handle = None
+        dirty = self._dirty
+        self._dirty = set()
+
+        for session in dirty:
+            # An in-progress drain will pick up anything we just queued.
+            if not session.draining:
+                session.draining = True
+                asyncio.ensure_future(self._drain(session))
+
+    async def _drain(self, session):
+        ''' Sends everything in the session's outbox, in order.
+        '''
+        request_code = self.REQUEST_CODES['send_subs_update']
+
+        try:
+            while session.outbox:
+                entry = session.outbox.popleft()
+                self._forget(session, entry)
+                subscribed_ghid, notification_ghid, queued = entry
+
+                try:
+                    response = await self.send(
+                        session = session,
+                        msg = bytes(subscribed_ghid) + bytes(notification_ghid),
+                        request_code = request_code,
+                        await_reply = False
+                    )
+
+                # The connection went away without its session being closed.
+                except KeyError:
+                    logger.warning(
+                        'Dropping subscriptions for vanished session ' +
+                        str(session)
+                    )
+                    self._drop_session(session)
+                    break
+
+                except Exception:
+                    logger.error(
+                        'Application client failed to receive sub update '
+                        'at ' + str(subscribed_ghid) + ' for notification ' +
+                        str(notification_ghid) + ' w/ traceback: \n' +
+                        ''.join(traceback.format_exc())
+                    )
+
+                else:
+                    self._internals.ignore_response(response)
+                    self.fanout_latency.record(time.monotonic() - queued)
+
+        finally:
+            session.draining = False
+            if session.overflowing and not session.outbox:
+                session.overflowing = False
+                logger.info(
+                    'Outbox for ' + self._describe(session) + ' caught up.'
+                )
+
+    def _subscribe(self, session, ghid):
+        try:
+            notifier = self._notifiers[ghid]
+        except KeyError:
+            notifier = self._make_notifier()
+            self._notifiers[ghid] = notifier
+            self._subscribers[ghid] = set()
+
+        # Always (re)subscribe at the persister, even if the notifier is
+        # already registered, so that it re-schedules pending requests.
+        self._backend.subscribe(ghid, notifier)
+        self._subscribers[ghid].add(session)
+        self._internals.subscriptions(session)[ghid] = notifier
+
+    def _unsubscribe(self, session, ghid):
+        ''' Returns True if the session was subscribed to ghid.
+        '''
+        self._internals.subscriptions(session).pop(ghid, None)
+        sessions = self._subscribers.get(ghid)
+        if sessions is None or session not in sessions:
+            return False
+
+        sessions.discard(session)
+        if not sessions:
+            del self._subscribers[ghid]
+            notifier = self._notifiers.pop(ghid)
+            self._backend.unsubscribe(ghid, notifier)
+
+        return True
+
+    def _drop_session(self, session):
+        for ghid in list(self._internals.subscriptions(session)):
+            self._unsubscribe(session, ghid)
+        if session.outbox:
+            logger.info(
+                'Discarding ' + str(len(session.outbox)) + ' queued '
+                'notifications for ' + self._describe(session) + '.'
+            )
+        session.outbox.clear()
+        session.pending.clear()
+        self._dirty.discard(session)
+
+    async def publish_wrapper(self, session, request_body):
+        ''' Checks the signature in the verification pool first, if we
+        have one. The doorman then finds it in the verified cache.
+        '''
+        if self.verifier is not None:
+            await self.verifier.preverify(self.loop, request_body)
+        return await super().publish_wrapper(session, request_body)
+
+    async def batch_wrapper(self, session, request_body):
+        ''' Runs every request in the batch, in order, and packs all of
+        their results into one response. A failed request doesn't stop
+        the rest of the batch.
+        '''
+        requests = list(unpack_batch(request_body))
+        if self.verifier is not None:
+            await asyncio.gather(*(
+                self.verifier.preverify(self.loop, body)
+                for req_code, body in requests if req_code == b'PB'
+            ))
+
+        results = []
+        for req_code, body in requests:
+            try:
+                if req_code not in _BATCHABLE:
+                    raise ValueError(
+                        'Cannot batch request code ' + repr(req_code)
+                    )
+                handler = self.req_handlers[req_code]
+                response = await handler(session, body)
+
+            except Exception as exc:
+                logger.info(
+                    'Exception in batched request: \n' +
+                    ''.join(traceback.format_exc())
+                )
+                try:
+                    code = self.error_lookup[type(exc)]
+                except KeyError:
+                    code = b'\x00\x00'
+                results.append((False, code + repr(exc).encode('utf-8')))
+
+            else:
+                results.append((True, bytes(response)))
+
+        return pack_results(results)
+
+    async def export_wrapper(self, session, request_body):
+        ''' Pages through the ghids placed within the requested ring
+        ranges. Listing them walks the whole store, so that's done (off
+        of the event loop) once per pass through the ranges, at its
+        first page, and later pages are served from the listing.
+        '''
+        ranges, limit, after = unpack_export(request_body)
+        key = tuple(ranges)
+        cursors = self._exports.get(key)
+        if after is None or cursors is None:
+            cursors = await self.loop.run_in_executor(
+                None,
+                export_range,
+                self._backend,
+                ranges
+            )
+            self._exports[key] = cursors
+
+        page = page_export(cursors, after, limit)
+        if not page:
+            self._exports.pop(key, None)
+        return page
+
+    async def export_identities_wrapper(self, session, request_body):
+        ''' Lists the identities we know about.
+        '''
+        after, limit = unpack_identities(request_body)
+        ghids = await self.loop.run_in_executor(
+            None,
+            export_identities,
+            self._backend,
+            after,
+            limit
+        )
+        return pack_ghids(ghids)
+
+    async def evict_wrapper(self, session, request_body):
+        ''' Drops objects that have moved to another shard.
+        '''
+        ghids = unpack_ghids(request_body)
+        evicted = await self.loop.run_in_executor(
+            None,
+            evict,
+            self._backend,
+            ghids
+        )
+        return pack_ghids(evicted)
+
+    async def subscribe_wrapper(self, session, request_body):
+        ''' Deserializes a subscribe request and adds the session to the
+        subscription index.
+        '''
+        ghid = Ghid.from_bytes(request_body)
+        self._subscribe(session, ghid)
+        return b'\x01'
+
+    async def unsubscribe_wrapper(self, session, request_body):
+        ''' Deserializes an unsubscribe request and removes the session
+        from the subscription index.
+        '''
+        ghid = Ghid.from_bytes(request_body)
+        if self._unsubscribe(session, ghid):
+            return b'\x01'
+        else:
+            return b'\x00'
+
+    async def disconnect_wrapper(self, session, request_body):
+        ''' Removes all of the session's subscriptions.
+        '''
+        self._drop_session(session)
+        return b'\x01'
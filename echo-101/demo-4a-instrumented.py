@@ -32,7 +32,10 @@ hypergolix: A python Golix client.
 '''
 
 import logging
-logging.basicConfig(filename='demo4a.log', level=logging.DEBUG)
+from logqueue import log_in_background
+# Logged from a background thread, so that logging inside the callbacks
+# doesn't skew the timings we're measuring.
+log_in_background('demo4a.log', level=logging.DEBUG)
 
 # Just for interactive interpreter
 import IPython
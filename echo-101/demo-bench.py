@@ -0,0 +1,423 @@
+'''
+Load generator for the demo persistence server. Starts a local
+demo-server.py, drives it with simulated clients, and reports
+throughput, latency percentiles and server memory growth as JSON.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import socket
+import argparse
+import threading
+import subprocess
+import collections
+import logging
+
+from golix import FirstParty
+
+from hypergolix.persisters import PersisterBridgeClient
+
+from hypergolix.utils import Aengel
+
+from hypergolix.comms import Autocomms
+from hypergolix.comms import WSBasicClient
+
+from stats import percentile
+
+
+OPERATIONS = ('static', 'dynamic', 'get', 'subscribe')
+
+
+parser = argparse.ArgumentParser(
+    description = 'Benchmark a local Hypergolix demo persistence server.'
+)
+parser.add_argument(
+    '--clients',
+    action = 'store',
+    default = 8,
+    type = int,
+    help = 'Number of simulated clients. Each generates its own Golix '
+            'identity, which takes a few seconds [default: 8]'
+)
+parser.add_argument(
+    '--ops',
+    action = 'store',
+    default = 500,
+    type = int,
+    help = 'Timed operations per client [default: 500]'
+)
+parser.add_argument(
+    '--mix',
+    action = 'store',
+    default = 'static=1,dynamic=4,get=4,subscribe=1',
+    type = str,
+    help = 'Relative weights of static publishes, dynamic updates, gets '
+            'and subscriptions [default: static=1,dynamic=4,get=4,'
+            'subscribe=1]'
+)
+parser.add_argument(
+    '--payload-bytes',
+    action = 'store',
+    default = 512,
+    type = int,
+    help = 'Plaintext size of each published container [default: 512]'
+)
+parser.add_argument(
+    '--seed',
+    action = 'store',
+    default = 0,
+    type = int,
+    help = 'Random seed for the operation mix [default: 0]'
+)
+parser.add_argument(
+    '--port',
+    action = 'store',
+    default = 7790,
+    type = int,
+    help = 'Port for the benchmarked server [default: 7790]'
+)
+parser.add_argument(
+    '--server-args',
+    action = 'store',
+    default = '',
+    type = str,
+    help = 'Extra arguments for demo-server.py, for example '
+            '"--backend disk --datadir /tmp/bench".'
+)
+parser.add_argument(
+    '--output',
+    action = 'store',
+    default = None,
+    type = str,
+    help = 'Write the JSON report here instead of stdout.'
+)
+
+
+def parse_mix(mix):
+    weights = dict.fromkeys(OPERATIONS, 0)
+    for term in mix.split(','):
+        name, weight = term.split('=')
+        if name not in weights:
+            raise ValueError('Unknown operation in --mix: ' + name)
+        weights[name] = float(weight)
+    return weights
+
+
+def server_rss(pid):
+    ''' Resident memory of pid, in bytes (Linux only).
+    '''
+    with open('/proc/' + str(pid) + '/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def start_server(port, extra_args):
+    ''' Starts demo-server.py as a subprocess and waits for it to accept
+    connections.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(here, 'demo-server.py'),
+         '--host', 'localhost', '--port', str(port)] + shlex.split(extra_args)
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('demo-server.py exited during startup.')
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(.1)
+
+    server.terminate()
+    raise RuntimeError('demo-server.py did not start listening in time.')
+
+
+class SimClient:
+    ''' One simulated client: its own identity, connection, and a
+    pre-generated sequence of operations (so that client-side crypto
+    doesn't count against the server).
+    '''
+    def __init__(self, client_id, ops, weights, payload_bytes, rng, shared):
+        self.client_id = client_id
+        self._rng = rng
+        self._shared = shared
+        self._payload_bytes = payload_bytes
+
+        self.identity = FirstParty()
+        self.persister = None
+        # Lookup <operation>: [latency, ...]
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+        names = [name for name in OPERATIONS if weights[name] > 0]
+        self.schedule = rng.choices(
+            names,
+            weights = [weights[name] for name in names],
+            k = ops
+        )
+
+        # Pre-generate everything we're going to publish.
+        self._warmup = [self.identity.second_party.packed]
+        self.static_ghids = []
+        self._statics = collections.deque()
+        self._updates = collections.deque()
+
+        # Containers must be bound before the persister accepts them.
+        container, binding = self._make_static()
+        self._warmup.extend((binding.packed, container.packed))
+        self.static_ghids.append(container.ghid)
+
+        container, frame = self._make_frame()
+        self._warmup.extend((frame.packed, container.packed))
+        self.dynamic_ghid = frame.ghid_dynamic
+
+        for name in self.schedule:
+            if name == 'static':
+                container, binding = self._make_static()
+                self._statics.append(
+                    (container.ghid, container.packed, binding.packed)
+                )
+            elif name == 'dynamic':
+                container, frame = self._make_frame(frame)
+                self._updates.append(
+                    (frame.ghid, container.packed, frame.packed)
+                )
+
+    def _payload(self):
+        return os.urandom(self._payload_bytes)
+
+    def _make_static(self):
+        secret = self.identity.new_secret()
+        container = self.identity.make_container(secret, self._payload())
+        binding = self.identity.make_bind_static(container.ghid)
+        return container, binding
+
+    def _make_frame(self, previous=None):
+        secret = self.identity.new_secret()
+        container = self.identity.make_container(secret, self._payload())
+        if previous is None:
+            frame = self.identity.make_bind_dynamic(container.ghid)
+        else:
+            frame = self.identity.make_bind_dynamic(
+                target = container.ghid,
+                ghid_dynamic = previous.ghid_dynamic,
+                history = [previous.ghid]
+            )
+        return container, frame
+
+    def connect(self, port, aengel):
+        self.persister = Autocomms(
+            autoresponder_name = 'bench' + str(self.client_id),
+            autoresponder_class = PersisterBridgeClient,
+            connector_class = WSBasicClient,
+            connector_kwargs = {
+                'host': 'localhost',
+                'port': port,
+            },
+            aengel = aengel,
+        )
+
+    def warmup(self):
+        for packed in self._warmup:
+            self.persister.publish(packed)
+
+    def _timed(self, name, func, *args):
+        start = time.monotonic()
+        try:
+            func(*args)
+        except Exception:
+            self.errors[name] += 1
+        else:
+            self.latencies[name].append(time.monotonic() - start)
+
+    def _on_update(self, subscribed_ghid, notification_ghid):
+        sent = self._shared['sent'].get(notification_ghid)
+        if sent is not None:
+            self.latencies['notification'].append(time.monotonic() - sent)
+
+    def _publish_update(self, frame_ghid, container, frame):
+        # Subscribers are notified on the frame, so start the clock there.
+        self._shared['sent'][frame_ghid] = time.monotonic()
+        self.persister.publish(frame)
+        self.persister.publish(container)
+
+    def run(self):
+        for name in self.schedule:
+            if name == 'static':
+                ghid, container, binding = self._statics.popleft()
+                self._timed(name, self._publish_static, container, binding)
+                self.static_ghids.append(ghid)
+
+            elif name == 'dynamic':
+                self._timed(
+                    name, self._publish_update, *self._updates.popleft()
+                )
+
+            elif name == 'get':
+                ghid = self._rng.choice(
+                    self._shared['statics'] + self._shared['dynamics']
+                )
+                self._timed(name, self.persister.get, ghid)
+
+            elif name == 'subscribe':
+                ghid = self._rng.choice(self._shared['dynamics'])
+                self._timed(
+                    name, self.persister.subscribe, ghid, self._on_update
+                )
+
+    def _publish_static(self, container, binding):
+        self.persister.publish(binding)
+        self.persister.publish(container)
+
+
+def summarize(latencies, duration):
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'throughput': len(ordered) / duration if duration else 0,
+        'p50': percentile(ordered, .50),
+        'p95': percentile(ordered, .95),
+        'p99': percentile(ordered, .99),
+        'max': ordered[-1] if ordered else 0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    shared = {'sent': {}, 'statics': [], 'dynamics': []}
+
+    logging.info('Generating identities and payloads...')
+    clients = [
+        SimClient(
+            client_id, args.ops, weights, args.payload_bytes,
+            random.Random(rng.getrandbits(64)), shared
+        )
+        for client_id in range(args.clients)
+    ]
+
+    server = start_server(args.port, args.server_args)
+    aengel = Aengel()
+    try:
+        for client in clients:
+            client.connect(args.port, aengel)
+        for client in clients:
+            client.warmup()
+            shared['statics'].extend(client.static_ghids)
+            shared['dynamics'].append(client.dynamic_ghid)
+
+        rss_start = server_rss(server.pid)
+        threads = [
+            threading.Thread(target=client.run, name='bench-client')
+            for client in clients
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+
+        # Give the last notifications a moment to arrive.
+        time.sleep(1)
+        rss_end = server_rss(server.pid)
+
+    finally:
+        aengel.stop()
+        server.terminate()
+        server.wait()
+
+    merged = collections.defaultdict(list)
+    errors = collections.Counter()
+    for client in clients:
+        for name, latencies in client.latencies.items():
+            merged[name].extend(latencies)
+        errors.update(client.errors)
+
+    return {
+        'revision': git_revision(),
+        'config': {
+            'clients': args.clients,
+            'ops': args.ops,
+            'mix': weights,
+            'payload_bytes': args.payload_bytes,
+            'seed': args.seed,
+            'server_args': args.server_args,
+        },
+        'duration': duration,
+        'throughput': sum(
+            len(merged[name]) for name in OPERATIONS
+        ) / duration,
+        'operations': {
+            name: summarize(latencies, duration)
+            for name, latencies in sorted(merged.items())
+        },
+        'errors': dict(errors),
+        'server_rss_start': rss_start,
+        'server_rss_end': rss_end,
+        'server_rss_growth': rss_end - rss_start,
+    }
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    report = json.dumps(main(args), indent=4, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
@@ -0,0 +1,271 @@
+'''
+Thin router that spreads a Hypergolix demo persistence service across
+several demo-server.py shards, on a consistent-hash ring.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import signal
+import threading
+import time
+import traceback
+import argparse
+import logging
+
+from hypergolix.utils import Aengel
+
+from hypergolix.comms import Autocomms
+from hypergolix.comms import WSBasicServer
+
+from bridge import DemoBridgeServer
+from sharding import ShardedPersister
+from sharding import connect_shard
+
+
+parser = argparse.ArgumentParser(
+    description = 'Route a Hypergolix demo persistence service across '
+                    'several demo-server.py shards.'
+)
+parser.add_argument(
+    '--host',
+    action = 'store',
+    default = 'localhost',
+    type = str,
+    help = 'Specify the router host [default: localhost]'
+)
+parser.add_argument(
+    '--port',
+    action = 'store',
+    default = 7770,
+    type = int,
+    help = 'Specify the router port [default: 7770]'
+)
+parser.add_argument(
+    '--shards',
+    action = 'store',
+    default = '',
+    type = str,
+    help = 'Comma-separated HOST:PORT of the demo servers to start with.'
+)
+parser.add_argument(
+    '--shards-file',
+    action = 'store',
+    default = None,
+    type = str,
+    help = 'File listing one HOST:PORT per line. Watched while running: '
+            'shards added to it join the ring and take over their share '
+            'of the objects in the background.'
+)
+parser.add_argument(
+    '--watch-interval',
+    action = 'store',
+    default = 1,
+    type = float,
+    help = 'Seconds between checks of --shards-file [default: 1]'
+)
+parser.add_argument(
+    '--vnodes',
+    action = 'store',
+    default = 64,
+    type = int,
+    help = 'Ring points per shard [default: 64]'
+)
+parser.add_argument(
+    '--rebalance-batch',
+    action = 'store',
+    default = 256,
+    type = int,
+    help = 'Objects moved per round trip while rebalancing [default: 256]'
+)
+parser.add_argument(
+    '--max-placements',
+    action = 'store',
+    default = 1 << 20,
+    type = int,
+    help = 'Bindings whose placement the router remembers. Debindings '
+           'of anything older ask the shards. [default: 1048576]'
+)
+parser.add_argument(
+    '--logfile',
+    action = 'store',
+    default = None,
+    type = str,
+    help = 'Log to a specified file, relative to current directory.',
+)
+parser.add_argument(
+    '--verbosity',
+    action = 'store',
+    default = None,
+    type = str,
+    help = 'Set debug mode and specify the logging level. '
+            '"debug" -> most verbose, '
+            '"info" -> somewhat verbose, '
+            '"error" -> quiet.',
+)
+
+
+def read_shards_file(path):
+    try:
+        with open(path) as f:
+            return [
+                line.strip() for line in f
+                if line.strip() and not line.startswith('#')
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class ShardsFileWatcher(threading.Thread):
+    ''' Daemon thread that adds any new shards listed in path. Removing
+    shards isn't supported.
+    '''
+    def __init__(self, path, interval, add_shard):
+        super().__init__(daemon=True, name='shards-file')
+        self._path = path
+        self._interval = interval
+        self._add_shard = add_shard
+        self._mtime = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                mtime = os.stat(self._path).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime == self._mtime:
+                continue
+
+            self._mtime = mtime
+            for address in read_shards_file(self._path):
+                try:
+                    self._add_shard(address)
+                except Exception:
+                    logging.error(
+                        'Failed to add shard ' + address + ' w/ traceback:\n' +
+                        ''.join(traceback.format_exc())
+                    )
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.verbosity is not None:
+        debug = True
+        log_level = {
+            'debug': logging.DEBUG,
+            'info': logging.INFO,
+            'error': logging.ERROR,
+        }[args.verbosity.lower()]
+    else:
+        debug = False
+        log_level = logging.WARNING
+
+    if args.logfile:
+        logging.basicConfig(filename=args.logfile, level=log_level)
+    else:
+        logging.basicConfig(level=log_level)
+
+    addresses = [address for address in args.shards.split(',') if address]
+    if args.shards_file is not None:
+        addresses.extend(read_shards_file(args.shards_file))
+    if not addresses:
+        parser.error('Need at least one shard (--shards or --shards-file).')
+
+    aengel = Aengel()
+    sharded = ShardedPersister(
+        vnodes = args.vnodes,
+        batch = args.rebalance_batch,
+        max_placements = args.max_placements
+    )
+    shards_lock = threading.Lock()
+
+    def add_shard(address):
+        with shards_lock:
+            if address in sharded.shards:
+                return
+            host, port = parse_address(address)
+            sharded.add_shard(
+                address,
+                connect_shard(host, port, aengel=aengel, debug=debug)
+            )
+
+    for address in addresses:
+        add_shard(address)
+
+    if args.shards_file is not None:
+        watcher = ShardsFileWatcher(
+            args.shards_file,
+            args.watch_interval,
+            add_shard
+        )
+        watcher.start()
+
+    router = Autocomms(
+        autoresponder_class = DemoBridgeServer,
+        autoresponder_kwargs = {'persister': sharded},
+        connector_class = WSBasicServer,
+        connector_kwargs = {
+            'host': args.host,
+            'port': args.port,
+            # 48 bits = 1% collisions at 2.4 e 10^6 connections
+            'birthday_bits': 48,
+        },
+        debug = debug,
+        aengel = aengel,
+    )
+
+    def sighandler(signum, sigframe):
+        raise ZeroDivisionError('Caught signal ' + str(signum))
+
+    try:
+        signal.signal(signal.SIGINT, sighandler)
+        signal.signal(signal.SIGTERM, sighandler)
+
+        # Like demo-server.py, broken out of by the signal handlers.
+        while True:
+            time.sleep(600)
+
+    except ZeroDivisionError as exc:
+        logging.info(str(exc))
+        logging.info(
+            'Moved ' + str(sharded.moved_count) + ' objects between shards.'
+        )
@@ -33,20 +33,47 @@ hypergolix: A python Golix client.
 
 '''
 
+import os
 import signal
+import socket
 import time
 import argparse
 import logging
 
-from hypergolix.persisters import MemoryPersister
-from hypergolix.persisters import PersisterBridgeServer
-
 from hypergolix.utils import Aengel
 
 from hypergolix.comms import Autocomms
 from hypergolix.comms import WSBasicServer
+
+from bridge import DemoBridgeServer
+from bridge import OVERFLOW_POLICIES
+from logqueue import log_in_background
+from logqueue import parse_sampling
+from metrics import Registry
+from metrics import MetricsServer
+from metrics import LoopLagMonitor
+from metrics import instrument_process
+from retention import RetainingPersister
+from retention import Reclaimer
+from verification import VerifiedCache
+from verification import VerificationPool
+from verification import install_cache
+from replication import WriteLog
+from replication import Replicator
+from replication import ReplicaBridgeServer
+from segments import DiskPersister
+from snapshots import SnapshotPersister
+from snapshots import Snapshotter
+
+from workers import ReusePortServer
+from workers import PeeredBridgeServer
+from workers import spawn_workers
     
     
+# With --traceur, only keep a tenth of hypergolix's own debug chatter.
+TRACEUR_SAMPLING = {'hypergolix': .1}
+
+
 parser = argparse.ArgumentParser(
     description = 'Start a Hypergolix demo persistence server.'
 )
@@ -64,6 +91,164 @@ parser.add_argument(
     type = int,
     help = 'Specify the persistence provider port [default: 7770]'
 )
+parser.add_argument(
+    '--backend', 
+    action = 'store',
+    default = 'memory', 
+    choices = ('memory', 'disk'),
+    type = str,
+    help = 'Where to keep persisted objects. "memory" is volatile; "disk" '
+            'requires --datadir [default: memory]'
+)
+parser.add_argument(
+    '--datadir', 
+    action = 'store',
+    default = None, 
+    type = str,
+    help = 'Directory for the disk backend\'s segment files and index. '
+            'Created if missing.'
+)
+parser.add_argument(
+    '--cache-bytes', 
+    action = 'store',
+    default = 32 * 1048576, 
+    type = int,
+    help = 'Memory budget for the disk backend\'s hot-object cache, in '
+            'bytes. 0 disables it. Ignored by the memory backend '
+            '[default: 32 MiB]'
+)
+parser.add_argument(
+    '--snapshot', 
+    action = 'store',
+    default = None, 
+    type = str,
+    help = 'Memory backend only. Warm-start from this snapshot file (if it '
+            'exists), and write it back out on SIGINT/SIGTERM.'
+)
+parser.add_argument(
+    '--snapshot-interval', 
+    action = 'store',
+    default = 0, 
+    type = float,
+    help = 'Also write the --snapshot every this many seconds. 0 means '
+            'only on shutdown [default: 0]'
+)
+parser.add_argument(
+    '--retain-frames', 
+    action = 'store',
+    default = 1, 
+    type = int,
+    help = 'Keep this many frames (including the current one) of every '
+            'dynamic object. Older frames are reclaimed in the background '
+            '[default: 1]'
+)
+parser.add_argument(
+    '--retain-seconds', 
+    action = 'store',
+    default = None, 
+    type = float,
+    help = 'Also reclaim superseded frames once they are this many seconds '
+            'old, regardless of --retain-frames.'
+)
+parser.add_argument(
+    '--reclaim-interval', 
+    action = 'store',
+    default = 1, 
+    type = float,
+    help = 'Seconds between background reclaim passes [default: 1]'
+)
+parser.add_argument(
+    '--outbox-limit', 
+    action = 'store',
+    default = 1024, 
+    type = int,
+    help = 'Most subscription updates to queue for any one connection '
+            '[default: 1024]'
+)
+parser.add_argument(
+    '--overflow', 
+    action = 'store',
+    default = 'coalesce', 
+    choices = OVERFLOW_POLICIES,
+    type = str,
+    help = 'What to do when a connection\'s outbox is full: coalesce into '
+            'the queued update for the same object (else drop the oldest), '
+            'drop the oldest, or disconnect it [default: coalesce]'
+)
+parser.add_argument(
+    '--read-high-watermark', 
+    action = 'store',
+    default = 64, 
+    type = int,
+    help = 'Stop reading from a connection with this many requests in '
+            'flight [default: 64]'
+)
+parser.add_argument(
+    '--read-low-watermark', 
+    action = 'store',
+    default = 16, 
+    type = int,
+    help = 'Resume reading once it is back down to this many '
+            '[default: 16]'
+)
+parser.add_argument(
+    '--workers', 
+    action = 'store',
+    default = 1, 
+    type = int,
+    help = 'Run this many server processes sharing --host/--port '
+            '(SO_REUSEPORT; Linux only). Publishes are forwarded between '
+            'workers, so each keeps a full copy [default: 1]'
+)
+parser.add_argument(
+    '--verify-workers', 
+    action = 'store',
+    default = None, 
+    type = int,
+    help = 'Check signatures of published objects in this many processes '
+            '(per --workers worker). 0 checks them inline '
+            '[default: CPU count / --workers]'
+)
+parser.add_argument(
+    '--verified-cache', 
+    action = 'store',
+    default = 65536, 
+    type = int,
+    help = 'Remember this many already-verified objects, so that resent '
+            'duplicates skip the signature check. 0 disables it '
+            '[default: 65536]'
+)
+parser.add_argument(
+    '--replicate-to', 
+    action = 'store',
+    default = None, 
+    type = str,
+    help = 'Stream our write log to the --follow server at HOST:PORT, '
+            'resyncing it from a full copy whenever needed.'
+)
+parser.add_argument(
+    '--follow', 
+    action = 'store_true',
+    help = 'Run as a read-only hot standby for a server that '
+            '--replicate-to us. Send SIGUSR1 to promote it to primary.'
+)
+parser.add_argument(
+    '--replication-buffer', 
+    action = 'store',
+    default = 64 * 1048576, 
+    type = int,
+    help = 'Most unacknowledged write log to keep for the follower, in '
+            'bytes. Past that, it gets resynced [default: 64 MiB]'
+)
+parser.add_argument(
+    '--metrics-port', 
+    action = 'store',
+    default = None, 
+    type = int,
+    help = 'Serve plain-text (Prometheus-style) metrics at '
+            'http://127.0.0.1:PORT/metrics. With --workers, worker N uses '
+            'PORT + N.'
+)
 parser.add_argument(
     '--logfile', 
     action = 'store',
@@ -88,8 +273,36 @@ parser.add_argument(
             'Implies verbosity of debug.'
 )
 
+parser.add_argument(
+    '--log-sample', 
+    action = 'store',
+    default = None, 
+    type = parse_sampling,
+    help = 'Only log this fraction of the sub-warning records from each '
+            'category (logger name prefix), eg "hypergolix=0.1,bridge=0.5". '
+            '[default: hypergolix=0.1 with --traceur, otherwise everything]'
+)
+
 args = parser.parse_args()
 
+if args.backend == 'disk' and args.datadir is None:
+    parser.error('--backend disk requires --datadir.')
+if args.snapshot is not None and args.backend != 'memory':
+    parser.error('--snapshot is only supported by the memory backend.')
+if args.retain_frames < 1:
+    parser.error('--retain-frames must be at least 1.')
+if not 0 <= args.read_low_watermark < args.read_high_watermark:
+    parser.error('--read-low-watermark must be below --read-high-watermark.')
+if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+    parser.error('--workers requires SO_REUSEPORT support.')
+if args.workers > 1 and (args.follow or args.replicate_to is not None):
+    parser.error('Replication does not support --workers.')
+    
+if args.verify_workers is None:
+    verify_workers = max((os.cpu_count() or 1) // args.workers, 1)
+else:
+    verify_workers = args.verify_workers
+
 if args.verbosity is not None:
     debug = True
     log_level = {
@@ -108,27 +321,21 @@ if args.traceur:
 else:
     traceur = False
     
-if args.logfile:
-    logging.basicConfig(filename=args.logfile, level=log_level)
+if args.log_sample is not None:
+    log_sampling = args.log_sample
+elif traceur:
+    log_sampling = TRACEUR_SAMPLING
 else:
-    logging.basicConfig(level=log_level)
+    log_sampling = None
     
-
-backend = MemoryPersister()
-aengel = Aengel()
-server = Autocomms(
-    autoresponder_class = PersisterBridgeServer,
-    autoresponder_kwargs = { 'persister': backend, },
-    connector_class = WSBasicServer,
-    connector_kwargs = {
-        'host': args.host,
-        'port': args.port,
-        # 48 bits = 1% collisions at 2.4 e 10^6 connections
-        'birthday_bits': 48,
-    },
-    debug = debug,
-    aengel = aengel,
+# Written from a background thread, so logging (even with --traceur)
+# doesn't hold up the event loop.
+background_log = log_in_background(
+    args.logfile,
+    level = log_level,
+    sampling = log_sampling
 )
+    
 
 signame_lookup = {
     signal.SIGINT: 'SIGINT',
@@ -136,15 +343,247 @@ signame_lookup = {
 }
 def sighandler(signum, sigframe):
     raise ZeroDivisionError('Caught ' + signame_lookup[signum])
-
-try:
-    signal.signal(signal.SIGINT, sighandler)
-    signal.signal(signal.SIGTERM, sighandler)
     
-    # This is a little gross, but will be broken out of by the signal handlers
-    # erroring out.
-    while True:
-        time.sleep(600)
+    
+def wait_for_signal():
+    ''' Blocks until SIGINT or SIGTERM.
+    '''
+    try:
+        signal.signal(signal.SIGINT, sighandler)
+        signal.signal(signal.SIGTERM, sighandler)
+        
+        # This is a little gross, but will be broken out of by the signal
+        # handlers erroring out.
+        while True:
+            time.sleep(600)
+            
+    except ZeroDivisionError as exc:
+        logging.info(str(exc))
+    
+    
+def serve(worker_id=None, bus=None):
+    ''' Runs a single persistence server until signalled. If bus is
+    passed, we're one of several --workers sharing the port.
+    '''
+    if args.backend == 'disk':
+        datadir = args.datadir
+        # Workers each keep their own full copy.
+        if worker_id is not None:
+            datadir = os.path.join(datadir, 'worker-' + str(worker_id))
+        backend = DiskPersister(datadir, cache_bytes=args.cache_bytes)
+    elif args.snapshot is not None:
+        snapshot = args.snapshot
+        if worker_id is not None:
+            snapshot += '.worker-' + str(worker_id)
+        backend = SnapshotPersister(snapshot)
+    else:
+        backend = RetainingPersister()
+        
+    backend.librarian.retain(args.retain_frames, args.retain_seconds)
+    
+    # The pool forks, so it has to come before any of our threads.
+    if args.verified_cache > 0:
+        verified = VerifiedCache(args.verified_cache)
+        install_cache(backend, verified)
+        if verify_workers > 0:
+            verifier = VerificationPool(backend, verified, verify_workers)
+        else:
+            verifier = None
+    else:
+        verified = None
+        verifier = None
+        
+    reclaimer = Reclaimer(backend.librarian, args.reclaim_interval)
+    reclaimer.start()
+        
+    if args.snapshot is not None and args.snapshot_interval > 0:
+        snapshotter = Snapshotter(backend, args.snapshot_interval)
+        snapshotter.start()
+    else:
+        snapshotter = None
+        
+    if args.metrics_port is not None:
+        metrics = Registry()
+        instrument_process(metrics, backend.librarian)
+        
+        cache = getattr(backend.librarian, 'cache', None)
+        if cache is not None:
+            for stat in ('hits', 'misses', 'evictions', 'bytes'):
+                metrics.gauge(
+                    'object_cache_' + stat,
+                    'Object cache ' + stat + '.',
+                    callback = lambda stat=stat: cache.stats()[stat]
+                )
+                
+        if verified is not None:
+            for stat in ('hits', 'misses', 'entries'):
+                metrics.gauge(
+                    'verified_cache_' + stat,
+                    'Verified object cache ' + stat + '.',
+                    callback = lambda stat=stat: verified.stats()[stat]
+                )
+        if verifier is not None:
+            metrics.gauge(
+                'verify_offloaded',
+                'Signatures checked in the verification pool.',
+                callback = lambda: verifier.offloaded
+            )
+                
+        metrics.gauge(
+            'log_records_dropped',
+            'Log records dropped because the log writer fell behind.',
+            callback = lambda: background_log.dropped
+        )
+        metrics.gauge(
+            'log_records_sampled_out',
+            'Log records skipped by --log-sample.',
+            callback = lambda: background_log.sampled_out
+        )
+                
+        metrics.gauge(
+            'superseded_frames',
+            'Superseded dynamic frames still retained.',
+            callback = lambda: backend.librarian.superseded_count
+        )
+        metrics.gauge(
+            'reclaimed_frames',
+            'Superseded dynamic frames reclaimed since startup.',
+            callback = lambda: backend.librarian.reclaimed_count
+        )
+    else:
+        metrics = None
+        
+    autoresponder_kwargs = {
+        'persister': backend,
+        'metrics': metrics,
+        'outbox_limit': args.outbox_limit,
+        'overflow': args.overflow,
+        'high_watermark': args.read_high_watermark,
+        'low_watermark': args.read_low_watermark,
+        'verifier': verifier,
+    }
+    if args.replicate_to is not None:
+        wal = WriteLog(args.replication_buffer)
+    else:
+        wal = None
+        
+    if bus is None:
+        autoresponder_class = DemoBridgeServer
+        connector_class = WSBasicServer
+        if wal is not None or args.follow:
+            autoresponder_class = ReplicaBridgeServer
+            autoresponder_kwargs['wal'] = wal
+            autoresponder_kwargs['follow'] = args.follow
+    else:
+        bus.attach(worker_id, backend, verified)
+        autoresponder_class = PeeredBridgeServer
+        autoresponder_kwargs['bus'] = bus
+        connector_class = ReusePortServer
+    
+    aengel = Aengel()
+    bridge = Autocomms(
+        autoresponder_class = autoresponder_class,
+        autoresponder_kwargs = autoresponder_kwargs,
+        connector_class = connector_class,
+        connector_kwargs = {
+            'host': args.host,
+            'port': args.port,
+            # 48 bits = 1% collisions at 2.4 e 10^6 connections
+            'birthday_bits': 48,
+        },
+        debug = debug,
+        aengel = aengel,
+    )
+    
+    if wal is not None:
+        host, port = args.replicate_to.rsplit(':', 1)
+        replicator = Replicator(wal, backend, host, int(port), aengel=aengel)
+        replicator.start()
+    else:
+        replicator = None
         
-except ZeroDivisionError as exc:
-    logging.info(str(exc))
\ No newline at end of file
+    if args.follow:
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, sigframe: bridge.promote()
+        )
+    
+    if metrics is not None:
+        if wal is not None:
+            metrics.gauge(
+                'replication_send_lag_bytes',
+                'Write log the follower has yet to acknowledge.',
+                callback = lambda: wal.lag()[0]
+            )
+            metrics.gauge(
+                'replication_send_lag_seconds',
+                'Age of the oldest write the follower has yet to '
+                'acknowledge.',
+                callback = lambda: wal.lag()[1]
+            )
+        if args.follow:
+            metrics.gauge(
+                'replication_following',
+                '1 while running as a standby, 0 once promoted.',
+                callback = lambda: int(bridge.following)
+            )
+            metrics.gauge(
+                'replication_apply_lag_bytes',
+                'How far behind the primary\'s write log we are.',
+                callback = lambda: bridge.replication_lag()[0]
+            )
+            metrics.gauge(
+                'replication_apply_lag_seconds',
+                'How long ago the primary wrote the last entry we applied, '
+                'while behind it.',
+                callback = lambda: bridge.replication_lag()[1]
+            )
+            
+        LoopLagMonitor(metrics).start(bridge.loop)
+        metrics_server = MetricsServer(
+            metrics,
+            port = args.metrics_port + (worker_id or 0)
+        )
+        metrics_server.start()
+    
+    try:
+        wait_for_signal()
+        
+    finally:
+        logging.info('Fan-out latency: ' + repr(bridge.fanout_latency))
+        reclaimer.stop()
+        if verified is not None:
+            logging.info('Verified cache: ' + repr(verified))
+        if verifier is not None:
+            verifier.close()
+        if replicator is not None:
+            replicator.stop()
+            logging.info('Follower lag (bytes, seconds): ' + repr(wal.lag()))
+        
+        # Make sure the disk backend's log and index hit the disk.
+        if args.backend == 'disk':
+            if backend.librarian.cache is not None:
+                logging.info('Object cache: ' + repr(backend.librarian.cache))
+            backend.close()
+            
+        # Snapshot on the way out, so the next start is warm.
+        if args.snapshot is not None:
+            if snapshotter is not None:
+                snapshotter.stop()
+            backend.write_snapshot()
+            backend.close()
+            
+            
+if args.workers > 1:
+    bus, processes = spawn_workers(args.workers, serve)
+    try:
+        wait_for_signal()
+    finally:
+        bus.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+            
+else:
+    serve()
\ No newline at end of file
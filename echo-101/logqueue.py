@@ -0,0 +1,225 @@
+'''
+Background logging for the demos: records are handed to a queue and
+written out by a separate thread, and chatty categories can be sampled
+so that debug logging stays cheap enough to leave on.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import atexit
+import os
+import queue
+import weakref
+import logging
+import logging.handlers
+
+
+# Listeners to restart in forked children (see _restart_listeners).
+_listeners = weakref.WeakSet()
+
+
+def parse_sampling(spec):
+    ''' Parses "category=rate,category=rate" into a dict. Categories are
+    logger names (or prefixes of them); an empty category sets the
+    default rate.
+    '''
+    rates = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        category, rate = item.rsplit('=', 1)
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError('Sampling rates must be between 0 and 1.')
+        rates[category.strip()] = rate
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    ''' Keeps only a fraction of the records below always_level, at a
+    rate set per category. A record's category is the longest configured
+    prefix of its logger name (on a dotted boundary); records that don't
+    match any are kept at the default rate ('' category, or 1).
+
+    Sampling is deterministic (every 1/rate-th record per category)
+    rather than random, so it's cheap and evenly spread.
+    '''
+    def __init__(self, rates=None, always_level=logging.WARNING):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.default = self.rates.pop('', 1.)
+        self.always_level = always_level
+
+        # <logger name>: <category>, so we only match prefixes once per
+        # logger.
+        self._categories = {}
+        self._credit = {}
+        self.sampled_out = 0
+
+    def _categorize(self, name):
+        try:
+            return self._categories[name]
+        except KeyError:
+            pass
+
+        category = ''
+        for candidate in self.rates:
+            if name == candidate or name.startswith(candidate + '.'):
+                if len(candidate) > len(category):
+                    category = candidate
+        self._categories[name] = category
+        return category
+
+    def filter(self, record):
+        if record.levelno >= self.always_level:
+            return True
+
+        category = self._categorize(record.name)
+        rate = self.rates.get(category, self.default)
+        if rate >= 1:
+            return True
+
+        # Racing threads can occasionally double-count credit. That just
+        # nudges the rate, which is fine for sampling.
+        credit = self._credit.get(category, 0.) + rate
+        if credit >= 1:
+            self._credit[category] = credit - 1
+            return True
+
+        self._credit[category] = credit
+        self.sampled_out += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    ''' QueueHandler that never blocks the logging thread. If the writer
+    has fallen behind and the queue is full, the record is dropped (and
+    counted) instead.
+    '''
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundLog:
+    ''' Routes the root logger through a bounded queue to a writer
+    thread, which passes records on to handlers. Returned by
+    log_in_background().
+    '''
+    def __init__(self, handlers, level=logging.WARNING, sampling=None,
+                queue_size=65536):
+        self.queue_size = queue_size
+        self.sampler = SamplingFilter(sampling)
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(self.sampler)
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue,
+            *handlers,
+            respect_handler_level = True
+        )
+        self._stopped = False
+
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(level)
+
+        self.listener.start()
+        _listeners.add(self)
+        atexit.register(self.stop)
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    @property
+    def sampled_out(self):
+        return self.sampler.sampled_out
+
+    def _restart(self):
+        # Whatever was queued belongs to the parent, and the old writer
+        # thread didn't survive the fork.
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.listener.queue = self.handler.queue
+        self.listener._thread = None
+        if not self._stopped:
+            self.listener.start()
+
+    def stop(self):
+        ''' Writes out everything still queued and stops the writer.
+        '''
+        if self._stopped:
+            return
+        self._stopped = True
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+
+    def __repr__(self):
+        return (
+            '<' + type(self).__name__ + ' dropped=' + str(self.dropped) +
+            ' sampled_out=' + str(self.sampled_out) + '>'
+        )
+
+
+def _restart_listeners():
+    for log in list(_listeners):
+        log._restart()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listeners)
+
+
+def log_in_background(filename=None, level=logging.WARNING, sampling=None,
+                    queue_size=65536):
+    ''' Drop-in replacement for logging.basicConfig(filename, level)
+    that writes from a background thread. sampling maps categories to
+    the fraction of their sub-WARNING records to keep (see
+    SamplingFilter). Returns the BackgroundLog.
+    '''
+    if filename:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    return BackgroundLog(
+        [handler],
+        level = level,
+        sampling = sampling,
+        queue_size = queue_size
+    )
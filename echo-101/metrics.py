@@ -0,0 +1,373 @@
+'''
+Prometheus-style plain-text metrics for the demo persistence server.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import bisect
+import threading
+import socketserver
+import http.server
+import resource
+import time
+import traceback
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds. Covers everything from an in-memory get to a slow disk publish.
+DEFAULT_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+    1, 2.5, 5, 10
+)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        name + '="' + str(value).replace('"', '\\"') + '"'
+        for name, value in pairs
+    ) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        yield '# HELP ' + self.name + ' ' + self.documentation
+        yield '# TYPE ' + self.name + ' ' + self.kind
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    ''' Monotonically increasing count, optionally labelled.
+    '''
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._opslock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._opslock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._opslock:
+            values = list(self._values.items())
+
+        for key, value in sorted(values):
+            yield (
+                self.name + _format_labels(self.labelnames, key) + ' ' +
+                _format_value(value)
+            )
+
+
+class Gauge(_Metric):
+    ''' Point-in-time value. Either set() it, or pass a zero-argument
+    callback that's evaluated whenever we're scraped.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback=None):
+        super().__init__(name, documentation)
+        self._callback = callback
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def _samples(self):
+        if self._callback is not None:
+            try:
+                value = self._callback()
+            except Exception:
+                logger.warning(
+                    'Failed to collect gauge ' + self.name + ' w/ traceback:\n'
+                    + ''.join(traceback.format_exc())
+                )
+                return
+        else:
+            value = self._value
+        yield self.name + ' ' + _format_value(value)
+
+
+class Histogram(_Metric):
+    ''' Cumulative bucketed histogram, optionally labelled.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._bounds = tuple(sorted(buckets))
+        # Lookup <label key>: [bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._opslock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._opslock:
+            try:
+                counts = self._values[key]
+            except KeyError:
+                counts = self._values[key] = [0] * (len(self._bounds) + 2)
+
+            counts[bisect.bisect_left(self._bounds, value)] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        bounds = self._bounds + (float('inf'),)
+        with self._opslock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        for key, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield (
+                    self.name + '_bucket' + _format_labels(
+                        self.labelnames, key, (('le', _format_value(bound)),)
+                    ) + ' ' + str(cumulative)
+                )
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + '_sum' + labels + ' ' + _format_value(counts[-1])
+            yield self.name + '_count' + labels + ' ' + str(cumulative)
+
+
+class Summary(_Metric):
+    ''' Exposes a stats.RollingPercentiles as a prometheus summary.
+    '''
+    kind = 'summary'
+
+    def __init__(self, name, documentation, rolling):
+        super().__init__(name, documentation)
+        self._rolling = rolling
+
+    def _samples(self):
+        summary = self._rolling.summary()
+        for quantile in ('p50', 'p95', 'p99'):
+            yield (
+                self.name + '{quantile="0.' + quantile[1:] + '"} ' +
+                _format_value(summary[quantile])
+            )
+        yield self.name + '_sum ' + _format_value(self._rolling.total)
+        yield self.name + '_count ' + str(self._rolling.count)
+
+
+class Registry:
+    ''' Collection of metrics, rendered together in the prometheus text
+    exposition format.
+    '''
+    def __init__(self, namespace='hgx'):
+        self.namespace = namespace
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def _name(self, name):
+        return self.namespace + '_' + name
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(self._name(name), documentation, labelnames))
+
+    def gauge(self, name, documentation, callback=None):
+        return self._add(Gauge(self._name(name), documentation, callback))
+
+    def histogram(self, name, documentation, labelnames=(),
+                buckets=DEFAULT_BUCKETS):
+        return self._add(
+            Histogram(self._name(name), documentation, labelnames, buckets)
+        )
+
+    def summary(self, name, documentation, rolling):
+        return self._add(Summary(self._name(name), documentation, rolling))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def resident_bytes():
+    ''' Current resident set size, from /proc where available, otherwise
+    the peak RSS from getrusage.
+    '''
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # Linux reports in KiB; macOS in bytes. Close enough for a fallback.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    ''' Measures event loop lag by scheduling a callback every interval
+    and recording how late it actually ran.
+    '''
+    def __init__(self, registry, interval=.25):
+        self._interval = interval
+        self._loop = None
+        self._expected = None
+        self._lag = registry.gauge(
+            'event_loop_lag_seconds',
+            'How late the most recent loop lag probe ran.'
+        )
+        self._lag_hist = registry.histogram(
+            'event_loop_lag_probe_seconds',
+            'Distribution of loop lag probe delays, in seconds.'
+        )
+
+    def start(self, loop):
+        ''' Threadsafe. Starts probing loop.
+        '''
+        self._loop = loop
+        loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self._interval
+        self._loop.call_at(self._expected, self._probe)
+
+    def _probe(self):
+        lag = max(self._loop.time() - self._expected, 0)
+        self._lag.set(lag)
+        self._lag_hist.observe(lag)
+        self._schedule()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics scrape: ' + (format % args))
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    ''' Serves registry at http://host:port/metrics from a daemon
+    thread. Defaults to localhost only.
+    '''
+    def __init__(self, registry, port, host='127.0.0.1'):
+        handler = type(
+            '_BoundMetricsHandler', (_MetricsHandler,), {'registry': registry}
+        )
+        self._httpd = _ThreadingHTTPServer((host, port), handler)
+        self._thread = threading.Thread(
+            target = self._httpd.serve_forever,
+            daemon = True,
+            name = 'metrics'
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _object_count(librarian):
+    try:
+        return len(librarian)
+    # Plain MemoryLibrarians don't define __len__.
+    except TypeError:
+        return len(librarian._shelf)
+
+
+def instrument_process(registry, librarian=None, started=None):
+    ''' Registers the process-level gauges: resident memory, uptime and
+    (if a librarian is passed) objects stored.
+    '''
+    if started is None:
+        started = time.time()
+
+    registry.gauge(
+        'resident_memory_bytes',
+        'Resident set size of the server process.',
+        callback = resident_bytes
+    )
+    registry.gauge(
+        'start_time_seconds',
+        'Unix time the server process started.',
+        callback = lambda: started
+    )
+    registry.gauge(
+        'pid',
+        'Process ID (distinguishes --workers).',
+        callback = os.getpid
+    )
+
+    if librarian is not None:
+        registry.gauge(
+            'objects_stored',
+            'Objects currently held by the persister.',
+            callback = lambda: _object_count(librarian)
+        )
@@ -0,0 +1,179 @@
+'''
+Memory-budgeted object cache for the demo persistence server.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import collections
+import threading
+
+
+class ObjectCache:
+    ''' Segmented LRU cache of ghid -> packed object, bounded by total
+    bytes instead of entry count. Threadsafe.
+
+    New entries land in a probationary segment and are only promoted to
+    the protected segment on a second hit, so a one-off scan over cold
+    objects can't flush out the hot set.
+
+    Golix objects are content-addressed, so cached entries never go
+    stale; they only need to be discarded when the object is removed.
+    '''
+    def __init__(self, max_bytes, protected_ratio=.8):
+        self.max_bytes = int(max_bytes)
+        self._protected_max = int(self.max_bytes * protected_ratio)
+
+        self._probation = collections.OrderedDict()
+        self._protected = collections.OrderedDict()
+        self._probation_bytes = 0
+        self._protected_bytes = 0
+        self._opslock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        return self._probation_bytes + self._protected_bytes
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def __contains__(self, key):
+        return key in self._protected or key in self._probation
+
+    def get(self, key, default=None):
+        ''' Returns the cached data for key, or default on a miss.
+        '''
+        with self._opslock:
+            try:
+                data = self._protected[key]
+
+            except KeyError:
+                try:
+                    data = self._probation.pop(key)
+                except KeyError:
+                    self.misses += 1
+                    return default
+
+                # Second hit: promote to protected.
+                self._probation_bytes -= len(data)
+                self._protected[key] = data
+                self._protected_bytes += len(data)
+                self._demote()
+
+            else:
+                self._protected.move_to_end(key)
+
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        ''' Adds data to the cache. Entries that are larger than the
+        whole budget are ignored.
+        '''
+        size = len(data)
+        if size > self.max_bytes:
+            return
+
+        with self._opslock:
+            if key in self._protected or key in self._probation:
+                return
+
+            self._probation[key] = data
+            self._probation_bytes += size
+            self._evict()
+
+    def discard(self, key):
+        ''' Removes key from the cache, if present.
+        '''
+        with self._opslock:
+            data = self._protected.pop(key, None)
+            if data is not None:
+                self._protected_bytes -= len(data)
+
+            data = self._probation.pop(key, None)
+            if data is not None:
+                self._probation_bytes -= len(data)
+
+    def clear(self):
+        with self._opslock:
+            self._probation.clear()
+            self._protected.clear()
+            self._probation_bytes = 0
+            self._protected_bytes = 0
+
+    def _demote(self):
+        ''' Moves LRU protected entries back into probation until the
+        protected segment fits. Must be called with the opslock held.
+        '''
+        while self._protected_bytes > self._protected_max:
+            key, data = self._protected.popitem(last=False)
+            self._protected_bytes -= len(data)
+            self._probation[key] = data
+            self._probation_bytes += len(data)
+
+        self._evict()
+
+    def _evict(self):
+        ''' Drops LRU probation entries (and then protected ones, should
+        it come to that) until we're within budget. Must be called with
+        the opslock held.
+        '''
+        while self.nbytes > self.max_bytes:
+            if self._probation:
+                key, data = self._probation.popitem(last=False)
+                self._probation_bytes -= len(data)
+            else:
+                key, data = self._protected.popitem(last=False)
+                self._protected_bytes -= len(data)
+            self.evictions += 1
+
+    def stats(self):
+        ''' Returns a dict of the cache counters.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def __repr__(self):
+        return (
+            type(self).__name__ + '(' +
+            ', '.join(k + '=' + str(v) for k, v in self.stats().items()) +
+            ')'
+        )
@@ -0,0 +1,435 @@
+'''
+Write-ahead-log streaming replication from a demo persistence server to
+a hot standby, which serves reads and can be promoted.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import collections
+import struct
+import threading
+import time
+import traceback
+import logging
+
+from hypergolix.persisters import PersisterBridgeClient
+
+from hypergolix.comms import Autocomms
+from hypergolix.comms import WSBasicClient
+
+from bridge import DemoBridgeServer
+from sharding import walk_stored
+
+
+logger = logging.getLogger(__name__)
+
+
+# Request code for a chunk of the write log.
+REPLICATE_CODE = b'WL'
+# Chunk header: primary epoch, log offset the chunk starts at, primary's
+# log head offset and the (wall clock) time it was written, flags.
+_CHUNK = struct.Struct('>16sQQdB')
+# Entry header: log offset, time written, length.
+_ENTRY = struct.Struct('>QdI')
+# Response: follower's epoch and how far into it it has applied.
+_ACK = struct.Struct('>16sQ')
+
+# Chunk flags. A resync is a full copy of the primary, as of the chunk's
+# start offset, spread over several chunks; the first one resets the
+# follower to the primary's epoch.
+RESET = 0x01
+SNAPSHOT = 0x02
+
+_NO_EPOCH = bytes(16)
+
+
+def pack_chunk(epoch, start, head, head_time, entries, flags=0):
+    ''' entries is an iterable of (offset, time written, packed).
+    '''
+    return _CHUNK.pack(epoch, start, head, head_time, flags) + b''.join(
+        _ENTRY.pack(offset, written, len(packed)) + packed
+        for offset, written, packed in entries
+    )
+
+
+def unpack_chunk(data):
+    ''' Returns (epoch, start, head, head_time, flags, entries).
+    '''
+    data = memoryview(data)
+    epoch, start, head, head_time, flags = _CHUNK.unpack_from(data, 0)
+    offset = _CHUNK.size
+    entries = []
+    while offset < len(data):
+        entry_offset, written, length = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        entries.append(
+            (entry_offset, written, bytes(data[offset:offset + length]))
+        )
+        offset += length
+    return epoch, start, head, head_time, flags, entries
+
+
+class ReplicationError(RuntimeError):
+    ''' Raised by a follower for publishes it won't take: from clients
+    before it's promoted, and from its old primary afterwards.
+    '''
+    pass
+
+
+class WriteLog:
+    ''' In-memory log of accepted publishes, kept until the follower
+    acknowledges them. Offsets are in bytes of published objects, and
+    only mean anything within an epoch (one per process).
+
+    If the follower falls more than limit bytes behind, the oldest
+    entries are dropped and it's resynced from a full copy instead.
+    '''
+    def __init__(self, limit=64 * 1048576):
+        self.epoch = os.urandom(16)
+        self.limit = limit
+
+        # (offset, time written, packed), oldest first, from acked onwards
+        self._entries = collections.deque()
+        self._bytes = 0
+        self.head = 0
+        self.head_time = time.time()
+        # How far the follower has applied, or None until it tells us
+        self.acked = None
+        self.needs_resync = False
+        self._changed = threading.Condition()
+
+    def append(self, packed):
+        with self._changed:
+            self._entries.append((self.head, time.time(), packed))
+            self.head += len(packed)
+            self.head_time = time.time()
+            self._bytes += len(packed)
+
+            while self._bytes > self.limit:
+                __, __, dropped = self._entries.popleft()
+                self._bytes -= len(dropped)
+                if not self.needs_resync:
+                    logger.warning(
+                        'Follower fell more than ' + str(self.limit) +
+                        ' bytes behind; it will be resynced.'
+                    )
+                    self.needs_resync = True
+
+            self._changed.notify_all()
+
+    def wait(self, timeout):
+        ''' Waits up to timeout for anything unsent.
+        '''
+        with self._changed:
+            if self.acked is None or self.acked < self.head:
+                return
+            self._changed.wait(timeout)
+
+    def pending(self, max_bytes):
+        ''' Returns (start, entries) for the next chunk to send, up to
+        max_bytes (or one entry, if that's bigger). Before the follower
+        has acknowledged anything, that's an empty probe.
+        '''
+        with self._changed:
+            if self.acked is None:
+                return self.head, []
+
+            entries = []
+            size = 0
+            for entry in self._entries:
+                if entries and size + len(entry[2]) > max_bytes:
+                    break
+                entries.append(entry)
+                size += len(entry[2])
+            return self.acked, entries
+
+    def ack(self, epoch, applied):
+        ''' Records the follower's response, working out whether it has
+        to be resynced.
+        '''
+        with self._changed:
+            oldest = self._entries[0][0] if self._entries else self.head
+            if epoch != self.epoch or not oldest <= applied <= self.head:
+                self.needs_resync = True
+                return
+
+            self.acked = applied
+            while self._entries and self._entries[0][0] < applied:
+                __, __, packed = self._entries.popleft()
+                self._bytes -= len(packed)
+
+    def rebase(self, start):
+        ''' Call once a resync as of start is complete.
+        '''
+        with self._changed:
+            self.acked = start
+            while self._entries and self._entries[0][0] < start:
+                __, __, packed = self._entries.popleft()
+                self._bytes -= len(packed)
+
+            # If we overflowed again during the resync, go around again.
+            oldest = self._entries[0][0] if self._entries else self.head
+            self.needs_resync = oldest > start
+
+    def lag(self):
+        ''' Returns (bytes, seconds) the follower is behind us.
+        '''
+        with self._changed:
+            if self.acked is None:
+                return self.head, 0
+            seconds = 0
+            if self._entries:
+                seconds = max(time.time() - self._entries[0][1], 0)
+            return self.head - self.acked, seconds
+
+
+class ReplicaClient(PersisterBridgeClient):
+    ''' Bridge client that sends write log chunks to a follower.
+    '''
+    REQUEST_CODES = dict(
+        PersisterBridgeClient.REQUEST_CODES,
+        replicate = REPLICATE_CODE
+    )
+
+    def replicate(self, chunk):
+        ''' Sends a packed chunk, returning the follower's
+        (epoch, applied offset).
+        '''
+        self.await_session_threadsafe()
+        response = self.send_threadsafe(
+            session = self.any_session,
+            msg = chunk,
+            request_code = self.REQUEST_CODES['replicate']
+        )
+        return _ACK.unpack(response)
+
+
+class Replicator(threading.Thread):
+    ''' Daemon thread that streams a WriteLog to the follower at
+    host:port, resyncing it from a full copy of persister whenever it's
+    missing something we no longer have. Sends an empty chunk at least
+    every heartbeat seconds, so the follower can track its lag.
+    '''
+    def __init__(self, wal, persister, host, port, aengel=None,
+                heartbeat=1, max_bytes=512 * 1024, retry=1):
+        super().__init__(daemon=True, name='replicator')
+        self._wal = wal
+        self._persister = persister
+        self._host = host
+        self._port = port
+        self._aengel = aengel
+        self._heartbeat = heartbeat
+        self._max_bytes = max_bytes
+        self._retry = retry
+        self._client = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._client is None:
+                    self._client = Autocomms(
+                        autoresponder_name = 'replicator',
+                        autoresponder_class = ReplicaClient,
+                        connector_class = WSBasicClient,
+                        connector_kwargs = {
+                            'host': self._host,
+                            'port': self._port,
+                        },
+                        aengel = self._aengel,
+                    )
+
+                if self._wal.needs_resync:
+                    self._resync()
+                else:
+                    self._stream()
+
+            except Exception:
+                logger.error(
+                    'Replication to ' + self._host + ':' + str(self._port) +
+                    ' failed w/ traceback:\n' +
+                    ''.join(traceback.format_exc())
+                )
+                self._stopped.wait(self._retry)
+
+    def _send(self, start, entries, flags=0):
+        wal = self._wal
+        return self._client.replicate(pack_chunk(
+            wal.epoch, start, wal.head, wal.head_time, entries, flags
+        ))
+
+    def _stream(self):
+        self._wal.wait(self._heartbeat)
+        start, entries = self._wal.pending(self._max_bytes)
+        self._wal.ack(*self._send(start, entries))
+
+    def _resync(self):
+        ''' Sends everything we have, as of the current head. Anything
+        published meanwhile is either in the copy or streamed after it
+        (or both, which the follower shrugs off).
+        '''
+        start = self._wal.head
+        logger.info(
+            'Resyncing follower ' + self._host + ':' + str(self._port) + '.'
+        )
+
+        flags = RESET
+        chunk = []
+        size = 0
+        count = 0
+        for __, __, data in walk_stored(self._persister):
+            data = bytes(data)
+            if chunk and size + len(data) > self._max_bytes:
+                self._send(start, chunk, flags)
+                flags = SNAPSHOT
+                chunk = []
+                size = 0
+            chunk.append((start, self._wal.head_time, data))
+            size += len(data)
+            count += 1
+
+        self._send(start, chunk, flags)
+        self._wal.rebase(start)
+        logger.info(
+            'Resynced follower with ' + str(count) + ' objects.'
+        )
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ReplicaBridgeServer(DemoBridgeServer):
+    ''' Bridge server that takes part in replication.
+
+    With a wal, every accepted publish is appended to it (for a
+    Replicator to stream). With follow=True, we're a read-only standby:
+    client publishes are refused, and the write log chunks streamed to
+    us are applied instead, until promote() is called. A follower can
+    have a wal too, to pass everything on to another standby.
+    '''
+    def __init__(self, wal=None, follow=False, *args, **kwargs):
+        self._wal = wal
+        self.following = follow
+
+        # Which primary epoch we're following, and how far into it
+        self.epoch = _NO_EPOCH
+        self.applied = 0
+        # Primary time of the last entry we applied
+        self.applied_time = time.time()
+        # Primary's log head, as of the last chunk
+        self.primary_head = 0
+
+        super().__init__(*args, **kwargs)
+        self.req_handlers[REPLICATE_CODE] = self.replicate_wrapper
+
+    def promote(self):
+        ''' Stops following, and starts accepting publishes. Anything
+        the old primary sends from now on is refused.
+        '''
+        if not self.following:
+            return
+
+        lag_bytes, lag_seconds = self.replication_lag()
+        self.following = False
+        logger.warning(
+            'Promoted to primary, ' + str(lag_bytes) + ' bytes (' +
+            '{:.3f}'.format(lag_seconds) + ' seconds) behind the old one.'
+        )
+
+    def replication_lag(self):
+        ''' Returns (bytes, seconds) that we're behind the primary, as
+        of its last chunk. Only meaningful while following.
+        '''
+        lag_bytes = max(self.primary_head - self.applied, 0)
+        if not lag_bytes:
+            return 0, 0
+        return lag_bytes, max(time.time() - self.applied_time, 0)
+
+    async def publish_wrapper(self, session, request_body):
+        if self.following:
+            raise ReplicationError(
+                'Read-only standby. Publish to the primary instead.'
+            )
+
+        response = await super().publish_wrapper(session, request_body)
+        if self._wal is not None:
+            self._wal.append(request_body)
+        return response
+
+    async def replicate_wrapper(self, session, request_body):
+        ''' Applies a chunk of the primary's write log, off of the event
+        loop, and acknowledges how far we've got.
+        '''
+        if not self.following:
+            raise ReplicationError('Not following; refusing replication.')
+
+        await self.loop.run_in_executor(
+            None,
+            self._apply_chunk,
+            request_body
+        )
+        return _ACK.pack(self.epoch, self.applied)
+
+    def _apply_chunk(self, data):
+        epoch, start, head, head_time, flags, entries = unpack_chunk(data)
+
+        if flags & RESET:
+            self.epoch = epoch
+            self.applied = start
+            self.applied_time = head_time
+        # We've missed something, or are following someone else. Just tell
+        # the primary where we are, so it can sort it out.
+        elif epoch != self.epoch or start > self.applied:
+            return
+
+        if epoch == self.epoch:
+            self.primary_head = head
+
+        for offset, written, packed in entries:
+            if not flags and offset < self.applied:
+                continue
+
+            try:
+                self._backend.publish(packed)
+            # Most likely something the primary has since superseded or
+            # removed, which we'll (have) hear(d) about separately.
+            except Exception as exc:
+                logger.debug(
+                    'Skipped replicated object: ' + repr(exc)
+                )
+            if self._wal is not None:
+                self._wal.append(packed)
+
+            if not flags:
+                self.applied = offset + len(packed)
+                self.applied_time = written
@@ -0,0 +1,340 @@
+'''
+Retention policies for superseded dynamic frames: keep the last K
+frames of every dynamic ghid and/or drop superseded frames older than T,
+reclaiming them incrementally from a background thread.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import collections
+import threading
+import time
+import traceback
+import logging
+
+from hypergolix.exceptions import DoesNotExist
+
+from hypergolix.persistence import MemoryLibrarian
+from hypergolix.persistence import _GobdLite
+from hypergolix.persistence import Doorman
+from hypergolix.persistence import Enforcer
+from hypergolix.persistence import Lawyer
+from hypergolix.persistence import Bookie
+from hypergolix.persistence import PostOffice
+from hypergolix.persistence import Undertaker
+from hypergolix.persistence import Salmonator
+
+from hypergolix.persisters import MemoryPersister
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionMixin:
+    ''' Librarian mixin that takes removal of superseded dynamic frames
+    out of the publish path. Must come directly before the base
+    librarian in the MRO, ie after anything that overrides store().
+
+    Until retain() is called, behaves exactly like the base librarian.
+    Afterwards, storing a new frame just retires the old one onto a
+    queue, and reclaim() (usually from a Reclaimer thread) drops
+    whatever falls outside the policy: all but the newest keep_frames
+    frames of each dynamic ghid, and (if max_age is set) superseded
+    frames older than max_age seconds. The current frame is never
+    dropped by retention.
+
+    Retained frames keep their targets alive: if the undertaker GCs a
+    target that retained history still points to, the data stays put
+    until the last such frame is reclaimed.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.keep_frames = 1
+        self.max_age = None
+        self._retaining = False
+
+        # Lookup <dynamic ghid>: deque((<frame ghid>, <target ghid>)) of
+        # superseded frames, oldest first
+        self._superseded = {}
+        # Dynamic ghids holding more superseded frames than the policy allows
+        self._over = set()
+        # (monotonic time superseded, dynamic ghid, frame ghid), oldest first.
+        # Only tracked when we have a max_age.
+        self._retired = collections.deque()
+        # Lookup <target ghid>: <number of superseded frames pointing at it>
+        self._held = {}
+        # Lookup <target ghid>: <obj>, for held targets the undertaker has
+        # already tried to GC
+        self._orphans = {}
+
+        # Superseded frames still held, and total dropped so far
+        self.superseded_count = 0
+        self.reclaimed_count = 0
+
+        super().__init__(*args, **kwargs)
+
+    def retain(self, keep_frames=1, max_age=None):
+        ''' Enables deferred reclaim with the passed policy. keep_frames
+        includes the current frame, so must be at least 1.
+        '''
+        if keep_frames < 1:
+            raise ValueError('Must keep at least the current frame.')
+
+        with self._restoring.mutex:
+            self.keep_frames = keep_frames
+            self.max_age = max_age
+            self._retaining = True
+
+    def store(self, obj, data):
+        ''' Stores new dynamic frames without removing the frame they
+        supersede; that is retired for reclaim() instead.
+        '''
+        if not self._retaining or not isinstance(obj, _GobdLite):
+            with self._restoring.mutex:
+                # Re-uploading a held target makes it a normal object again.
+                self._orphans.pop(obj.ghid, None)
+                super().store(obj, data)
+            return
+
+        with self._restoring.mutex:
+            previous = self._ghid_resolver(obj.ghid)
+            target = None
+            if previous != obj.ghid:
+                try:
+                    target = self.summarize(previous).target
+                except (KeyError, DoesNotExist):
+                    pass
+
+            # Hide the existing frame from the base librarian, so that it
+            # doesn't remove it synchronously.
+            self._dyn_resolver.pop(obj.ghid, None)
+
+            try:
+                super().store(obj, data)
+            except:
+                if previous != obj.ghid:
+                    self._dyn_resolver.setdefault(obj.ghid, previous)
+                raise
+
+            if previous != obj.ghid and previous != obj.frame_ghid:
+                self._retire(obj.ghid, previous, target)
+
+    def _retire(self, dynamic, frame, target):
+        frames = self._superseded.setdefault(dynamic, collections.deque())
+        frames.append((frame, target))
+        self.superseded_count += 1
+        if target is not None:
+            self._held[target] = self._held.get(target, 0) + 1
+
+        if len(frames) >= self.keep_frames:
+            self._over.add(dynamic)
+        if self.max_age is not None:
+            self._retired.append((time.monotonic(), dynamic, frame))
+
+    def force_gc(self, obj):
+        ''' Defers GC of targets that retained frames still point to.
+        Removing a dynamic binding also drops all of its retained
+        history.
+        '''
+        with self._restoring.mutex:
+            if obj.ghid in self._held and not isinstance(obj, _GobdLite):
+                self._orphans[obj.ghid] = obj
+                return
+
+            super().force_gc(obj)
+
+            if isinstance(obj, _GobdLite):
+                self._over.discard(obj.ghid)
+                for frame, target in self._superseded.pop(obj.ghid, ()):
+                    self._drop(frame, target)
+
+    def _pop_superseded(self, dynamic):
+        frames = self._superseded[dynamic]
+        entry = frames.popleft()
+        if not frames:
+            del self._superseded[dynamic]
+        return entry
+
+    def _next_expired(self):
+        ''' Returns the next (frame, target) that the policy says to
+        drop, or None. Call with the mutex held.
+        '''
+        while self._over:
+            dynamic = next(iter(self._over))
+            frames = self._superseded.get(dynamic, ())
+            if len(frames) >= self.keep_frames:
+                return self._pop_superseded(dynamic)
+            self._over.discard(dynamic)
+
+        if self.max_age is not None:
+            cutoff = time.monotonic() - self.max_age
+            while self._retired and self._retired[0][0] <= cutoff:
+                __, dynamic, frame = self._retired.popleft()
+                # Skip anything that was already dropped for other reasons.
+                frames = self._superseded.get(dynamic)
+                if frames and frames[0][0] == frame:
+                    return self._pop_superseded(dynamic)
+
+        return None
+
+    def _remove(self, ghid):
+        try:
+            self.remove_from_cache(ghid)
+        except (KeyError, DoesNotExist):
+            pass
+        self._catalog.pop(ghid, None)
+
+    def _drop(self, frame, target):
+        self._remove(frame)
+        self.superseded_count -= 1
+        self.reclaimed_count += 1
+
+        if target is None:
+            return
+
+        held = self._held[target] - 1
+        if held:
+            self._held[target] = held
+            return
+
+        del self._held[target]
+        orphan = self._orphans.pop(target, None)
+        # Finish the GC the undertaker started, unless it's been rebound
+        # since.
+        if orphan is not None and not self._percore.bookie.is_bound(orphan):
+            self._remove(target)
+
+    def reclaim(self, budget=256):
+        ''' Drops up to budget superseded frames that fall outside the
+        retention policy, taking the lock once per frame so that we
+        never hold up request handling for long. Returns the number of
+        frames dropped.
+        '''
+        dropped = 0
+        while dropped < budget:
+            with self._restoring.mutex:
+                entry = self._next_expired()
+                if entry is None:
+                    break
+                self._drop(*entry)
+            dropped += 1
+
+        return dropped
+
+    def drop_superseded(self):
+        ''' Drops every superseded frame, regardless of policy. For
+        shutdown, since retained history isn't tracked across restarts.
+        '''
+        with self._restoring.mutex:
+            for dynamic in list(self._superseded):
+                while dynamic in self._superseded:
+                    self._drop(*self._pop_superseded(dynamic))
+            self._over.clear()
+            self._retired.clear()
+
+    def superseded_frames(self):
+        ''' Returns a set of every superseded frame ghid still held.
+        '''
+        with self._restoring.mutex:
+            return {
+                frame
+                for frames in self._superseded.values()
+                for frame, __ in frames
+            }
+
+
+class RetainingLibrarian(RetentionMixin, MemoryLibrarian):
+    ''' MemoryLibrarian with deferred frame retention.
+    '''
+    def walk_cache(self):
+        ''' Iterator to go through the entire cache, returning possible
+        candidates for loading. Loading will handle malformed primitives
+        without error.
+
+        MemoryLibrarian doesn't implement this, which breaks anything
+        that copies the whole store (resyncs, shard exports). Only the
+        listing happens under the lock, so a long walk doesn't hold up
+        storing; anything removed meanwhile is skipped.
+        '''
+        with self._restoring.mutex:
+            ghids = list(self._shelf)
+
+        for ghid in ghids:
+            try:
+                yield self._shelf[ghid]
+            except KeyError:
+                pass
+
+
+class RetainingPersister(MemoryPersister):
+    ''' Replicate MemoryPersister, just replace Librarian with one that
+    supports retention policies for superseded dynamic frames.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.assemble(Doorman(), Enforcer(), Lawyer(), Bookie(),
+                        RetainingLibrarian(), PostOffice(),
+                        Undertaker(), Salmonator())
+
+        self.subscribe = self.postman.subscribe
+        self.unsubscribe = self.postman.unsubscribe
+        self.list_bindings = self.bookie.bind_status
+        self.list_debindings = self.bookie.debind_status
+
+
+class Reclaimer(threading.Thread):
+    ''' Daemon thread that reclaims superseded frames from a retaining
+    librarian every interval seconds until stopped. Works through any
+    backlog in batches, so the librarian lock is never held for long.
+    '''
+    def __init__(self, librarian, interval=1, batch=256):
+        super().__init__(daemon=True, name='reclaimer')
+        self._librarian = librarian
+        self._interval = interval
+        self._batch = batch
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                while (self._librarian.reclaim(self._batch) == self._batch and
+                    not self._stopped.is_set()):
+                        # Let request handling threads have the GIL.
+                        time.sleep(0)
+
+            except Exception:
+                logger.error(
+                    'Frame reclaim failed w/ traceback:\n' +
+                    ''.join(traceback.format_exc())
+                )
+
+    def stop(self):
+        self._stopped.set()
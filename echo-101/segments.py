@@ -0,0 +1,662 @@
+'''
+Disk-backed storage for the demo persistence server: append-only
+segment files, looked up by Ghid through a memory-mapped hash index.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import mmap
+import struct
+import zlib
+import pathlib
+import threading
+import logging
+
+from golix import Ghid
+
+from hypergolix.exceptions import DoesNotExist
+
+from hypergolix.persistence import _LibrarianCore
+from hypergolix.persistence import _GobdLite
+from hypergolix.persistence import Doorman
+from hypergolix.persistence import Enforcer
+from hypergolix.persistence import Lawyer
+from hypergolix.persistence import Bookie
+from hypergolix.persistence import PostOffice
+from hypergolix.persistence import Undertaker
+from hypergolix.persistence import Salmonator
+
+from hypergolix.persisters import MemoryPersister
+
+from objcache import ObjectCache
+from retention import RetentionMixin
+
+
+logger = logging.getLogger(__name__)
+
+
+# Record kinds, shared between the segment log and the index slot states.
+_EMPTY = 0
+_PUT = 1
+_ALIAS = 2
+_DELETED = 3
+
+# Segment record header: kind, key (packed ghid), data length, data crc32.
+_RECORD = struct.Struct('>B65sII')
+# Index header: magic, capacity, live slots, used slots (live + deleted),
+# checkpoint segment, checkpoint offset. Padded out to _INDEX_HEADER_SIZE.
+_INDEX_MAGIC = b'HGXIDX\x00\x01'
+_INDEX_HEADER = struct.Struct('>8sQQQIQ')
+_INDEX_HEADER_SIZE = 64
+# Index slot: state, key (packed ghid), segment, offset, data length.
+_SLOT = struct.Struct('>B65sIQI')
+
+
+def _slot_hash(key):
+    ''' Ghid addresses are already cryptographic hashes, so just use
+    the leading bytes of the address (skipping the algo byte).
+    '''
+    return int.from_bytes(key[1:9], byteorder='big', signed=False)
+
+
+class _MmapIndex:
+    ''' Open-addressed (linear probing) hash table living in a memory
+    mapped file. Maps packed ghid -> (kind, segment, offset, length).
+
+    NOT THREADSAFE. Must be called from within the owning store's lock.
+    '''
+    def __init__(self, path, capacity=1 << 16, max_load=.6):
+        self._path = pathlib.Path(path)
+        self._max_load = max_load
+
+        if not self._path.exists():
+            self._create(self._path, capacity)
+
+        self._file = open(str(self._path), 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+
+        magic, capacity, live, used, ckpt_seg, ckpt_off = \
+            _INDEX_HEADER.unpack_from(self._mm, 0)
+        if magic != _INDEX_MAGIC:
+            raise ValueError(
+                'Not a ghid index file: ' + self._path.as_posix()
+            )
+        self.capacity = capacity
+        self.live = live
+        self.used = used
+        self.checkpoint = (ckpt_seg, ckpt_off)
+
+    @staticmethod
+    def _create(path, capacity):
+        ''' Writes out an empty index with the passed capacity.
+        '''
+        with open(str(path), 'wb') as f:
+            f.write(
+                _INDEX_HEADER.pack(_INDEX_MAGIC, capacity, 0, 0, 0, 0).ljust(
+                    _INDEX_HEADER_SIZE, b'\x00'
+                )
+            )
+            f.truncate(_INDEX_HEADER_SIZE + capacity * _SLOT.size)
+
+    def _write_header(self):
+        _INDEX_HEADER.pack_into(
+            self._mm, 0, _INDEX_MAGIC, self.capacity, self.live, self.used,
+            self.checkpoint[0], self.checkpoint[1]
+        )
+
+    def _probe(self, key):
+        ''' Returns (slot number, slot tuple) for the key, or for the
+        slot the key should be inserted into if missing.
+        '''
+        capacity = self.capacity
+        slot = _slot_hash(key) % capacity
+        reusable = None
+
+        for __ in range(capacity):
+            record = _SLOT.unpack_from(
+                self._mm, _INDEX_HEADER_SIZE + slot * _SLOT.size
+            )
+            state = record[0]
+
+            if state == _EMPTY:
+                if reusable is not None:
+                    return reusable
+                return slot, record
+
+            elif state == _DELETED:
+                if reusable is None:
+                    reusable = slot, record
+
+            elif record[1] == key:
+                return slot, record
+
+            slot = (slot + 1) % capacity
+
+        # Only reachable if the table is entirely live/deleted, which the
+        # load factor should prevent.
+        if reusable is not None:
+            return reusable
+        raise RuntimeError('Ghid index is full.')
+
+    def get(self, key):
+        ''' Returns (kind, segment, offset, length), or None if missing.
+        '''
+        slot, record = self._probe(key)
+        state, found_key, segment, offset, length = record
+        if state in (_PUT, _ALIAS) and found_key == key:
+            return state, segment, offset, length
+        else:
+            return None
+
+    def put(self, key, kind, segment, offset, length):
+        if (self.used + 1) > self.capacity * self._max_load:
+            self._grow()
+
+        slot, record = self._probe(key)
+        state = record[0]
+        if state == _EMPTY:
+            self.used += 1
+            self.live += 1
+        elif state == _DELETED:
+            self.live += 1
+
+        _SLOT.pack_into(
+            self._mm, _INDEX_HEADER_SIZE + slot * _SLOT.size,
+            kind, key, segment, offset, length
+        )
+
+    def delete(self, key):
+        slot, record = self._probe(key)
+        state, found_key, segment, offset, length = record
+        if state in (_PUT, _ALIAS) and found_key == key:
+            _SLOT.pack_into(
+                self._mm, _INDEX_HEADER_SIZE + slot * _SLOT.size,
+                _DELETED, key, 0, 0, 0
+            )
+            self.live -= 1
+            return True
+        else:
+            return False
+
+    def items(self):
+        ''' Iterates over (key, kind, segment, offset, length) for every
+        live slot. Do not mutate the index while iterating.
+        '''
+        for slot in range(self.capacity):
+            state, key, segment, offset, length = _SLOT.unpack_from(
+                self._mm, _INDEX_HEADER_SIZE + slot * _SLOT.size
+            )
+            if state in (_PUT, _ALIAS):
+                yield key, state, segment, offset, length
+
+    def _grow(self):
+        ''' Doubles capacity (dropping deleted slots while we're at it)
+        by rebuilding into a fresh file and swapping it in.
+        '''
+        # Only double if we're actually full of live entries; otherwise a
+        # rebuild at the same size is enough to clear out the tombstones.
+        if self.live + 1 > self.capacity * self._max_load / 2:
+            capacity = self.capacity * 2
+        else:
+            capacity = self.capacity
+
+        tmp_path = self._path.with_suffix('.tmp')
+        self._create(tmp_path, capacity)
+        fresh = _MmapIndex(tmp_path, max_load=self._max_load)
+        for key, kind, segment, offset, length in self.items():
+            fresh.put(key, kind, segment, offset, length)
+        fresh.checkpoint = self.checkpoint
+        fresh._write_header()
+        fresh._mm.flush()
+
+        self._mm.close()
+        self._file.close()
+        fresh._mm.close()
+        fresh._file.close()
+        os.replace(str(tmp_path), str(self._path))
+
+        self._file = open(str(self._path), 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self.capacity = capacity
+        self.live = fresh.live
+        self.used = fresh.used
+        logger.info('Ghid index resized to ' + str(capacity) + ' slots.')
+
+    def flush(self):
+        self._write_header()
+        self._mm.flush()
+
+    def close(self):
+        self.flush()
+        self._mm.close()
+        self._file.close()
+
+
+class SegmentStore:
+    ''' Append-only segment log of (ghid -> data) records, with an
+    mmap'd index for O(1) lookups. Threadsafe.
+
+    Every mutation is appended to the active segment before the index is
+    updated, and the index header records how far into the log it has
+    been applied. On open, only the log tail past that checkpoint is
+    replayed, so restarts cost seconds regardless of store size.
+    '''
+    def __init__(self, datadir, segment_size=64 * 1048576, sync=False):
+        ''' datadir is created if it does not exist. If sync is True,
+        every write is fsync'd before returning.
+        '''
+        self._datadir = pathlib.Path(datadir)
+        self._datadir.mkdir(parents=True, exist_ok=True)
+        if not self._datadir.is_dir():
+            raise ValueError(
+                'Path is not an available directory: ' +
+                self._datadir.as_posix()
+            )
+
+        self._segment_size = segment_size
+        self._sync = sync
+        self._opslock = threading.RLock()
+
+        # Lookup <segment number>: <read-only fd>
+        self._readers = {}
+        self._active = None
+        self._active_fd = None
+        self._active_size = 0
+
+        self._index = _MmapIndex(self._datadir / 'ghid.idx')
+        self._open_segments()
+        self._replay()
+
+    def _segment_path(self, segment):
+        return self._datadir / '{:08d}.seg'.format(segment)
+
+    def segments(self):
+        ''' Returns a sorted list of all existing segment numbers.
+        '''
+        return sorted(
+            int(child.stem) for child in self._datadir.glob('*.seg')
+        )
+
+    def _open_segments(self):
+        for segment in self.segments():
+            self._readers[segment] = os.open(
+                str(self._segment_path(segment)), os.O_RDONLY
+            )
+
+        if self._readers:
+            self._activate(max(self._readers))
+        else:
+            self._activate(1)
+
+    def _activate(self, segment):
+        ''' Makes segment the one we append to, creating it if needed.
+        '''
+        if self._active_fd is not None:
+            if self._sync:
+                os.fsync(self._active_fd)
+            os.close(self._active_fd)
+
+        path = str(self._segment_path(segment))
+        self._active_fd = os.open(
+            path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        if segment not in self._readers:
+            self._readers[segment] = os.open(path, os.O_RDONLY)
+        self._active = segment
+        self._active_size = os.fstat(self._active_fd).st_size
+
+    def _replay(self):
+        ''' Applies any log records past the index checkpoint. A torn
+        record at the end of the active segment is truncated away.
+        '''
+        ckpt_segment, ckpt_offset = self._index.checkpoint
+        replayed = 0
+
+        for segment in self.segments():
+            if segment < ckpt_segment:
+                continue
+            elif segment == ckpt_segment:
+                offset = ckpt_offset
+            else:
+                offset = 0
+
+            good = offset
+            for kind, key, start, length, end in self._scan(segment, offset):
+                self._apply(kind, key, segment, start, length)
+                self._index.checkpoint = (segment, end)
+                good = end
+                replayed += 1
+
+            # Anything past the last good record is garbage from a crash.
+            size = os.fstat(self._readers[segment]).st_size
+            if good < size:
+                if segment == self._active:
+                    logger.warning(
+                        'Truncating torn write at end of segment ' +
+                        str(segment) + ' (' + str(size - good) + ' bytes).'
+                    )
+                    os.truncate(str(self._segment_path(segment)), good)
+                    self._active_size = good
+                else:
+                    logger.error(
+                        'Unreadable records in sealed segment ' +
+                        str(segment) + ' past offset ' + str(good) + '.'
+                    )
+
+        self._index.flush()
+        if replayed:
+            logger.info(
+                'Replayed ' + str(replayed) + ' log records past checkpoint.'
+            )
+
+    def _scan(self, segment, offset=0):
+        ''' Yields (kind, key, offset, length, end) for every intact
+        record in the segment, starting at offset.
+        '''
+        fd = self._readers[segment]
+        size = os.fstat(fd).st_size
+
+        while offset + _RECORD.size <= size:
+            header = os.pread(fd, _RECORD.size, offset)
+            kind, key, length, crc = _RECORD.unpack(header)
+            end = offset + _RECORD.size + length
+            if kind not in (_PUT, _ALIAS, _DELETED) or end > size:
+                break
+            data = os.pread(fd, length, offset + _RECORD.size)
+            if zlib.crc32(data) != crc:
+                break
+
+            yield kind, key, offset, length, end
+            offset = end
+
+    def _apply(self, kind, key, segment, offset, length):
+        if kind == _DELETED:
+            self._index.delete(key)
+        else:
+            self._index.put(key, kind, segment, offset, length)
+
+    def _append(self, kind, key, data):
+        ''' Appends a record to the log and then applies it to the index.
+        '''
+        record = _RECORD.pack(kind, key, len(data), zlib.crc32(data)) + data
+
+        with self._opslock:
+            if (self._active_size and
+                self._active_size + len(record) > self._segment_size):
+                    self._activate(self._active + 1)
+
+            offset = self._active_size
+            os.write(self._active_fd, record)
+            if self._sync:
+                os.fsync(self._active_fd)
+            self._active_size += len(record)
+
+            self._apply(kind, key, self._active, offset, len(data))
+            self._index.checkpoint = (self._active, self._active_size)
+
+    def put(self, key, data):
+        ''' Stores data under the (packed ghid) key.
+        '''
+        self._append(_PUT, bytes(key), bytes(data))
+
+    def put_alias(self, key, target):
+        ''' Points key at target. Used to persist dynamic ghid -> frame
+        ghid resolution across restarts.
+        '''
+        self._append(_ALIAS, bytes(key), bytes(target))
+
+    def delete(self, key):
+        ''' Removes the key. Returns False if it did not exist.
+        '''
+        key = bytes(key)
+        with self._opslock:
+            if self._index.get(key) is None:
+                return False
+            self._append(_DELETED, key, b'')
+            return True
+
+    def _read(self, key, kinds):
+        with self._opslock:
+            entry = self._index.get(key)
+            if entry is None or entry[0] not in kinds:
+                raise KeyError(key)
+            kind, segment, offset, length = entry
+            blob = os.pread(
+                self._readers[segment], _RECORD.size + length, offset
+            )
+
+        # Protect against an index page that outlived a lost segment write.
+        if blob[1:66] != key or len(blob) != _RECORD.size + length:
+            raise KeyError(key)
+        return blob[_RECORD.size:]
+
+    def get(self, key):
+        ''' Returns the data stored under key. Raises KeyError if
+        missing.
+        '''
+        return self._read(bytes(key), (_PUT,))
+
+    def get_alias(self, key):
+        ''' Returns the alias target for key, or None.
+        '''
+        try:
+            return self._read(bytes(key), (_ALIAS,))
+        except KeyError:
+            return None
+
+    def __contains__(self, key):
+        with self._opslock:
+            entry = self._index.get(bytes(key))
+        return entry is not None and entry[0] == _PUT
+
+    def __len__(self):
+        return self._index.live
+
+    def keys(self):
+        ''' Snapshot of all stored (non-alias) keys.
+        '''
+        with self._opslock:
+            return [
+                key for key, kind, *__ in self._index.items() if kind == _PUT
+            ]
+
+    def flush(self):
+        with self._opslock:
+            os.fsync(self._active_fd)
+            self._index.flush()
+
+    def close(self):
+        with self._opslock:
+            self.flush()
+            self._index.close()
+            os.close(self._active_fd)
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers.clear()
+
+
+class SegmentLibrarian(RetentionMixin, _LibrarianCore):
+    ''' Librarian that keeps object data in a SegmentStore instead of
+    memory. Only the (lazily-loaded) catalog of lightweight object
+    descriptions, plus an optional ObjectCache of hot object data, lives
+    in RAM. Supports retention policies for superseded dynamic frames
+    through retain().
+    '''
+    def __init__(self, datadir, segment_size=64 * 1048576, sync=False,
+                cache_bytes=0):
+        self._store = SegmentStore(
+            datadir,
+            segment_size = segment_size,
+            sync = sync
+        )
+
+        if cache_bytes:
+            self.cache = ObjectCache(cache_bytes)
+        else:
+            self.cache = None
+
+        super().__init__()
+
+    def _ghid_resolver(self, ghid):
+        ''' Fall back to the on-disk alias for dynamic ghids we haven't
+        seen since the last restart.
+        '''
+        resolved = super()._ghid_resolver(ghid)
+
+        if resolved is ghid:
+            target = self._store.get_alias(ghid)
+            if target is not None:
+                resolved = Ghid.from_bytes(target)
+                self._dyn_resolver[ghid] = resolved
+
+        return resolved
+
+    def store(self, obj, data):
+        ''' Also persists the dynamic ghid -> frame ghid resolution.
+        '''
+        if isinstance(obj, _GobdLite):
+            # Prime the resolver so that super() can find (and remove) any
+            # frame we stored before the last restart. Unless that's the
+            # frame being stored (eg. lazy-loading it after a restart),
+            # which super() would otherwise remove as superseded.
+            if self._ghid_resolver(obj.ghid) == obj.frame_ghid:
+                del self._dyn_resolver[obj.ghid]
+
+        super().store(obj, data)
+
+        if isinstance(obj, _GobdLite) and not self._restoring:
+            self._store.put_alias(obj.ghid, obj.frame_ghid)
+
+    def force_gc(self, obj):
+        if isinstance(obj, _GobdLite):
+            self._ghid_resolver(obj.ghid)
+
+        super().force_gc(obj)
+
+        if isinstance(obj, _GobdLite):
+            self._store.delete(obj.ghid)
+
+    def walk_cache(self):
+        ''' Iterator to go through the entire cache, returning possible
+        candidates for loading. Loading will handle malformed primitives
+        without error.
+        '''
+        for key in self._store.keys():
+            try:
+                yield self._store.get(key)
+            except KeyError:
+                pass
+
+    def add_to_cache(self, ghid, data):
+        ''' Adds the passed raw data to the cache.
+        '''
+        self._store.put(ghid, data)
+        # Freshly-published objects (especially new dynamic frames) are the
+        # most likely to be requested next, by subscribers.
+        if self.cache is not None:
+            self.cache.put(ghid, data)
+
+    def remove_from_cache(self, ghid):
+        ''' Removes the data associated with the passed ghid from the
+        cache.
+        '''
+        if self.cache is not None:
+            self.cache.discard(ghid)
+
+        if not self._store.delete(ghid):
+            raise DoesNotExist(
+                'Ghid does not exist at persister: ' + str(ghid)
+            )
+
+    def get_from_cache(self, ghid):
+        ''' Returns the raw data associated with the ghid.
+        '''
+        if self.cache is not None:
+            data = self.cache.get(ghid)
+            if data is not None:
+                return data
+
+        try:
+            data = self._store.get(ghid)
+        except KeyError as exc:
+            raise DoesNotExist(
+                'Ghid does not exist at persister: ' + str(ghid)
+            ) from exc
+
+        if self.cache is not None:
+            self.cache.put(ghid, data)
+        return data
+
+    def check_in_cache(self, ghid):
+        ''' Check to see if the ghid is contained in the cache.
+        '''
+        return ghid in self._store
+
+    def __len__(self):
+        ''' Live index entries (including dynamic ghid aliases).
+        '''
+        return len(self._store)
+
+    def close(self):
+        # Retained history isn't tracked across restarts, so don't leave it
+        # on disk forever.
+        self.drop_superseded()
+        self._store.close()
+
+
+class DiskPersister(MemoryPersister):
+    ''' Replicate MemoryPersister, just replace Librarian with one that
+    keeps everything in append-only segments under datadir.
+
+    Nothing is restored eagerly on startup: reads go straight to disk,
+    and the object catalog (and therefore bookkeeping) is lazy-loaded
+    from disk the first time an object is needed. If cache_bytes is
+    nonzero, hot objects are kept in an ObjectCache of that size.
+    '''
+    def __init__(self, datadir, segment_size=64 * 1048576, sync=False,
+                cache_bytes=0):
+        super().__init__()
+        self.assemble(Doorman(), Enforcer(), Lawyer(), Bookie(),
+                        SegmentLibrarian(datadir, segment_size, sync,
+                                        cache_bytes),
+                        PostOffice(), Undertaker(), Salmonator())
+
+        self.subscribe = self.postman.subscribe
+        self.unsubscribe = self.postman.unsubscribe
+        self.list_bindings = self.bookie.bind_status
+        self.list_debindings = self.bookie.debind_status
+
+    def close(self):
+        ''' Flushes the segment log and index to disk.
+        '''
+        self.librarian.close()
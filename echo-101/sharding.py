@@ -0,0 +1,952 @@
+'''
+Consistent-hash sharding of Ghids across several demo persistence
+servers, with background rebalancing when shards are added.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import bisect
+import collections
+import hashlib
+import struct
+import threading
+import time
+import traceback
+import logging
+
+from golix import Ghid
+
+from golix._getlow import GIDC
+from golix._getlow import GEOC
+from golix._getlow import GOBS
+from golix._getlow import GOBD
+from golix._getlow import GDXX
+from golix._getlow import GARQ
+
+from hypergolix.exceptions import DoesNotExist
+from hypergolix.exceptions import IllegalDynamicFrame
+from hypergolix.exceptions import UnboundContainer
+
+from hypergolix.persistence import _GidcLite
+from hypergolix.persistence import _GobdLite
+
+from hypergolix.comms import Autocomms
+from hypergolix.comms import WSBasicClient
+
+from batching import BatchingBridgeClient
+
+
+logger = logging.getLogger(__name__)
+
+
+# Request codes for moving objects between shards.
+EXPORT_CODE = b'RX'
+IDENTITIES_CODE = b'RI'
+EVICT_CODE = b'RV'
+
+# Export request header: most ghids to return, number of ranges. Followed
+# by the ranges, and optionally the cursor to start after.
+_EXPORT = struct.Struct('>IH')
+# Ring range: exclusive start, inclusive end.
+_RANGE = struct.Struct('>QQ')
+# Identity export request header: most ghids to return. Optionally
+# followed by the ghid to start after.
+_LIMIT = struct.Struct('>I')
+_GHID_SIZE = 65
+# Export cursor: the rank (see below) of the object's type, then its
+# ghid. Exports are ordered by cursor, so that paging works even if the
+# last object of the previous page has since been evicted.
+_CURSOR_SIZE = 1 + _GHID_SIZE
+
+# Exported in this order, so that everything an object depends on (its
+# author, its binding) reaches the new shard before it does.
+_LOADERS = (
+    (b'GIDC', GIDC),
+    (b'GOBD', GOBD),
+    (b'GOBS', GOBS),
+    (b'GEOC', GEOC),
+    (b'GARQ', GARQ),
+    (b'GDXX', GDXX),
+)
+_RANK = {magic: rank for rank, (magic, __) in enumerate(_LOADERS)}
+
+
+def ring_position(key):
+    ''' Position of a ghid (or any bytes) on the ring.
+    '''
+    digest = hashlib.sha256(bytes(key)).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def in_ranges(position, ranges):
+    ''' Checks position against (start, end] ring ranges, which wrap
+    around when start >= end.
+    '''
+    for start, end in ranges:
+        if start < end:
+            if start < position <= end:
+                return True
+        elif position > start or position <= end:
+            return True
+    return False
+
+
+def pack_ghids(ghids):
+    return b''.join(bytes(ghid) for ghid in ghids)
+
+
+def unpack_ghids(data):
+    return [
+        Ghid.from_bytes(data[offset:offset + _GHID_SIZE])
+        for offset in range(0, len(data), _GHID_SIZE)
+    ]
+
+
+def pack_export(ranges, limit, after=None):
+    msg = _EXPORT.pack(limit, len(ranges)) + b''.join(
+        _RANGE.pack(start, end) for start, end in ranges
+    )
+    if after is not None:
+        msg += after
+    return msg
+
+
+def unpack_export(data):
+    ''' Returns (ranges, limit, after) from an export request.
+    '''
+    limit, count = _EXPORT.unpack_from(data, 0)
+    ranges = [
+        _RANGE.unpack_from(data, _EXPORT.size + ii * _RANGE.size)
+        for ii in range(count)
+    ]
+    offset = _EXPORT.size + count * _RANGE.size
+    after = None
+    if len(data) > offset:
+        after = bytes(data[offset:offset + _CURSOR_SIZE])
+    return ranges, limit, after
+
+
+def unpack_export_page(data):
+    ''' Returns (ghids, cursor to continue after) from an export
+    response. The cursor is None once there's nothing left.
+    '''
+    cursors = [
+        bytes(data[offset:offset + _CURSOR_SIZE])
+        for offset in range(0, len(data), _CURSOR_SIZE)
+    ]
+    ghids = [Ghid.from_bytes(cursor[1:]) for cursor in cursors]
+    return ghids, (cursors[-1] if cursors else None)
+
+
+def pack_identities(after, limit):
+    msg = _LIMIT.pack(limit)
+    if after is not None:
+        msg += bytes(after)
+    return msg
+
+
+def unpack_identities(data):
+    ''' Returns (after, limit) from an identity export request.
+    '''
+    limit, = _LIMIT.unpack_from(data, 0)
+    after = None
+    if len(data) > _LIMIT.size:
+        after = Ghid.from_bytes(data[_LIMIT.size:])
+    return after, limit
+
+
+def load_packed(packed):
+    ''' Parses (without verifying) a packed Golix object. Returns
+    (magic, obj).
+    '''
+    magic = bytes(packed[:4])
+    for candidate, loader in _LOADERS:
+        if candidate == magic:
+            return magic, loader.unpack(packed)
+    raise ValueError('Not a Golix object: ' + repr(magic))
+
+
+class Placement:
+    ''' Works out which ghid decides where an object lives (its
+    placement key), so that everything the persister validates together
+    ends up on the same shard:
+
+        GIDC    everywhere (every shard needs to know every author)
+        GOBD    its dynamic ghid
+        GEOC    the dynamic ghid binding it, if any, else itself
+        GOBS    the placement of its target
+        GDXX    the placement of its target
+        GARQ    its recipient, so that it's delivered to subscribers
+
+    Containers of dynamic objects can't be placed without knowing which
+    binding they belong to, so place() has to see the binding first
+    (which the persister requires anyway). Keeps one entry per binding
+    and request seen until it's debound (see forget()), and at most
+    max_entries of them; past that, the least recently placed are
+    dropped. None means no limit.
+    '''
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        # Lookup <ghid>: <ghid it's placed with>, least recently set first
+        self._parents = collections.OrderedDict()
+        # Lookup <dynamic ghid>: (<frame ghid>, <target ghid>)
+        self._frames = {}
+
+    def __len__(self):
+        return len(self._parents)
+
+    def knows(self, ghid):
+        ''' Returns True if we know what ghid is placed with, as opposed
+        to placing it with itself because we never saw (or have since
+        forgotten) whatever binds it.
+        '''
+        return ghid in self._parents or ghid in self._frames
+
+    def key(self, ghid):
+        ''' Returns the placement key for ghid.
+        '''
+        # Chains are at most debinding -> binding -> container -> dynamic.
+        for __ in range(4):
+            try:
+                ghid = self._parents[ghid]
+            except KeyError:
+                break
+        return ghid
+
+    def _link(self, ghid, parent):
+        self._parents[ghid] = parent
+        self._parents.move_to_end(ghid)
+
+        if self.max_entries is None:
+            return
+        while len(self._parents) > self.max_entries:
+            oldest, parent = self._parents.popitem(last=False)
+            frame = self._frames.get(parent)
+            if frame is not None and oldest in frame:
+                del self._frames[parent]
+
+    def _unlink(self, ghid, parent):
+        if self._parents.get(ghid) == parent:
+            del self._parents[ghid]
+
+    def _set_frame(self, obj):
+        dynamic = obj.ghid_dynamic
+        previous = self._frames.get(dynamic)
+        if previous is not None:
+            for ghid in previous:
+                self._unlink(ghid, dynamic)
+
+        self._frames[dynamic] = (obj.ghid, obj.target)
+        self._link(obj.ghid, dynamic)
+        self._link(obj.target, dynamic)
+
+    def forget(self, target):
+        ''' Drops what we know about a binding or request that's been
+        debound, and so is about to be GC'd along with anything only it
+        was holding.
+        '''
+        self._parents.pop(target, None)
+        frame = self._frames.pop(target, None)
+        if frame is not None:
+            for ghid in frame:
+                self._unlink(ghid, target)
+
+    def place(self, magic, obj):
+        ''' Records the object, returning its placement key (or None if
+        it goes everywhere).
+        '''
+        if magic == b'GIDC':
+            return None
+        elif magic == b'GOBD':
+            self._set_frame(obj)
+            return obj.ghid_dynamic
+        elif magic == b'GOBS':
+            self._link(obj.ghid, obj.target)
+            return self.key(obj.target)
+        elif magic == b'GARQ':
+            self._link(obj.ghid, obj.recipient)
+            return obj.recipient
+        elif magic == b'GDXX':
+            return self.key(obj.target)
+        else:
+            return self.key(obj.ghid)
+
+
+class HashRing:
+    ''' Consistent-hash ring of shard names, with vnodes points per
+    shard.
+    '''
+    def __init__(self, shards=(), vnodes=64):
+        self.vnodes = vnodes
+        self._points = []
+        self._owners = []
+        for shard in shards:
+            self.add(shard)
+
+    def __len__(self):
+        return len(set(self._owners))
+
+    def __contains__(self, shard):
+        return shard in self._owners
+
+    def _shard_points(self, shard):
+        for replica in range(self.vnodes):
+            yield ring_position((shard + '#' + str(replica)).encode('utf-8'))
+
+    def owner(self, position):
+        ''' Returns the shard responsible for position.
+        '''
+        if not self._points:
+            raise RuntimeError('No shards on the ring.')
+        index = bisect.bisect_left(self._points, position)
+        return self._owners[index % len(self._points)]
+
+    def add(self, shard):
+        ''' Adds shard to the ring. Returns a lookup of
+        <previous owner>: [(start, end), ...] for the ranges it takes
+        over, which is empty for the first shard.
+        '''
+        if shard in self:
+            raise ValueError('Already on the ring: ' + repr(shard))
+
+        # Work out who used to own each new point before inserting any.
+        previous = {}
+        if self._points:
+            for position in self._shard_points(shard):
+                previous[position] = self.owner(position)
+
+        for position in self._shard_points(shard):
+            index = bisect.bisect_left(self._points, position)
+            # Skip the (astronomically unlikely) collisions.
+            if index < len(self._points) and self._points[index] == position:
+                continue
+            self._points.insert(index, position)
+            self._owners.insert(index, shard)
+
+        moved = {}
+        for index, (position, owner) in enumerate(
+            zip(self._points, self._owners)
+        ):
+            if owner != shard or position not in previous:
+                continue
+            start = self._points[index - 1]
+            moved.setdefault(previous[position], []).append((start, position))
+
+        return moved
+
+
+class ShardClient(BatchingBridgeClient):
+    ''' Bridge client for one shard, adding the requests that the
+    rebalancer uses to move objects off of it.
+    '''
+    REQUEST_CODES = dict(
+        BatchingBridgeClient.REQUEST_CODES,
+        export = EXPORT_CODE,
+        export_identities = IDENTITIES_CODE,
+        evict = EVICT_CODE,
+    )
+
+    def export(self, ranges, limit, after=None):
+        ''' Lists up to limit ghids whose placement falls within the
+        ring ranges, in the order they should be re-published, starting
+        after the passed cursor. Returns (ghids, cursor for the next
+        page).
+        '''
+        self.await_session_threadsafe()
+        response = self.send_threadsafe(
+            session = self.any_session,
+            msg = pack_export(ranges, limit, after),
+            request_code = self.REQUEST_CODES['export']
+        )
+        return unpack_export_page(response)
+
+    def export_identities(self, after=None, limit=4096):
+        ''' Lists up to limit identity ghids, in order, starting after
+        the passed ghid.
+        '''
+        self.await_session_threadsafe()
+        response = self.send_threadsafe(
+            session = self.any_session,
+            msg = pack_identities(after, limit),
+            request_code = self.REQUEST_CODES['export_identities']
+        )
+        return unpack_ghids(response)
+
+    def evict(self, ghids):
+        ''' Removes ghids from the shard without notifying anyone.
+        Returns the ghids that were actually removed.
+        '''
+        self.await_session_threadsafe()
+        response = self.send_threadsafe(
+            session = self.any_session,
+            msg = pack_ghids(ghids),
+            request_code = self.REQUEST_CODES['evict']
+        )
+        return unpack_ghids(response)
+
+
+def connect_shard(host, port, aengel=None, debug=False):
+    ''' Connects a ShardClient to the demo server at host:port.
+    '''
+    return Autocomms(
+        autoresponder_name = 'shard-' + host + ':' + str(port),
+        autoresponder_class = ShardClient,
+        connector_class = WSBasicClient,
+        connector_kwargs = {
+            'host': host,
+            'port': port,
+        },
+        debug = debug,
+        aengel = aengel,
+    )
+
+
+def _load_stored(librarian, data):
+    ''' Returns (magic, obj, data), or None for superseded frames and
+    anything malformed.
+    '''
+    try:
+        magic, obj = load_packed(data)
+    except Exception:
+        return None
+
+    if magic == b'GOBD':
+        with librarian._restoring.mutex:
+            current = librarian._ghid_resolver(obj.ghid_dynamic)
+        if current != obj.ghid:
+            return None
+    return magic, obj, data
+
+
+def walk_stored(persister):
+    ''' Parses everything the persister has, skipping superseded frames
+    and anything malformed. Yields (magic, obj, data), ordered so that
+    it can be re-published as-is: identities, then bindings, then
+    everything else.
+
+    The librarian lock is only held to list (and resolve) objects, so
+    anything stored or removed during the walk may or may not be
+    included. Only identities, bindings and requests (which are all
+    small) are sorted in memory; containers, which make up the bulk of
+    the data, are read one at a time in a second walk.
+    '''
+    librarian = persister.librarian
+    objects = []
+    for data in librarian.walk_cache():
+        if bytes(data[:4]) == b'GEOC':
+            continue
+        item = _load_stored(librarian, data)
+        if item is not None:
+            objects.append(item)
+
+    objects.sort(key=lambda item: _RANK[item[0]])
+    split = bisect.bisect_left([_RANK[item[0]] for item in objects],
+                               _RANK[b'GEOC'])
+    yield from objects[:split]
+
+    for data in librarian.walk_cache():
+        if bytes(data[:4]) != b'GEOC':
+            continue
+        item = _load_stored(librarian, data)
+        if item is not None:
+            yield item
+
+    yield from objects[split:]
+
+
+def export_range(persister, ranges):
+    ''' Server side of ShardClient.export(): lists the cursors of
+    everything placed within the ring ranges, in order. Dynamic objects
+    are listed by their dynamic ghid. Walks the whole store, so it's
+    meant to be run in an executor, once per pass; see page_export().
+    '''
+    # Bindings come first, so that their targets are placed with them.
+    placement = Placement()
+    cursors = []
+    for magic, obj, __ in walk_stored(persister):
+        key = placement.place(magic, obj)
+        if key is None or not in_ranges(ring_position(key), ranges):
+            continue
+
+        if magic == b'GOBD':
+            ghid = obj.ghid_dynamic
+        else:
+            ghid = obj.ghid
+        cursors.append(bytes([_RANK[magic]]) + bytes(ghid))
+
+    cursors.sort()
+    return cursors
+
+
+def page_export(cursors, after, limit):
+    ''' Packs the export response for up to limit of the export_range()
+    cursors, starting after the passed one.
+    '''
+    start = 0
+    if after is not None:
+        start = bisect.bisect_right(cursors, after)
+    return b''.join(cursors[start:start + limit])
+
+
+def export_identities(persister, after, limit):
+    ''' Server side of ShardClient.export_identities().
+    '''
+    # Ghids don't define an ordering, so order them by their bytes.
+    ghids = sorted(
+        (
+            obj.ghid for magic, obj, __ in walk_stored(persister)
+            if magic == b'GIDC'
+        ),
+        key = bytes
+    )
+    if after is not None:
+        keys = [bytes(ghid) for ghid in ghids]
+        ghids = ghids[bisect.bisect_right(keys, bytes(after)):]
+    return ghids[:limit]
+
+
+def evict(persister, ghids):
+    ''' Server side of ShardClient.evict(). Removes the objects at the
+    bookie and librarian, but (unlike a real GC) doesn't tell the
+    postman, since they haven't gone anywhere as far as subscribers are
+    concerned. Identities are never evicted.
+
+    Returns the ghids actually removed. Anything we don't have, and
+    anything the librarian holds on to anyway (eg. targets of retained
+    frames; see RetentionMixin.force_gc), isn't.
+    '''
+    librarian = persister.librarian
+    evicted = []
+    for ghid in ghids:
+        try:
+            obj = librarian.summarize(ghid)
+        except (KeyError, DoesNotExist):
+            continue
+        if isinstance(obj, _GidcLite):
+            continue
+
+        persister.bookie.force_gc(obj)
+        librarian.force_gc(obj)
+
+        if isinstance(obj, _GobdLite):
+            stored = obj.frame_ghid
+        else:
+            stored = obj.ghid
+        if not librarian.check_in_cache(stored):
+            evicted.append(ghid)
+
+    return evicted
+
+
+def _bound_targets(packed):
+    ''' Returns the ghids that a packed binding binds, if it is one.
+    '''
+    try:
+        magic, obj = load_packed(packed)
+    except Exception:
+        return ()
+
+    if magic in (b'GOBS', b'GOBD'):
+        return (obj.target,)
+    return ()
+
+
+class ShardedPersister:
+    ''' Persister that spreads objects across several shards (normally
+    ShardClients connected to demo servers) on a consistent-hash ring.
+    Use it directly for client-side routing, or put a DemoBridgeServer
+    in front of it (see demo-router.py) for a thin router.
+
+    Adding a shard copies the ranges it takes over from their previous
+    owners in the background, then evicts them there. Meanwhile, gets
+    that miss at the new owner fall back to asking every other shard.
+    Subscriptions follow their objects to the new owner.
+
+    Placement is remembered for at most max_placements bindings. Past
+    that (or after a restart), debindings whose target we no longer know
+    how to place are sent wherever the shards say the target is.
+    '''
+    def __init__(self, vnodes=64, export_limit=8192, batch=256, pause=.01,
+                 max_placements=1 << 20):
+        self.export_limit = export_limit
+        self.batch = batch
+        self.pause = pause
+
+        self._ring = HashRing(vnodes=vnodes)
+        self._placement = Placement(max_entries=max_placements)
+        # Lookup <shard name>: <shard>
+        self._shards = {}
+        self._opslock = threading.RLock()
+
+        # Lookup <subscribed ghid>: set(<callback>)
+        self._subscriptions = {}
+        # Lookup <subscribed ghid>: <shard name we're subscribed at>
+        self._subscribed_at = {}
+        # Lookup <shard name>: set(<ghid>) of subscriptions to drop there
+        # once it's done handing off the objects
+        self._departing = {}
+        # Lookup <subscribed ghid>: <last notification relayed>. Copying a
+        # frame to its new shard notifies again, so we dedupe.
+        self._last_notified = {}
+
+        self._rebalancers = []
+        self.moved_count = 0
+
+    @property
+    def shards(self):
+        ''' Names of the shards on the ring.
+        '''
+        with self._opslock:
+            return list(self._shards)
+
+    @property
+    def rebalancing(self):
+        return any(thread.is_alive() for thread in self._rebalancers)
+
+    def _owner(self, ghid):
+        key = self._placement.key(ghid)
+        return self._ring.owner(ring_position(key))
+
+    def add_shard(self, name, shard):
+        ''' Adds a shard, and starts moving the ranges it takes over to
+        it in the background. Returns the rebalancing thread, if any.
+        '''
+        with self._opslock:
+            if name in self._shards:
+                raise ValueError('Already have a shard called ' + repr(name))
+            source = next(iter(self._shards.values()), None)
+            # From now on new identities go to it as well...
+            self._shards[name] = shard
+
+        # ...and before it owns anything, it needs every existing author.
+        if source is not None:
+            self._copy_identities(source, shard)
+
+        with self._opslock:
+            moved = self._ring.add(name)
+            self._follow_subscriptions()
+
+        logger.info(
+            'Added shard ' + name + '; taking over ' +
+            str(sum(len(ranges) for ranges in moved.values())) +
+            ' ranges from ' + str(len(moved)) + ' shards.'
+        )
+        if not moved:
+            return None
+
+        rebalancer = threading.Thread(
+            target = self._rebalance,
+            args = (name, moved),
+            daemon = True,
+            name = 'rebalance-' + name
+        )
+        self._rebalancers.append(rebalancer)
+        rebalancer.start()
+        return rebalancer
+
+    def _copy_identities(self, source, dest):
+        after = None
+        while True:
+            ghids = source.export_identities(after, self.batch)
+            if not ghids:
+                break
+            identities = [
+                data for data in source.get_many(ghids)
+                if not isinstance(data, Exception)
+            ]
+            dest.publish_many(identities)
+            after = ghids[-1]
+
+    def _follow_subscriptions(self):
+        ''' Subscribes at the new owner of anything that moved. Call
+        with the lock held. We stay subscribed at the old owner until
+        it's done handing off, in case something was in flight there.
+        '''
+        for ghid, name in list(self._subscribed_at.items()):
+            owner = self._owner(ghid)
+            if owner == name:
+                continue
+
+            # Copying the current frame over will notify about it again.
+            try:
+                magic, obj = load_packed(self._shards[name].get(ghid))
+            except Exception:
+                pass
+            else:
+                if magic == b'GOBD':
+                    self._last_notified[ghid] = obj.ghid
+
+            self._shards[owner].subscribe(ghid, self._relay)
+            self._subscribed_at[ghid] = owner
+            self._departing.setdefault(name, set()).add(ghid)
+
+    def _rebalance(self, dest_name, moved):
+        for source_name, ranges in moved.items():
+            try:
+                count = self._migrate(source_name, dest_name, ranges)
+            except Exception:
+                logger.error(
+                    'Rebalancing from ' + source_name + ' to ' + dest_name +
+                    ' failed w/ traceback:\n' +
+                    ''.join(traceback.format_exc())
+                )
+            else:
+                logger.info(
+                    'Moved ' + str(count) + ' objects from ' +
+                    source_name + ' to ' + dest_name + '.'
+                )
+            self._release_subscriptions(source_name)
+
+    def _migrate(self, source_name, dest_name, ranges):
+        ''' Copies everything in ranges from source to dest, evicting it
+        from source as we go. Anything dest refuses for any reason but
+        already having something newer, or that source won't evict,
+        stays where it is.
+        '''
+        source = self._shards[source_name]
+        dest = self._shards[dest_name]
+        stuck = set()
+        moved = 0
+
+        # Each pass pages through the ranges once. Go around again for
+        # anything that arrived meanwhile, until a pass moves nothing.
+        while True:
+            passed = 0
+            after = None
+            while True:
+                ghids, after = source.export(
+                    ranges,
+                    self.export_limit,
+                    after
+                )
+                if not ghids:
+                    break
+
+                ghids = [ghid for ghid in ghids if ghid not in stuck]
+                for start in range(0, len(ghids), self.batch):
+                    passed += self._move(
+                        source,
+                        dest,
+                        dest_name,
+                        ghids[start:start + self.batch],
+                        stuck
+                    )
+                    time.sleep(self.pause)
+
+            if not passed:
+                return moved
+            moved += passed
+
+    def _move(self, source, dest, dest_name, chunk, stuck):
+        ''' Moves one chunk of ghids, adding any that can't be moved to
+        stuck. Returns how many were.
+        '''
+        evictable = []
+        copies = []
+        for ghid, data in zip(chunk, source.get_many(chunk)):
+            if isinstance(data, Exception):
+                stuck.add(ghid)
+            else:
+                copies.append((ghid, data))
+
+        # Keep these in order: bindings before their containers.
+        results = dest.publish_many(
+            [data for __, data in copies],
+            window = 1
+        )
+        for (ghid, data), result in zip(copies, results):
+            # Pinned by a binding that couldn't be moved (see below).
+            if ghid in stuck:
+                continue
+
+            if isinstance(result, (IllegalDynamicFrame, UnboundContainer)):
+                # Dest already has a newer frame, so this one (or its
+                # container) is obsolete.
+                evictable.append(ghid)
+            elif isinstance(result, Exception):
+                logger.warning(
+                    'Could not move ' + str(ghid) + ' to ' + dest_name +
+                    ': ' + repr(result)
+                )
+                stuck.add(ghid)
+                # Dest will refuse its target as unbound, but that doesn't
+                # make the target obsolete here.
+                stuck.update(_bound_targets(data))
+            else:
+                evictable.append(ghid)
+
+        if not evictable:
+            return 0
+
+        evicted = source.evict(evictable)
+        # Anything source kept would otherwise be exported again forever.
+        stuck.update(set(evictable).difference(evicted))
+        self.moved_count += len(evicted)
+        return len(evicted)
+
+    def _release_subscriptions(self, name):
+        with self._opslock:
+            for ghid in self._departing.pop(name, ()):
+                if self._subscribed_at.get(ghid) == name:
+                    continue
+                try:
+                    self._shards[name].unsubscribe(ghid, self._relay)
+                except Exception:
+                    logger.warning(
+                        'Failed to unsubscribe from ' + str(ghid) + ' at ' +
+                        name + ' w/ traceback:\n' +
+                        ''.join(traceback.format_exc())
+                    )
+
+    def _relay(self, subscribed_ghid, notification_ghid):
+        with self._opslock:
+            if self._last_notified.get(subscribed_ghid) == notification_ghid:
+                return
+            self._last_notified[subscribed_ghid] = notification_ghid
+            callbacks = list(self._subscriptions.get(subscribed_ghid, ()))
+
+        for callback in callbacks:
+            callback(subscribed_ghid, notification_ghid)
+
+    def ping(self):
+        return all(shard.ping() for shard in list(self._shards.values()))
+
+    def publish(self, packed):
+        ''' Publishes to the owning shard, or every shard for
+        identities.
+        '''
+        magic, obj = load_packed(packed)
+        with self._opslock:
+            key = self._placement.place(magic, obj)
+            if key is None:
+                shards = list(self._shards.values())
+            else:
+                shards = [self._shards[self._ring.owner(ring_position(key))]]
+            forgotten = (
+                magic == b'GDXX' and not self._placement.knows(obj.target)
+            )
+
+        if forgotten:
+            shards = [self._locate(obj.target)]
+
+        for shard in shards:
+            shard.publish(packed)
+
+        if magic == b'GDXX':
+            with self._opslock:
+                self._placement.forget(obj.target)
+        return True
+
+    def _locate(self, ghid):
+        ''' Returns the shard holding ghid, starting with its owner, or
+        the owner if nobody has it.
+        '''
+        owner = self._owner(ghid)
+        shard = self._shards[owner]
+        if shard.query(ghid):
+            return shard
+        for other in self._others(owner):
+            if other.query(ghid):
+                return other
+        return shard
+
+    def _others(self, owner):
+        with self._opslock:
+            return [
+                shard for name, shard in self._shards.items()
+                if name != owner
+            ]
+
+    def get(self, ghid):
+        ''' Gets from the owning shard, falling back to the rest (which
+        covers objects that haven't been moved yet).
+        '''
+        owner = self._owner(ghid)
+        try:
+            return self._shards[owner].get(ghid)
+        except Exception as exc:
+            for shard in self._others(owner):
+                try:
+                    return shard.get(ghid)
+                except Exception:
+                    pass
+            raise exc
+
+    def query(self, ghid):
+        owner = self._owner(ghid)
+        if self._shards[owner].query(ghid):
+            return True
+        return any(shard.query(ghid) for shard in self._others(owner))
+
+    def list_bindings(self, ghid):
+        return self._shards[self._owner(ghid)].list_bindings(ghid)
+
+    def list_debindings(self, ghid):
+        return self._shards[self._owner(ghid)].list_debindings(ghid)
+
+    def subscribe(self, ghid, callback):
+        with self._opslock:
+            callbacks = self._subscriptions.get(ghid)
+            if callbacks is None:
+                owner = self._owner(ghid)
+                self._shards[owner].subscribe(ghid, self._relay)
+                callbacks = self._subscriptions[ghid] = set()
+                self._subscribed_at[ghid] = owner
+            callbacks.add(callback)
+        return True
+
+    def unsubscribe(self, ghid, callback):
+        ''' Returns True if callback was subscribed to ghid.
+        '''
+        with self._opslock:
+            callbacks = self._subscriptions.get(ghid)
+            if callbacks is None or callback not in callbacks:
+                return False
+
+            callbacks.discard(callback)
+            if not callbacks:
+                del self._subscriptions[ghid]
+                self._last_notified.pop(ghid, None)
+                owner = self._subscribed_at.pop(ghid)
+                self._shards[owner].unsubscribe(ghid, self._relay)
+        return True
+
+    def list_subs(self):
+        with self._opslock:
+            return list(self._subscriptions)
+
+    def disconnect(self):
+        with self._opslock:
+            for ghid, callbacks in list(self._subscriptions.items()):
+                for callback in list(callbacks):
+                    self.unsubscribe(ghid, callback)
+        return True
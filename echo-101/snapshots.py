@@ -0,0 +1,430 @@
+'''
+Snapshots for the in-memory demo persistence server: write everything
+out on shutdown (or periodically), and lazily serve it back out of a
+memory-mapped file on the next startup.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import mmap
+import struct
+import pathlib
+import threading
+import time
+import traceback
+import logging
+
+from golix import Ghid
+
+from hypergolix.persistence import MemoryLibrarian
+from hypergolix.persistence import _GobdLite
+from hypergolix.persistence import Doorman
+from hypergolix.persistence import Enforcer
+from hypergolix.persistence import Lawyer
+from hypergolix.persistence import Bookie
+from hypergolix.persistence import PostOffice
+from hypergolix.persistence import Undertaker
+from hypergolix.persistence import Salmonator
+
+from hypergolix.persisters import MemoryPersister
+
+from retention import RetentionMixin
+
+
+logger = logging.getLogger(__name__)
+
+
+# Header: magic, object count, alias count.
+_MAGIC = b'HGXSNAP\x01'
+_HEADER = struct.Struct('>8sQQ')
+# Object index entry (sorted by key): key, data offset, data length.
+_ENTRY = struct.Struct('>65sQI')
+# Alias entry (sorted by key): dynamic ghid, frame ghid.
+_ALIAS = struct.Struct('>65s65s')
+
+
+class Snapshot:
+    ''' Read-only view of a snapshot file. Opening is O(1) regardless
+    of size; lookups binary search the mmap'd index.
+
+    Layout: header, sorted object index, sorted alias table, then the
+    object data itself.
+    '''
+    def __init__(self, path):
+        self._file = open(str(path), 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.alias_count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError('Not a snapshot file: ' + str(path))
+
+        self._index_start = _HEADER.size
+        self._alias_start = self._index_start + self.count * _ENTRY.size
+
+    @staticmethod
+    def _search(mm, start, count, record, key):
+        ''' Binary search for key among count sorted records. Returns
+        the unpacked record, or None.
+        '''
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = record.unpack_from(mm, start + mid * record.size)
+            if found[0] < key:
+                lo = mid + 1
+            elif found[0] > key:
+                hi = mid
+            else:
+                return found
+        return None
+
+    def get(self, key):
+        ''' Returns the data for the (packed ghid) key, or None.
+        '''
+        found = self._search(
+            self._mm, self._index_start, self.count, _ENTRY, bytes(key)
+        )
+        if found is None:
+            return None
+        __, offset, length = found
+        return self._mm[offset:offset + length]
+
+    def __contains__(self, key):
+        return self._search(
+            self._mm, self._index_start, self.count, _ENTRY, bytes(key)
+        ) is not None
+
+    def get_alias(self, key):
+        ''' Returns the packed frame ghid for a dynamic ghid, or None.
+        '''
+        found = self._search(
+            self._mm, self._alias_start, self.alias_count, _ALIAS, bytes(key)
+        )
+        if found is None:
+            return None
+        return found[1]
+
+    def keys(self):
+        for ii in range(self.count):
+            yield _ENTRY.unpack_from(
+                self._mm, self._index_start + ii * _ENTRY.size
+            )[0]
+
+    def aliases(self):
+        for ii in range(self.alias_count):
+            yield _ALIAS.unpack_from(
+                self._mm, self._alias_start + ii * _ALIAS.size
+            )
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    @staticmethod
+    def write(path, objects, aliases):
+        ''' Atomically writes a snapshot to path.
+
+        objects is a mapping of packed ghid -> data getter (a callable
+        returning the data, so we only hold one object at a time).
+        aliases is a mapping of packed dynamic ghid -> packed frame ghid.
+        '''
+        path = pathlib.Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+
+        keys = sorted(objects)
+        alias_keys = sorted(aliases)
+        offset = (
+            _HEADER.size +
+            len(keys) * _ENTRY.size +
+            len(alias_keys) * _ALIAS.size
+        )
+
+        # First pass: pull the data and compute offsets for the index.
+        lengths = []
+        with open(str(tmp_path), 'wb') as f:
+            f.seek(offset)
+            for key in keys:
+                data = objects[key]()
+                f.write(data)
+                lengths.append(len(data))
+
+            f.seek(0)
+            f.write(_HEADER.pack(_MAGIC, len(keys), len(alias_keys)))
+            for key, length in zip(keys, lengths):
+                f.write(_ENTRY.pack(key, offset, length))
+                offset += length
+            for key in alias_keys:
+                f.write(_ALIAS.pack(key, aliases[key]))
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(str(tmp_path), str(path))
+        return len(keys)
+
+
+class SnapshotLibrarian(RetentionMixin, MemoryLibrarian):
+    ''' MemoryLibrarian that falls back to a memory-mapped Snapshot for
+    anything it doesn't have in memory yet. Snapshotted objects are
+    pulled into memory the first time they're requested. Supports
+    retention policies for superseded dynamic frames through retain().
+    '''
+    def __init__(self, path):
+        self._path = pathlib.Path(path)
+        self._snapshot = None
+        # Snapshotted ghids that have since been removed
+        self._removed = set()
+        self._removed_aliases = set()
+        # Snapshotted ghids that are now on the shelf or removed, ie that
+        # we no longer serve from the snapshot
+        self._shadowed = set()
+
+        if self._path.exists():
+            self._snapshot = Snapshot(self._path)
+            logger.info(
+                'Serving ' + str(self._snapshot.count) + ' objects from '
+                'snapshot ' + self._path.as_posix()
+            )
+
+        super().__init__()
+
+    def _ghid_resolver(self, ghid):
+        ''' Fall back to the snapshot for dynamic ghids we haven't seen
+        since startup.
+        '''
+        resolved = super()._ghid_resolver(ghid)
+
+        if (resolved is ghid and self._snapshot is not None and
+            ghid not in self._removed_aliases):
+                target = self._snapshot.get_alias(ghid)
+                if target is not None:
+                    resolved = Ghid.from_bytes(target)
+                    self._dyn_resolver[ghid] = resolved
+
+        return resolved
+
+    def store(self, obj, data):
+        if isinstance(obj, _GobdLite):
+            # Prime the resolver so that super() can find (and remove) any
+            # frame that only exists in the snapshot. Unless that's the
+            # frame being stored (eg. lazy-loading it from the snapshot),
+            # which super() would otherwise remove as superseded.
+            if self._ghid_resolver(obj.ghid) == obj.frame_ghid:
+                del self._dyn_resolver[obj.ghid]
+        super().store(obj, data)
+
+    def force_gc(self, obj):
+        if isinstance(obj, _GobdLite):
+            self._ghid_resolver(obj.ghid)
+            self._removed_aliases.add(obj.ghid)
+        super().force_gc(obj)
+
+    def _in_snapshot(self, ghid):
+        return (
+            self._snapshot is not None and
+            ghid not in self._removed and
+            ghid in self._snapshot
+        )
+
+    def walk_cache(self):
+        ''' Iterator to go through the entire cache, returning possible
+        candidates for loading. Loading will handle malformed primitives
+        without error.
+        '''
+        with self._restoring.mutex:
+            ghids = list(self._shelf)
+
+        for ghid in ghids:
+            try:
+                yield self._shelf[ghid]
+            except KeyError:
+                pass
+
+        if self._snapshot is not None:
+            for key in self._snapshot.keys():
+                ghid = Ghid.from_bytes(key)
+                if ghid not in self._shelf and ghid not in self._removed:
+                    yield self._snapshot.get(key)
+
+    def add_to_cache(self, ghid, data):
+        self._removed.discard(ghid)
+        if self._snapshot is not None and ghid in self._snapshot:
+            self._shadowed.add(ghid)
+        super().add_to_cache(ghid, data)
+
+    def remove_from_cache(self, ghid):
+        ''' Removes the data associated with the passed ghid from the
+        cache.
+        '''
+        # Objects promoted out of the snapshot are in both, and must be
+        # removed from both, or the snapshot would serve them again.
+        in_snapshot = self._in_snapshot(ghid)
+        if ghid in self._shelf:
+            super().remove_from_cache(ghid)
+        elif not in_snapshot:
+            raise KeyError(ghid)
+
+        if in_snapshot:
+            self._removed.add(ghid)
+            self._shadowed.add(ghid)
+
+    def get_from_cache(self, ghid):
+        ''' Returns the raw data associated with the ghid, promoting it
+        out of the snapshot if needed.
+        '''
+        try:
+            return self._shelf[ghid]
+
+        except KeyError:
+            if not self._in_snapshot(ghid):
+                raise
+
+            data = self._snapshot.get(ghid)
+            self._shelf[ghid] = data
+            self._shadowed.add(ghid)
+            return data
+
+    def check_in_cache(self, ghid):
+        ''' Check to see if the ghid is contained in the cache.
+        '''
+        return ghid in self._shelf or self._in_snapshot(ghid)
+
+    def __len__(self):
+        unloaded = 0
+        if self._snapshot is not None:
+            unloaded = self._snapshot.count - len(self._shadowed)
+        return len(self._shelf) + unloaded
+
+    def write_snapshot(self, path=None):
+        ''' Snapshots everything we have (in memory or still unloaded
+        from the previous snapshot) to path (defaulting to the one we
+        loaded from). Returns the number of objects written.
+        '''
+        if path is None:
+            path = self._path
+
+        # Freeze the current state while holding the lock, but do all of the
+        # actual IO outside of it.
+        with self._restoring.mutex:
+            # Retained history (and anything only it was keeping alive)
+            # isn't tracked across restarts, so leave it out.
+            retired = self.superseded_frames().union(self._orphans)
+            shelf = {
+                ghid: data for ghid, data in self._shelf.items()
+                if ghid not in retired
+            }
+            dyn_resolver = dict(self._dyn_resolver)
+            removed = set(self._removed)
+            removed_aliases = set(self._removed_aliases)
+
+        objects = {
+            bytes(ghid): (lambda data=data: data)
+            for ghid, data in shelf.items()
+        }
+        aliases = {
+            bytes(ghid): bytes(frame) for ghid, frame in dyn_resolver.items()
+        }
+
+        snapshot = self._snapshot
+        if snapshot is not None:
+            removed = {bytes(ghid) for ghid in removed}
+            removed_aliases = {bytes(ghid) for ghid in removed_aliases}
+
+            for key in snapshot.keys():
+                if key not in objects and key not in removed:
+                    objects[key] = (
+                        lambda key=key: snapshot.get(key)
+                    )
+            for key, frame in snapshot.aliases():
+                if key not in aliases and key not in removed_aliases:
+                    aliases[key] = frame
+
+        return Snapshot.write(path, objects, aliases)
+
+    def close(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+
+
+class SnapshotPersister(MemoryPersister):
+    ''' Replicate MemoryPersister, just replace Librarian with one that
+    warm-starts from (and can write out) a snapshot file at path.
+    '''
+    def __init__(self, path):
+        super().__init__()
+        self.assemble(Doorman(), Enforcer(), Lawyer(), Bookie(),
+                        SnapshotLibrarian(path), PostOffice(),
+                        Undertaker(), Salmonator())
+
+        self.subscribe = self.postman.subscribe
+        self.unsubscribe = self.postman.unsubscribe
+        self.list_bindings = self.bookie.bind_status
+        self.list_debindings = self.bookie.debind_status
+
+    def write_snapshot(self):
+        ''' Snapshots the persister, logging how long it took.
+        '''
+        start = time.monotonic()
+        count = self.librarian.write_snapshot()
+        logger.info(
+            'Snapshotted ' + str(count) + ' objects in ' +
+            '{:.3f}'.format(time.monotonic() - start) + ' seconds.'
+        )
+
+    def close(self):
+        self.librarian.close()
+
+
+class Snapshotter(threading.Thread):
+    ''' Daemon thread that snapshots a SnapshotPersister every interval
+    seconds until stopped.
+    '''
+    def __init__(self, persister, interval):
+        super().__init__(daemon=True, name='snapshotter')
+        self._persister = persister
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._persister.write_snapshot()
+            except Exception:
+                logger.error(
+                    'Periodic snapshot failed w/ traceback:\n' +
+                    ''.join(traceback.format_exc())
+                )
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,89 @@
+'''
+Lightweight measurement helpers for the demo persistence server.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import collections
+
+
+def percentile(ordered, fraction):
+    ''' Nearest-rank percentile of an already-sorted sequence.
+    '''
+    if not ordered:
+        return 0.0
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class RollingPercentiles:
+    ''' Keeps the last window samples (plus lifetime count and total)
+    and computes percentiles over them on demand. Not threadsafe; record
+    from a single thread or event loop.
+    '''
+    def __init__(self, window=4096):
+        self._samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        ''' Returns a dict of count, lifetime mean, and windowed
+        p50/p95/p99/max.
+        '''
+        ordered = sorted(self._samples)
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = 0.0
+
+        return {
+            'count': self.count,
+            'mean': mean,
+            'p50': percentile(ordered, .50),
+            'p95': percentile(ordered, .95),
+            'p99': percentile(ordered, .99),
+            'max': ordered[-1] if ordered else 0.0,
+        }
+
+    def __repr__(self):
+        return (
+            type(self).__name__ + '(' +
+            ', '.join(
+                k + '=' + (str(v) if k == 'count' else '{:.6f}'.format(v))
+                for k, v in self.summary().items()
+            ) + ')'
+        )
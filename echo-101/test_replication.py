@@ -0,0 +1,92 @@
+'''
+Tests for primary/standby replication (replication.py).
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import unittest
+
+try:
+    from golix import FirstParty
+    from retention import RetainingPersister
+    from replication import WriteLog
+    from replication import Replicator
+    from replication import unpack_chunk
+except ImportError as exc:
+    raise unittest.SkipTest('hypergolix is not installed.') from exc
+
+
+class _RecordingClient:
+    ''' Stands in for the ReplicaClient, acking every chunk.
+    '''
+    def __init__(self, wal):
+        self.wal = wal
+        self.chunks = []
+
+    def replicate(self, chunk):
+        self.chunks.append(unpack_chunk(chunk))
+        return self.wal.epoch, self.wal.head
+
+
+class ResyncTest(unittest.TestCase):
+    def test_resync_memory_backend(self):
+        ''' The default (memory) backend must be walkable for a resync.
+        '''
+        persister = RetainingPersister()
+        author = FirstParty()
+        container = author.make_container(author.new_secret(), b'hello')
+        binding = author.make_bind_static(container.ghid)
+        for obj in (author.second_party, binding, container):
+            persister.publish(obj.packed)
+
+        wal = WriteLog()
+        replicator = Replicator(wal, persister, 'localhost', 0,
+                                max_bytes=1)
+        client = replicator._client = _RecordingClient(wal)
+        replicator._resync()
+
+        sent = [
+            packed
+            for *__, entries in client.chunks
+            for __, __, packed in entries
+        ]
+        # Identities, then bindings, then everything else.
+        self.assertEqual(sent, [
+            bytes(author.second_party.packed),
+            bytes(binding.packed),
+            bytes(container.packed),
+        ])
+        self.assertEqual(wal.acked, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+'''
+Tests for the disk backend (segments.py).
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from golix import Ghid
+    from hypergolix.persistence import _GobdLite
+except ImportError as exc:
+    raise unittest.SkipTest('hypergolix is not installed.') from exc
+
+from segments import SegmentLibrarian
+
+
+def _ghid():
+    return Ghid.from_bytes(b'\x01' + os.urandom(64))
+
+
+class _IngestingCore:
+    ''' Just enough of a persistence core for the librarian to lazy-load
+    from: "ingesting" data stores the object description it was made
+    from. Data is just the packed frame ghid.
+    '''
+    def __init__(self, librarian, objs):
+        self.librarian = librarian
+        self.objs = objs
+
+    def ingest(self, data):
+        obj = self.objs[Ghid.from_bytes(data[:65])]
+        self.librarian.store(obj, data)
+
+
+class SegmentLibrarianTest(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+
+        dynamic = _ghid()
+        author = _ghid()
+        self.frame1 = _ghid()
+        self.frame2 = _ghid()
+        self.dynamic = dynamic
+        self.objs = {
+            self.frame1: _GobdLite(dynamic, author, _ghid(), self.frame1, []),
+            self.frame2: _GobdLite(dynamic, author, _ghid(), self.frame2,
+                                   [self.frame1]),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir, ignore_errors=True)
+
+    def _open(self):
+        librarian = SegmentLibrarian(self.datadir)
+        librarian._percore = _IngestingCore(librarian, self.objs)
+        return librarian
+
+    def test_superseded_frame_removed(self):
+        librarian = self._open()
+        librarian.store(self.objs[self.frame1], bytes(self.frame1))
+        librarian.store(self.objs[self.frame2], bytes(self.frame2))
+
+        self.assertFalse(librarian.check_in_cache(self.frame1))
+        self.assertTrue(librarian.check_in_cache(self.frame2))
+        librarian.close()
+
+    def test_lazy_load_after_restart(self):
+        ''' Without retention, lazy-loading the current frame of a
+        dynamic ghid after a restart must not remove it as superseded.
+        '''
+        librarian = self._open()
+        librarian.store(self.objs[self.frame1], bytes(self.frame1))
+        librarian.store(self.objs[self.frame2], bytes(self.frame2))
+        librarian.close()
+
+        librarian = self._open()
+        self.assertEqual(librarian.summarize(self.dynamic).frame_ghid,
+                         self.frame2)
+        self.assertTrue(librarian.check_in_cache(self.frame2))
+        self.assertEqual(librarian.retrieve(self.dynamic),
+                         bytes(self.frame2))
+        librarian.close()
+
+        # And it's still there after the next restart, too.
+        librarian = self._open()
+        self.assertEqual(librarian.retrieve(self.dynamic),
+                         bytes(self.frame2))
+        librarian.close()
+
+    def test_update_after_restart(self):
+        ''' A new frame after a restart still replaces the one on disk.
+        '''
+        librarian = self._open()
+        librarian.store(self.objs[self.frame1], bytes(self.frame1))
+        librarian.close()
+
+        librarian = self._open()
+        librarian.store(self.objs[self.frame2], bytes(self.frame2))
+        self.assertFalse(librarian.check_in_cache(self.frame1))
+        self.assertEqual(librarian.retrieve(self.dynamic),
+                         bytes(self.frame2))
+        librarian.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
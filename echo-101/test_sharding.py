@@ -0,0 +1,254 @@
+'''
+Tests for consistent-hash sharding (sharding.py).
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import threading
+import unittest
+
+try:
+    from golix import FirstParty
+    from retention import RetainingPersister
+    from sharding import ShardedPersister
+    from sharding import export_range
+    from sharding import page_export
+    from sharding import unpack_export_page
+    from sharding import export_identities
+    from sharding import evict
+except ImportError as exc:
+    raise unittest.SkipTest('hypergolix is not installed.') from exc
+
+
+def _call(func, *args):
+    try:
+        return func(*args)
+    except Exception as exc:
+        return exc
+
+
+class _LocalShard:
+    ''' Stands in for a ShardClient connected to a memory-backend demo
+    server, by calling the server side directly.
+    '''
+    def __init__(self):
+        self.persister = RetainingPersister()
+        self.refuse = set()
+        self.exports = 0
+
+    def export(self, ranges, limit, after=None):
+        self.exports += 1
+        cursors = export_range(self.persister, ranges)
+        return unpack_export_page(page_export(cursors, after, limit))
+
+    def export_identities(self, after=None, limit=4096):
+        return export_identities(self.persister, after, limit)
+
+    def evict(self, ghids):
+        return evict(self.persister, ghids)
+
+    def publish(self, packed):
+        if bytes(packed) in self.refuse:
+            raise ValueError('Refused.')
+        self.persister.publish(packed)
+        return True
+
+    def publish_many(self, packed_objects, window=8):
+        return [_call(self.publish, packed) for packed in packed_objects]
+
+    def get(self, ghid):
+        return self.persister.get(ghid)
+
+    def get_many(self, ghids, window=8):
+        return [_call(self.get, ghid) for ghid in ghids]
+
+    def query(self, ghid):
+        return self.persister.query(ghid)
+
+    def holds(self, ghid):
+        return self.persister.librarian.check_in_cache(ghid)
+
+
+class ShardedPersisterTest(unittest.TestCase):
+    def setUp(self):
+        self.author = FirstParty()
+        self.objects = []
+        for ii in range(16):
+            container = self.author.make_container(
+                self.author.new_secret(),
+                bytes([ii]) * 16
+            )
+            binding = self.author.make_bind_static(container.ghid)
+            self.objects.append(binding)
+            self.objects.append(container)
+
+    def _populate(self, sharded):
+        sharded.publish(self.author.second_party.packed)
+        for obj in self.objects:
+            sharded.publish(obj.packed)
+
+    def test_add_memory_shard(self):
+        ''' Adding a second memory-backend shard copies the identities
+        over and moves everything it now owns.
+        '''
+        shards = {'first': _LocalShard(), 'second': _LocalShard()}
+        sharded = ShardedPersister(vnodes=16, pause=0)
+        sharded.add_shard('first', shards['first'])
+        self._populate(sharded)
+
+        rebalancer = sharded.add_shard('second', shards['second'])
+        self.assertIsNotNone(rebalancer)
+        rebalancer.join(30)
+        self.assertFalse(sharded.rebalancing)
+
+        self.assertTrue(shards['second'].holds(self.author.ghid))
+        self.assertGreater(sharded.moved_count, 0)
+        for obj in self.objects:
+            owner = sharded._owner(obj.ghid)
+            for name, shard in shards.items():
+                self.assertEqual(shard.holds(obj.ghid), name == owner)
+            self.assertEqual(sharded.get(obj.ghid), bytes(obj.packed))
+
+    def test_debind_forgotten_placement(self):
+        ''' Debinding reaches the shard holding the binding even once
+        placement has forgotten it, and debound bindings are forgotten.
+        '''
+        shards = {'first': _LocalShard(), 'second': _LocalShard()}
+        sharded = ShardedPersister(vnodes=16, pause=0, max_placements=4)
+        for name, shard in shards.items():
+            sharded.add_shard(name, shard)
+        self._populate(sharded)
+        self.assertEqual(len(sharded._placement), 4)
+
+        for binding in self.objects[0::2]:
+            sharded.publish(self.author.make_debind(binding.ghid).packed)
+
+        self.assertEqual(len(sharded._placement), 0)
+        for obj in self.objects:
+            for shard in shards.values():
+                self.assertFalse(shard.holds(obj.ghid))
+
+    def _migrate_all(self, sharded):
+        ''' Runs a migration of the whole ring from first to second,
+        failing instead of hanging if it never finishes.
+        '''
+        result = []
+        migration = threading.Thread(
+            target = lambda: result.append(
+                sharded._migrate('first', 'second', [(0, 0)])
+            ),
+            daemon = True
+        )
+        migration.start()
+        migration.join(30)
+        self.assertFalse(migration.is_alive())
+        return result[0]
+
+    def _sharded_pair(self, export_limit=8192):
+        shards = {'first': _LocalShard(), 'second': _LocalShard()}
+        sharded = ShardedPersister(vnodes=16, export_limit=export_limit,
+                                   batch=2, pause=0)
+        sharded.add_shard('first', shards['first'])
+        self._populate(sharded)
+        shards['second'].publish(self.author.second_party.packed)
+        sharded._shards['second'] = shards['second']
+        return sharded, shards
+
+    def test_migrate_past_stuck(self):
+        ''' More stuck objects than fit in one export page mustn't stop
+        the rest from moving.
+        '''
+        sharded, shards = self._sharded_pair(export_limit=4)
+        bindings = sorted(self.objects[0::2], key=lambda obj: bytes(obj.ghid))
+        # Bindings are exported first, in ghid order, so refusing the
+        # first half of them fills the first two pages with stuck
+        # objects. Their containers stay pinned on the old shard.
+        stuck = bindings[:8]
+        pinned = {obj.ghid for obj in stuck}
+        pinned.update(obj.target for obj in stuck)
+        for binding in stuck:
+            shards['second'].refuse.add(bytes(binding.packed))
+
+        self.assertEqual(self._migrate_all(sharded),
+                         len(self.objects) - len(pinned))
+        for obj in self.objects:
+            self.assertEqual(shards['first'].holds(obj.ghid),
+                             obj.ghid in pinned)
+            self.assertEqual(shards['second'].holds(obj.ghid),
+                             obj.ghid not in pinned)
+
+        shards['second'].refuse.clear()
+        self.assertEqual(self._migrate_all(sharded), len(pinned))
+        for obj in self.objects:
+            self.assertFalse(shards['first'].holds(obj.ghid))
+            self.assertTrue(shards['second'].holds(obj.ghid))
+
+    def test_migrate_retained_target(self):
+        ''' Evicting a target that retained frames still hold doesn't
+        remove it, which mustn't make the migration loop forever.
+        '''
+        sharded, shards = self._sharded_pair()
+        librarian = shards['first'].persister.librarian
+        librarian.retain(keep_frames=2)
+        old, new = self.objects[1], self.objects[3]
+        frame1 = self.author.make_bind_dynamic(old.ghid)
+        frame2 = self.author.make_bind_dynamic(
+            target = new.ghid,
+            ghid_dynamic = frame1.ghid_dynamic,
+            history = [frame1.ghid]
+        )
+        sharded.publish(frame1.packed)
+        sharded.publish(frame2.packed)
+        # Without its static binding, the retained frame is all that
+        # holds the old target.
+        sharded.publish(self.author.make_debind(self.objects[0].ghid).packed)
+        self.assertIn(old.ghid, librarian._held)
+
+        # While the binding can't move, neither can its retained history.
+        shards['second'].refuse.add(bytes(frame2.packed))
+        self._migrate_all(sharded)
+        self.assertTrue(shards['first'].holds(frame2.ghid))
+        self.assertTrue(shards['first'].holds(old.ghid))
+
+        shards['second'].refuse.clear()
+        self._migrate_all(sharded)
+        self.assertFalse(shards['first'].holds(frame2.ghid))
+        self.assertFalse(shards['first'].holds(old.ghid))
+        self.assertEqual(
+            shards['second'].persister.librarian.summarize(
+                frame1.ghid_dynamic
+            ).frame_ghid,
+            frame2.ghid
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+'''
+Multi-core verification of incoming Golix objects, with a cache of
+objects that have already been verified.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import threading
+import logging
+
+from golix import ThirdParty
+from golix import SecondParty
+
+from golix._getlow import GIDC
+
+from sharding import load_packed
+
+
+logger = logging.getLogger(__name__)
+
+
+# Objects that the doorman never verifies, so there's nothing to offload.
+_UNSIGNED = {b'GIDC', b'GARQ'}
+
+
+def cache_key(obj):
+    ''' Verified-cache key for a parsed object. Unpacking already checks
+    the ghid against the object's content, so (ghid, signature) can only
+    match an object whose signature we've actually checked.
+    '''
+    return bytes(obj.ghid) + bytes(obj.signature)
+
+
+def _signer(magic, obj):
+    if magic == b'GEOC':
+        return obj.author
+    elif magic == b'GDXX':
+        return obj.debinder
+    else:
+        return obj.binder
+
+
+class VerifiedCache:
+    ''' Bounded LRU set of cache_key()s for objects whose signatures have
+    already been verified. Threadsafe.
+    '''
+    def __init__(self, max_entries=65536):
+        self.max_entries = int(max_entries)
+        self._keys = collections.OrderedDict()
+        self._opslock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def check(self, key):
+        ''' Returns True (and counts a hit) if key has been verified.
+        '''
+        with self._opslock:
+            try:
+                self._keys.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        with self._opslock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+
+    def stats(self):
+        ''' Returns a dict of the cache counters.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self),
+            'max_entries': self.max_entries,
+        }
+
+    def __repr__(self):
+        return (
+            '<' + type(self).__name__ + ' ' +
+            ' '.join(k + '=' + str(v) for k, v in self.stats().items()) +
+            '>'
+        )
+
+
+def trust(cache, packed):
+    ''' Records packed as verified without checking its signature, for
+    objects that a trusted peer (eg. a sibling --workers process) has
+    already verified. Returns False if packed doesn't parse.
+    '''
+    try:
+        magic, obj = load_packed(packed)
+    except Exception:
+        return False
+
+    if magic not in _UNSIGNED:
+        cache.add(cache_key(obj))
+    return True
+
+
+class CachingVerifier:
+    ''' Stands in for the doorman's golix.ThirdParty, skipping the
+    signature check for anything already in the VerifiedCache, and
+    adding everything that passes it.
+    '''
+    def __init__(self, cache, golix=None):
+        self.cache = cache
+        if golix is None:
+            golix = ThirdParty()
+        self._golix = golix
+
+    def verify_object(self, second_party, obj):
+        key = cache_key(obj)
+        if self.cache.check(key):
+            return True
+
+        # Raises SecurityError on failure, which the doorman converts.
+        result = self._golix.verify_object(
+            second_party = second_party,
+            obj = obj
+        )
+        self.cache.add(key)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._golix, name)
+
+
+def install_cache(persister, cache):
+    ''' Points the persister's doorman at the cache. Returns the
+    CachingVerifier.
+    '''
+    doorman = persister.doorman
+    verifier = CachingVerifier(cache, doorman._golix)
+    doorman._golix = verifier
+    return verifier
+
+
+# Per worker process: author identities don't change, and there are far
+# fewer of them than objects.
+_third_party = None
+
+
+@functools.lru_cache(maxsize=1024)
+def _second_party(gidc_packed):
+    return SecondParty.from_identity(GIDC.unpack(gidc_packed))
+
+
+def _verify_packed(packed, gidc_packed):
+    ''' Runs in a pool worker. Raises if the object doesn't verify.
+    '''
+    global _third_party
+    if _third_party is None:
+        _third_party = ThirdParty()
+
+    magic, obj = load_packed(packed)
+    _third_party.verify_object(
+        second_party = _second_party(gidc_packed),
+        obj = obj
+    )
+
+
+class VerificationPool:
+    ''' Verifies objects in a pool of worker processes ahead of the
+    (single-threaded) ingest, recording them in the VerifiedCache so that
+    the doorman skips the crypto when it gets to them.
+
+    Anything that can't be checked here (unknown author, malformed, bad
+    signature) is just left for the doorman, which raises the usual
+    error for it. The pool forks, so create it before starting threads.
+    '''
+    def __init__(self, persister, cache, workers=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        self._librarian = persister.librarian
+        self.cache = cache
+        self.workers = workers
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers = workers,
+            mp_context = multiprocessing.get_context('fork')
+        )
+
+        # Fork everything now, while we're still single-threaded.
+        for future in [self._pool.submit(os.getpid) for __ in range(workers)]:
+            future.result()
+
+        self.offloaded = 0
+        self.rejected = 0
+
+    async def preverify(self, loop, packed):
+        ''' Verifies packed in the pool, unless it's already cached.
+        Never raises.
+        '''
+        try:
+            magic, obj = load_packed(packed)
+        except Exception:
+            return
+        if magic in _UNSIGNED:
+            return
+
+        key = cache_key(obj)
+        if key in self.cache:
+            return
+
+        try:
+            gidc_packed = self._librarian.retrieve(_signer(magic, obj))
+        except Exception:
+            return
+
+        try:
+            await loop.run_in_executor(
+                self._pool,
+                _verify_packed,
+                bytes(packed),
+                bytes(gidc_packed)
+            )
+        except Exception as exc:
+            self.rejected += 1
+            logger.debug('Pool verification failed: ' + repr(exc))
+        else:
+            self.offloaded += 1
+            self.cache.add(key)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,180 @@
+'''
+Multi-process support for the demo persistence server: several worker
+processes share one listening port, and forward every publish they
+accept to each other so that subscribers on any worker get updated.
+
+LICENSING
+-------------------------------------------------
+
+hypergolix: A python Golix client.
+    Copyright (C) 2016 Muterra, Inc.
+
+    Contributors
+    ------------
+    Nick Badger
+        badg@muterra.io | badg@nickbadger.com | nickbadger.com
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the
+    Free Software Foundation, Inc.,
+    51 Franklin Street,
+    Fifth Floor,
+    Boston, MA  02110-1301 USA
+
+------------------------------------------------------
+
+'''
+
+import multiprocessing
+import threading
+import traceback
+import logging
+
+import websockets
+
+from hypergolix.comms import WSBasicServer
+
+from bridge import DemoBridgeServer
+from verification import trust
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReusePortServer(WSBasicServer):
+    ''' WSBasicServer that binds with SO_REUSEPORT, so that several
+    processes can listen on the same host/port and let the kernel
+    balance incoming connections between them. Linux only.
+    '''
+    async def loop_run(self):
+        self._server = await websockets.serve(
+            self._handle_connection,
+            self._ws_host,
+            self._ws_port,
+            reuse_port = True
+        )
+        await self._server.wait_closed()
+
+
+class PeerBus:
+    ''' Forwards packed objects between sibling worker processes. One
+    inbox queue per worker; broadcasting puts onto everyone else's.
+
+    Every worker is a full replica: the enforcer and bookie need the
+    whole object graph (previous frames, bindings, debindings) in one
+    persister to validate a publish or GC anything, and the persisters
+    can't be shared between processes. So memory and ingest are paid
+    once per worker. What scales with workers is websocket framing,
+    request dispatch, notification fan-out and, since siblings only
+    forward objects they've accepted, signature verification: forwarded
+    objects go into the receiving worker's VerifiedCache first, so its
+    doorman doesn't check them again.
+
+    Must be created in the parent process before forking the workers.
+    '''
+    def __init__(self, workers, ctx=None):
+        if ctx is None:
+            ctx = multiprocessing.get_context('fork')
+
+        self._inboxes = [ctx.Queue() for __ in range(workers)]
+        self.worker_id = None
+        self._persister = None
+        self._verified = None
+        self._drainer = None
+
+    def attach(self, worker_id, persister, verified=None):
+        ''' Called from within the worker process. Starts ingesting
+        anything the other workers send us into persister. If verified
+        (the persister's VerifiedCache) is passed, forwarded objects
+        skip signature verification.
+        '''
+        self.worker_id = worker_id
+        self._persister = persister
+        self._verified = verified
+        self._drainer = threading.Thread(
+            target = self._drain,
+            daemon = True,
+            name = 'peerbus-' + str(worker_id)
+        )
+        self._drainer.start()
+
+    def broadcast(self, packed):
+        ''' Sends packed to every worker but ourselves.
+        '''
+        for worker_id, inbox in enumerate(self._inboxes):
+            if worker_id != self.worker_id:
+                inbox.put(packed)
+
+    def _drain(self):
+        inbox = self._inboxes[self.worker_id]
+        while True:
+            packed = inbox.get()
+            if packed is None:
+                break
+
+            # Going straight to the persister (instead of through the bridge)
+            # means that we don't re-broadcast it, but local subscribers are
+            # still notified by the mail run.
+            try:
+                if self._verified is not None:
+                    trust(self._verified, packed)
+                self._persister.publish(packed)
+            except Exception:
+                logger.error(
+                    'Worker ' + str(self.worker_id) + ' failed to ingest '
+                    'forwarded object w/ traceback:\n' +
+                    ''.join(traceback.format_exc())
+                )
+
+    def close(self):
+        ''' Called from the parent process to stop every drainer.
+        '''
+        for inbox in self._inboxes:
+            inbox.put(None)
+
+
+class PeeredBridgeServer(DemoBridgeServer):
+    ''' Bridge server that forwards every accepted publish to the sibling
+    workers on the PeerBus.
+    '''
+    def __init__(self, bus, *args, **kwargs):
+        self._bus = bus
+        super().__init__(*args, **kwargs)
+
+    async def publish_wrapper(self, session, request_body):
+        ''' Only forwards publishes that we ourselves accepted.
+        '''
+        response = await super().publish_wrapper(session, request_body)
+        self._bus.broadcast(request_body)
+        return response
+
+
+def spawn_workers(workers, target, ctx=None):
+    ''' Forks workers processes, each running target(worker_id, bus).
+    Returns (bus, processes).
+    '''
+    if ctx is None:
+        ctx = multiprocessing.get_context('fork')
+
+    bus = PeerBus(workers, ctx)
+    processes = []
+    for worker_id in range(workers):
+        process = ctx.Process(
+            target = target,
+            args = (worker_id, bus),
+            name = 'hgx-worker-' + str(worker_id)
+        )
+        process.start()
+        processes.append(process)
+
+    return bus, processes
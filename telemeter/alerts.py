@@ -0,0 +1,214 @@
+''' On-device threshold alerts for the Telemeter.
+
+Rules are evaluated against every sample, on the sampler thread, and
+changes (a rule starting or stopping firing) are published right away
+on their own alert object, instead of waiting for the next status push.
+
+A rule is "METRIC OP THRESHOLD[:COUNT]", for example:
+
+    disk>95             root filesystem over 95% used
+    cpu_max>90:3        any cpu over 90%, for 3 samples in a row
+    load.1m>=8          any extra metric (see collectors.py) by name
+
+METRIC is one of tsstore.METRICS, or the name of an extra. OP is one of
+>, >=, < or <=. A rule fires once it has matched COUNT (default 1)
+samples in a row, and clears on the first sample it doesn't match.
+Samples without the metric (eg. extras from a collector that didn't run)
+are skipped.
+'''
+
+import logging
+import operator
+import re
+import threading
+
+from tsstore import METRICS
+from tsstore import sample_values
+
+
+logger = logging.getLogger(__name__)
+
+
+_OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+_RULE = re.compile(
+    r'^\s*([^<>=\s]+)\s*(>=|<=|>|<)\s*([^:\s]+)\s*(?::\s*(\d+))?\s*$'
+)
+
+
+class Rule:
+    ''' One threshold rule, and its streak of matching samples.
+    '''
+    def __init__(self, metric, op, threshold, count=1):
+        if count < 1:
+            raise ValueError('Alert rule counts must be at least 1.')
+        self.metric = metric
+        self.op = op
+        self.threshold = threshold
+        self.count = count
+        self.streak = 0
+        self.firing = False
+
+    @property
+    def spec(self):
+        spec = self.metric + self.op + '{:g}'.format(self.threshold)
+        if self.count != 1:
+            spec += ':' + str(self.count)
+        return spec
+
+    def value(self, sample, core):
+        ''' The metric's value in sample, or None if it doesn't have it.
+        core is sample_values(sample).
+        '''
+        if self.metric in METRICS:
+            return core[METRICS.index(self.metric)]
+        return sample.extras.get(self.metric)
+
+    def __repr__(self):
+        return '<' + type(self).__name__ + ' ' + self.spec + '>'
+
+
+def parse_rules(spec):
+    ''' Parses comma-separated rules (see the module docstring).
+    '''
+    rules = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+
+        match = _RULE.match(item)
+        if match is None:
+            raise ValueError('Invalid alert rule: ' + repr(item))
+
+        metric, op, threshold, count = match.groups()
+        rules.append(Rule(
+            metric,
+            op,
+            float(threshold),
+            int(count) if count is not None else 1
+        ))
+
+    return rules
+
+
+class AlertEngine:
+    ''' Evaluates rules against samples. Not threadsafe; run from the
+    sampler thread.
+    '''
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def evaluate(self, sample):
+        ''' Updates every rule with sample, and returns a list of events,
+        one per rule that started or stopped firing, as dicts of rule
+        (its spec), state ('firing' or 'cleared'), value and timestamp.
+        '''
+        core = sample_values(sample)
+        events = []
+        for rule in self.rules:
+            value = rule.value(sample, core)
+            if value is None:
+                continue
+
+            if _OPERATORS[rule.op](value, rule.threshold):
+                rule.streak += 1
+                if rule.firing or rule.streak < rule.count:
+                    continue
+                rule.firing = True
+                state = 'firing'
+
+            else:
+                rule.streak = 0
+                if not rule.firing:
+                    continue
+                rule.firing = False
+                state = 'cleared'
+
+            events.append({
+                'rule': rule.spec,
+                'state': state,
+                'value': value,
+                'timestamp': sample.timestamp,
+            })
+
+        return events
+
+
+class AlertPublisher(threading.Thread):
+    ''' Pushes alert events on obj (a JsonObj) from its own thread, so
+    neither a slow alert push nor a slow status push holds up the other
+    (or the sampler). Events that arrive while a push is in flight are
+    coalesced into the next one.
+
+    The state pushed is a dict of:
+        seq         count of events so far
+        active      {rule: event that started it firing}
+        events      the last history events, oldest first, each with
+                    its seq, so readers can tell which they've seen
+    '''
+    def __init__(self, obj, history=32, retry=1):
+        super().__init__(daemon=True, name='telemeter-alerts')
+        self.obj = obj
+        self.history = history
+        self.retry = retry
+        self.seq = 0
+        self.active = {}
+        self.events = []
+        self._dirty = False
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def publish(self, events):
+        ''' Queues events (from AlertEngine.evaluate) to be pushed.
+        '''
+        with self._condition:
+            for event in events:
+                self.seq += 1
+                event = dict(event, seq=self.seq)
+                if event['state'] == 'firing':
+                    self.active[event['rule']] = event
+                else:
+                    self.active.pop(event['rule'], None)
+                self.events.append(event)
+            del self.events[:-self.history]
+            self._dirty = True
+            self._condition.notify()
+
+    def state(self):
+        with self._condition:
+            return {
+                'seq': self.seq,
+                'active': dict(self.active),
+                'events': list(self.events),
+            }
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._dirty and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                self._dirty = False
+
+            try:
+                self.obj.state = self.state()
+                self.obj.push_threadsafe()
+
+            except Exception:
+                logger.warning('Alert push failed; retrying.', exc_info=True)
+                with self._condition:
+                    self._dirty = True
+                    self._condition.wait(self.retry)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
@@ -0,0 +1,316 @@
+''' Pluggable metric collectors for the Telemeter.
+
+A collector is anything with a name, an interval (seconds) and a
+collect() method returning a flat {metric name: number} dict. The
+Telemeter's sampler runs each one when it's due, and adds whatever they
+return to that sample's extras.
+
+Collectors are timed (in CPU seconds, on the sampler thread), and the
+CollectorSet keeps their combined cost under a CPU budget by backing
+off (doubling the interval of) whichever is most expensive, and
+recovering them once there's room again. Collectors that raise are
+backed off the same way.
+'''
+
+import abc
+import importlib
+import logging
+import os
+import time
+
+import psutil
+
+
+logger = logging.getLogger(__name__)
+
+
+class Collector(abc.ABC):
+    ''' Base class for collectors. Subclasses set name and implement
+    collect().
+    '''
+    name = None
+    interval = 5
+
+    @abc.abstractmethod
+    def collect(self):
+        ''' Returns a flat {metric name: number} dict.
+        '''
+
+
+class NetCollector(Collector):
+    ''' Network counters, summed over interfaces.
+    '''
+    name = 'net'
+
+    def collect(self):
+        counters = psutil.net_io_counters()
+        return {
+            'net.bytes_sent': counters.bytes_sent,
+            'net.bytes_recv': counters.bytes_recv,
+            'net.packets_sent': counters.packets_sent,
+            'net.packets_recv': counters.packets_recv,
+            'net.errin': counters.errin,
+            'net.errout': counters.errout,
+            'net.dropin': counters.dropin,
+            'net.dropout': counters.dropout,
+        }
+
+
+class DiskIOCollector(Collector):
+    ''' Disk I/O counters, summed over disks.
+    '''
+    name = 'diskio'
+
+    def collect(self):
+        counters = psutil.disk_io_counters()
+        # Some platforms (and containers) have no disks to count
+        if counters is None:
+            return {}
+        return {
+            'diskio.read_count': counters.read_count,
+            'diskio.write_count': counters.write_count,
+            'diskio.read_bytes': counters.read_bytes,
+            'diskio.write_bytes': counters.write_bytes,
+        }
+
+
+class LoadCollector(Collector):
+    ''' 1, 5 and 15 minute load averages.
+    '''
+    name = 'load'
+
+    def collect(self):
+        load1, load5, load15 = os.getloadavg()
+        return {
+            'load.1m': load1,
+            'load.5m': load5,
+            'load.15m': load15,
+        }
+
+
+class TopProcessesCollector(Collector):
+    ''' CPU percent and resident memory of the top n processes by CPU,
+    as proc.<name>.<pid>.cpu and .rss. Scanning every process is the
+    expensive one on busy hosts, hence the longer default interval.
+    '''
+    name = 'top'
+    interval = 30
+
+    def __init__(self, n=5):
+        self.n = n
+
+    def collect(self):
+        processes = []
+        # cpu_percent is the delta since the last scan of that process,
+        # which psutil caches per Process object; process_iter reuses them.
+        for process in psutil.process_iter(['name', 'cpu_percent',
+                                            'memory_info']):
+            info = process.info
+            if info['cpu_percent'] is None or info['memory_info'] is None:
+                continue
+            processes.append((info['cpu_percent'], process.pid, info))
+
+        processes.sort(key=lambda entry: entry[0], reverse=True)
+        metrics = {}
+        for cpu, pid, info in processes[:self.n]:
+            prefix = 'proc.' + str(info['name']) + '.' + str(pid)
+            metrics[prefix + '.cpu'] = cpu
+            metrics[prefix + '.rss'] = info['memory_info'].rss
+        return metrics
+
+
+class FilesystemsCollector(Collector):
+    ''' Use of every mounted (physical) filesystem, as
+    fs.<mountpoint>.percent, .free and .total.
+    '''
+    name = 'fs'
+    interval = 60
+
+    def collect(self):
+        metrics = {}
+        for partition in psutil.disk_partitions(all=False):
+            try:
+                usage = psutil.disk_usage(partition.mountpoint)
+            except OSError:
+                # Eg. empty removable drives
+                continue
+            prefix = 'fs.' + partition.mountpoint
+            metrics[prefix + '.percent'] = usage.percent
+            metrics[prefix + '.free'] = usage.free
+            metrics[prefix + '.total'] = usage.total
+        return metrics
+
+
+BUILTIN_COLLECTORS = {
+    cls.name: cls for cls in (
+        NetCollector,
+        DiskIOCollector,
+        LoadCollector,
+        TopProcessesCollector,
+        FilesystemsCollector,
+    )
+}
+
+
+def load_collectors(spec):
+    ''' Parses "name[=interval],..." into collectors. Names are either
+    built-in (see BUILTIN_COLLECTORS) or "module:Class" plugins, which
+    must be importable and constructible without arguments.
+    '''
+    collectors = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        if '=' in item:
+            name, interval = item.rsplit('=', 1)
+            interval = float(interval)
+        else:
+            name = item
+            interval = None
+
+        if name in BUILTIN_COLLECTORS:
+            collector = BUILTIN_COLLECTORS[name]()
+        elif ':' in name:
+            module, cls = name.split(':', 1)
+            collector = getattr(importlib.import_module(module), cls)()
+        else:
+            raise ValueError('Unknown collector: ' + repr(name))
+
+        # Subclasses of Collector missing collect() already failed above
+        if not callable(getattr(collector, 'collect', None)):
+            raise TypeError('Collector has no collect(): ' + repr(name))
+
+        if interval is not None:
+            collector.interval = interval
+        collectors.append(collector)
+
+    return collectors
+
+
+class _Scheduled:
+    ''' Scheduling and cost-accounting state for one collector.
+    '''
+    def __init__(self, collector, max_backoff):
+        self.collector = collector
+        self.base_interval = float(collector.interval)
+        self.interval = self.base_interval
+        self.max_interval = self.base_interval * max_backoff
+        self.due = 0
+        # Moving average of CPU seconds per run
+        self.cost = 0.
+        self.runs = 0
+        self.errors = 0
+        self.failing = False
+
+    @property
+    def rate(self):
+        ''' Fraction of a CPU this collector uses at its current interval.
+        '''
+        return self.cost / self.interval
+
+    def back_off(self):
+        self.interval = min(self.interval * 2, self.max_interval)
+
+    def recover(self):
+        self.interval = max(self.interval / 2, self.base_interval)
+
+
+class CollectorSet:
+    ''' Runs collectors when they're due, and keeps their total cost
+    under cpu_budget (a fraction of one CPU). Not threadsafe; run from
+    the sampler thread.
+    '''
+    def __init__(self, collectors, cpu_budget=.01, max_backoff=64,
+                 smoothing=.2):
+        self.cpu_budget = cpu_budget
+        self.smoothing = smoothing
+        self._scheduled = [
+            _Scheduled(collector, max_backoff) for collector in collectors
+        ]
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    @property
+    def usage(self):
+        ''' Estimated fraction of a CPU the collectors use.
+        '''
+        return sum(scheduled.rate for scheduled in self._scheduled)
+
+    def run_due(self, now=None):
+        ''' Runs every collector that's due and returns their combined
+        metrics, plus telemetry.<name>.cpu_ms and .interval for each that
+        ran, and telemetry.budget_used.
+        '''
+        if now is None:
+            now = time.monotonic()
+
+        metrics = {}
+        for scheduled in self._scheduled:
+            if now < scheduled.due:
+                continue
+
+            name = scheduled.collector.name
+            start = time.thread_time()
+            try:
+                metrics.update(scheduled.collector.collect())
+                failed = False
+            except Exception:
+                logger.exception('Collector ' + name + ' failed.')
+                scheduled.errors += 1
+                failed = True
+            cost = time.thread_time() - start
+
+            if scheduled.runs:
+                scheduled.cost += self.smoothing * (cost - scheduled.cost)
+            else:
+                scheduled.cost = cost
+            scheduled.runs += 1
+
+            scheduled.failing = failed
+            if failed:
+                scheduled.back_off()
+
+            metrics['telemetry.' + name + '.cpu_ms'] = cost * 1000
+            metrics['telemetry.' + name + '.interval'] = scheduled.interval
+            scheduled.due = now + scheduled.interval
+
+        if metrics:
+            self._rebalance()
+            metrics['telemetry.budget_used'] = self.usage / self.cpu_budget
+
+        return metrics
+
+    def _rebalance(self):
+        ''' Backs off the most expensive collector while we're over
+        budget, and recovers the cheapest backed-off one while there's
+        comfortably enough room for it.
+        '''
+        usage = self.usage
+        if usage > self.cpu_budget:
+            candidates = [
+                scheduled for scheduled in self._scheduled
+                if scheduled.interval < scheduled.max_interval
+            ]
+            if candidates:
+                worst = max(candidates, key=lambda scheduled: scheduled.rate)
+                worst.back_off()
+                logger.info(
+                    'Telemetry over budget; collector ' +
+                    worst.collector.name + ' now every ' +
+                    str(worst.interval) + 's.'
+                )
+
+        else:
+            candidates = [
+                scheduled for scheduled in self._scheduled
+                if scheduled.interval > scheduled.base_interval and
+                not scheduled.failing
+            ]
+            if candidates:
+                best = min(candidates, key=lambda scheduled: scheduled.rate)
+                # Halving the interval doubles its rate
+                if usage + best.rate < self.cpu_budget / 2:
+                    best.recover()
@@ -0,0 +1,190 @@
+''' Bounded on-disk spool for Telemeter samples that couldn't be pushed.
+
+The spool is a ring buffer of length-prefixed records in a
+memory-mapped file:
+
+    magic (4 bytes), version, capacity, head, used, count
+    capacity bytes of ring data
+
+Records are a 4-byte big-endian length and the record itself, and may
+wrap around the end of the ring. Appending to a full spool drops the
+oldest records to make room, so it never grows past capacity.
+
+Writes go through the mmap, so the spool survives the Telemeter being
+killed (though not necessarily the host losing power) and is picked up
+again on restart.
+'''
+
+import mmap
+import os
+import struct
+import threading
+
+
+_MAGIC = b'TSPL'
+_VERSION = 1
+_HEADER = struct.Struct('>4sIQQQQ')
+_LENGTH = struct.Struct('>I')
+
+
+class Spool:
+    ''' Ring-file spool of records (bytes). Threadsafe.
+    '''
+    def __init__(self, path, capacity=16 * 1048576):
+        self.path = path
+        self._lock = threading.Lock()
+        self.dropped = 0
+        # Sequence number of the oldest record, counting every record ever
+        # removed from the head. peek() markers are in the same terms.
+        self._first = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            existing = None
+            if size >= _HEADER.size:
+                header = os.pread(fd, _HEADER.size, 0)
+                magic, version, *existing = _HEADER.unpack(header)
+                if (magic != _MAGIC or version != _VERSION or
+                    size != _HEADER.size + existing[0]):
+                    existing = None
+
+            # Keep whatever capacity an existing spool was made with.
+            if existing is not None:
+                capacity, head, used, count = existing
+            else:
+                head = used = count = 0
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, _HEADER.size + capacity)
+
+            self._mmap = mmap.mmap(fd, _HEADER.size + capacity)
+        finally:
+            os.close(fd)
+
+        self.capacity = capacity
+        self._head = head
+        self._used = used
+        self._count = count
+        self._write_header()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def used(self):
+        return self._used
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, self.capacity,
+                          self._head, self._used, self._count)
+
+    def _write(self, offset, data):
+        offset %= self.capacity
+        first = min(len(data), self.capacity - offset)
+        start = _HEADER.size + offset
+        self._mmap[start:start + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            self._mmap[_HEADER.size:_HEADER.size + rest] = data[first:]
+
+    def _read(self, offset, length):
+        offset %= self.capacity
+        first = min(length, self.capacity - offset)
+        start = _HEADER.size + offset
+        data = self._mmap[start:start + first]
+        if first < length:
+            data += self._mmap[_HEADER.size:_HEADER.size + length - first]
+        return data
+
+    def _record_size(self, offset):
+        length, = _LENGTH.unpack(self._read(offset, _LENGTH.size))
+        return _LENGTH.size + length
+
+    def _drop_oldest(self):
+        size = self._record_size(self._head)
+        self._head = (self._head + size) % self.capacity
+        self._used -= size
+        self._count -= 1
+        self._first += 1
+
+    def extend(self, records):
+        ''' Appends records, dropping the oldest ones if there isn't
+        room. Records too big for the whole spool are dropped outright.
+        '''
+        with self._lock:
+            for record in records:
+                size = _LENGTH.size + len(record)
+                if size > self.capacity:
+                    self.dropped += 1
+                    continue
+
+                while self.capacity - self._used < size:
+                    self._drop_oldest()
+                    self.dropped += 1
+
+                self._write(
+                    self._head + self._used,
+                    _LENGTH.pack(len(record)) + record
+                )
+                self._used += size
+                self._count += 1
+
+            self._write_header()
+
+    def prepend(self, records):
+        ''' Puts records (oldest first) back ahead of everything spooled,
+        for ones that were taken out to push and have to be retried. They
+        only use free space: if it runs out, the oldest of them are
+        dropped instead. Not for use while a peek() is awaiting consume().
+        '''
+        with self._lock:
+            records = list(records)
+            while records:
+                size = _LENGTH.size + len(records[-1])
+                if self.capacity - self._used < size:
+                    break
+
+                self._head = (self._head - size) % self.capacity
+                self._write(self._head, _LENGTH.pack(size - _LENGTH.size) +
+                            records.pop())
+                self._used += size
+                self._count += 1
+                self._first -= 1
+
+            self.dropped += len(records)
+            self._write_header()
+
+    def peek(self, max_bytes):
+        ''' Returns (records, marker): the oldest records, up to
+        max_bytes of them (but at least one, if there are any), without
+        removing them, and a marker to consume() them with.
+        '''
+        with self._lock:
+            records = []
+            offset = self._head
+            total = 0
+            for __ in range(self._count):
+                size = self._record_size(offset)
+                if records and total + size > max_bytes:
+                    break
+                records.append(self._read(offset + _LENGTH.size,
+                                          size - _LENGTH.size))
+                offset += size
+                total += size
+            return records, self._first + len(records)
+
+    def consume(self, marker):
+        ''' Removes the records returned by the peek() that returned
+        marker, once they've been pushed. Any of them that extend() has
+        since dropped to make room are already gone, so only what's left
+        of them is removed, never anything newer.
+        '''
+        with self._lock:
+            for __ in range(min(marker - self._first, self._count)):
+                self._drop_oldest()
+            self._write_header()
+
+    def close(self):
+        with self._lock:
+            self._mmap.flush()
+            self._mmap.close()
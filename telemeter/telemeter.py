@@ -1,11 +1,28 @@
 import argparse
+import concurrent.futures
+import sys
 import time
 import datetime
+import logging
+import os
+import random
+import struct
+import threading
 import psutil
 import collections
 import daemoniker
 import hypergolix as hgx
 
+from alerts import AlertEngine
+from alerts import AlertPublisher
+from alerts import parse_rules
+from collectors import CollectorSet
+from collectors import load_collectors
+from tsstore import TimeSeriesStore
+from spool import Spool
+
+
+logger = logging.getLogger(__name__)
 
 # These are app-specific (here, totally random) API schema identifiers
 STATUS_API = hgx.utils.ApiID(
@@ -32,6 +49,188 @@ INTERVAL_API = hgx.utils.ApiID(
     b'\x0e\n\x19\x0b\x14\r\n\x04\x0c\x06\x03\x13\x01' +
     b'\x01\x12\x05'
 )
+BINARY_STATUS_API = hgx.utils.ApiID(
+    b'\x06\x00\x10\x17\x01\x05\x07\x00\x01\x19\x15\x04' +
+    b'\x16\x0b\x07\x03\n\x0e\x16\x0b\x08\x0c\x08\x0b' +
+    b'\x07\x06\x0b\x19\n\x07\t\x17\x10\r\x07\x12\x0e\r' +
+    b'\x0f\x02\x0e\x12\x19\x0b\x0e\x12\n\x16\x14\x0e\x0c' +
+    b'\x18\x19\x02\x0f\x00\x06\x04\x11\x05\x13\x19\x16\x17'
+)
+ALERT_API = hgx.utils.ApiID(
+    b'\x0c\x18\x00\x06\t\x14\x0f\x01\x18\x08\x01\t' +
+    b'\x12\r\x03\x12\x03\x12\x15\x17\x06\x10\x19' +
+    b'\x13\n\x05\x11\x0b\x10\x0f\x10\x03\x14\x15' +
+    b'\x03\x13\x12\x0b\r\x0b\x06\x15\x05\x13\x0e' +
+    b'\x02\x02\x0c\x12\x02\x10\x14\x04\x17\x01\x11' +
+    b'\x05\x02\x12\x07\x18\r\x11\x0e'
+)
+
+# Binary status records (BINARY_STATUS_API) are:
+#   version, timestamp (integer milliseconds since the epoch), cpu count
+#   one centi-percent per cpu
+#   mem available, total, centi-percent used
+#   disk free, total, centi-percent used
+#   sample deadlines missed just before this one (version 2 and up)
+#   extra metric count, then per metric: utf-8 name length, name, double
+#   value (version 3 and up; see collectors.py)
+# all big-endian. Readers must reject versions they don't know.
+STATUS_VERSION = 3
+_STATUS_HEADER = struct.Struct('>BqH')
+_STATUS_CPU = struct.Struct('>H')
+_STATUS_TAIL = struct.Struct('>QQHQQH')
+_STATUS_MISSED = struct.Struct('>I')
+_STATUS_EXTRAS = struct.Struct('>H')
+_STATUS_NAME = struct.Struct('>B')
+_STATUS_VALUE = struct.Struct('>d')
+
+
+MemSample = collections.namedtuple(
+    'MemSample',
+    ['available', 'total', 'percent']
+)
+DiskSample = collections.namedtuple(
+    'DiskSample',
+    ['free', 'total', 'percent']
+)
+StatusSample = collections.namedtuple(
+    'StatusSample',
+    ['timestamp', 'cpus', 'mem', 'disk', 'missed', 'extras']
+)
+
+
+def take_sample(missed=0, extras=None):
+    ''' Samples cpu, memory and disk use. Timestamp is integer ms since
+    the epoch. Never blocks: cpu use is the delta of psutil's cached
+    cpu times since the previous call (so the first call after startup
+    is meaningless; prime it with psutil.cpu_percent(percpu=True)).
+    
+    extras are any other {name: number} metrics, from collectors.
+    '''
+    timestamp = int(time.time() * 1000)
+    cpus = psutil.cpu_percent(interval=None, percpu=True)
+    mem = psutil.virtual_memory()
+    disk = psutil.disk_usage('/')
+    return StatusSample(
+        timestamp = timestamp,
+        cpus = cpus,
+        mem = MemSample(mem.available, mem.total, mem.percent),
+        disk = DiskSample(disk.free, disk.total, disk.percent),
+        missed = missed,
+        extras = extras or {}
+    )
+
+
+def _centi(percent):
+    return min(max(int(round(percent * 100)), 0), 0xFFFF)
+
+
+def pack_status(sample):
+    ''' Packs a StatusSample into a binary status record.
+    '''
+    return b''.join((
+        _STATUS_HEADER.pack(STATUS_VERSION, sample.timestamp,
+                            len(sample.cpus)),
+        b''.join(_STATUS_CPU.pack(_centi(cpu)) for cpu in sample.cpus),
+        _STATUS_TAIL.pack(
+            sample.mem.available,
+            sample.mem.total,
+            _centi(sample.mem.percent),
+            sample.disk.free,
+            sample.disk.total,
+            _centi(sample.disk.percent)
+        ),
+        _STATUS_MISSED.pack(min(sample.missed, 0xFFFFFFFF)),
+        _pack_extras(sample.extras)
+    ))
+
+
+def _pack_extras(extras):
+    parts = []
+    for name, value in extras.items():
+        # Names are truncated to fit the length byte
+        name = name.encode('utf-8')[:255]
+        parts.append(_STATUS_NAME.pack(len(name)) + name +
+                     _STATUS_VALUE.pack(value))
+        if len(parts) == 0xFFFF:
+            break
+    return _STATUS_EXTRAS.pack(len(parts)) + b''.join(parts)
+
+
+def _unpack_extras(data, offset):
+    extras = {}
+    count, = _STATUS_EXTRAS.unpack_from(data, offset)
+    offset += _STATUS_EXTRAS.size
+    for __ in range(count):
+        length, = _STATUS_NAME.unpack_from(data, offset)
+        offset += _STATUS_NAME.size
+        name = bytes(data[offset:offset + length]).decode('utf-8', 'replace')
+        offset += length
+        extras[name], = _STATUS_VALUE.unpack_from(data, offset)
+        offset += _STATUS_VALUE.size
+    return extras, offset
+
+
+def unpack_status(data, offset=0):
+    ''' Unpacks a binary status record at offset into a StatusSample.
+    Returns (sample, offset of the end of the record).
+    '''
+    version, timestamp, ncpu = _STATUS_HEADER.unpack_from(data, offset)
+    if not 1 <= version <= STATUS_VERSION:
+        raise ValueError('Unknown status version: ' + str(version))
+
+    offset += _STATUS_HEADER.size
+    cpus = [
+        _STATUS_CPU.unpack_from(data, offset + ii * _STATUS_CPU.size)[0] / 100
+        for ii in range(ncpu)
+    ]
+    offset += ncpu * _STATUS_CPU.size
+
+    (mem_available, mem_total, mem_percent,
+     disk_free, disk_total, disk_percent) = _STATUS_TAIL.unpack_from(
+        data,
+        offset
+    )
+    offset += _STATUS_TAIL.size
+
+    if version >= 2:
+        missed, = _STATUS_MISSED.unpack_from(data, offset)
+        offset += _STATUS_MISSED.size
+    else:
+        missed = 0
+
+    if version >= 3:
+        extras, offset = _unpack_extras(data, offset)
+    else:
+        extras = {}
+
+    sample = StatusSample(
+        timestamp = timestamp,
+        cpus = cpus,
+        mem = MemSample(mem_available, mem_total, mem_percent / 100),
+        disk = DiskSample(disk_free, disk_total, disk_percent / 100),
+        missed = missed,
+        extras = extras
+    )
+    return sample, offset
+
+
+def pack_statuses(samples):
+    ''' Packs a batch of StatusSamples. Records are self-delimiting, so a
+    batch is just their concatenation.
+    '''
+    return b''.join(pack_status(sample) for sample in samples)
+
+
+def unpack_statuses(data):
+    ''' Unpacks a batch of binary status records into a list of
+    StatusSamples, oldest first.
+    '''
+    samples = []
+    offset = 0
+    while offset < len(data):
+        sample, offset = unpack_status(data, offset)
+        samples.append(sample)
+    return samples
 
 
 def humanize_bibytes(n, prefixes=collections.OrderedDict((
@@ -74,30 +273,315 @@ def format_disk(disk_tup):
     return diskstr
 
 
+def format_status(sample):
+    ''' Formats a StatusSample as human-readable text.
+    '''
+    timestamp = datetime.datetime.fromtimestamp(sample.timestamp / 1000)
+    timestr = timestamp.strftime('%Y.%m.%d @ %H:%M:%S\n==========\n')
+    cpustr = format_cpu(sample.cpus)
+    memstr = format_mem(sample.mem)
+    diskstr = format_disk(sample.disk)
+    extrastr = format_extras(sample.extras)
+    if sample.missed:
+        missedstr = 'Missed ' + str(sample.missed) + ' sample(s) before this\n'
+    else:
+        missedstr = ''
+    return timestr + cpustr + memstr + diskstr + extrastr + missedstr + '\n'
+
+
+def format_extras(extras):
+    if not extras:
+        return ''
+    extrastr = 'EXTRA:\n----------\n'
+    for name in sorted(extras):
+        extrastr += '  {}: {:.6g}\n'.format(name, extras[name])
+    return extrastr
+
+
+def format_alert(event):
+    ''' Formats an alert event (see alerts.AlertPublisher).
+    '''
+    timestamp = datetime.datetime.fromtimestamp(event['timestamp'] / 1000)
+    return (
+        'ALERT ' + event['state'].upper() + ': ' + event['rule'] +
+        ' (' + '{:g}'.format(event['value']) + ') at ' +
+        timestamp.strftime('%Y.%m.%d @ %H:%M:%S')
+    )
+
+
+class LoopProfile:
+    ''' Rolling timings (seconds) of each phase of the Telemeter's loop,
+    over the last window of each. Threadsafe: the sampler and pusher
+    threads both record into it.
+    
+    The phases are running collectors, the psutil sample, evaluating
+    alert rules, formatting (or packing) the batch, assigning it to the
+    status object (a local state update only), and pushing it, which is
+    everything the push costs: IPC to the Hypergolix daemon, its
+    encryption and signing, and the network.
+    '''
+    
+    PHASES = ('collect', 'sample', 'alert', 'format', 'assign', 'push')
+    
+    def __init__(self, window=256):
+        self._timings = {
+            phase: collections.deque(maxlen=window) for phase in self.PHASES
+        }
+        self._lock = threading.Lock()
+        
+    def record(self, phase, seconds):
+        with self._lock:
+            self._timings[phase].append(seconds)
+            
+    def percentiles(self, fractions=(.5, .95, .99)):
+        ''' Returns {phase: [percentile, ...]} (nearest rank) for every
+        phase with any timings.
+        '''
+        with self._lock:
+            timings = {
+                phase: sorted(values)
+                for phase, values in self._timings.items() if values
+            }
+        return {
+            phase: [
+                values[int(round(fraction * (len(values) - 1)))]
+                for fraction in fractions
+            ]
+            for phase, values in timings.items()
+        }
+        
+    def extras(self):
+        ''' Percentiles as loop.<phase>.p50_ms etc, for a sample's extras.
+        '''
+        extras = {}
+        for phase, (p50, p95, p99) in self.percentiles().items():
+            extras['loop.' + phase + '.p50_ms'] = p50 * 1000
+            extras['loop.' + phase + '.p95_ms'] = p95 * 1000
+            extras['loop.' + phase + '.p99_ms'] = p99 * 1000
+        return extras
+
+
+class Sampler(threading.Thread):
+    ''' Samples the Telemeter's host into its ring buffer on a fixed
+    schedule of time.monotonic() deadlines, so it neither drifts nor
+    follows wall-clock changes. Pushing happens on another thread, which
+    we only signal when a push is due, so a slow push can't hold up the
+    next sample.
+    
+    If we wake up a whole interval (or more) late, the deadlines we
+    slept through are skipped and counted in the next sample's missed.
+    
+    With a deadband, pushes are adaptive instead of every interval: we
+    push as soon as a sample moves past the deadband from the last one
+    pushed (but no more often than minimum_interval), and otherwise back
+    off exponentially from interval up to max_interval, which doubles as
+    the heartbeat.
+    '''
+    
+    def __init__(self, telemeter):
+        super().__init__(daemon=True, name='telemeter-sampler')
+        self.telemeter = telemeter
+        self.push_due = threading.Event()
+        self.missed = 0
+        self._stopped = threading.Event()
+        
+    def run(self):
+        telemeter = self.telemeter
+        # Prime psutil's cached cpu times for the first delta
+        psutil.cpu_percent(interval=None, percpu=True)
+        
+        deadline = time.monotonic()
+        push_deadline = deadline
+        # For adaptive pushes
+        last_push = None
+        pushed_sample = None
+        quiet_interval = telemeter.interval
+        while not self._stopped.is_set():
+            interval = telemeter.sampling_interval
+            now = time.monotonic()
+            
+            missed = 0
+            if now - deadline >= interval:
+                missed = int((now - deadline) // interval)
+                deadline += missed * interval
+                self.missed += missed
+            
+            profile = telemeter.profile
+            if telemeter.collectors is not None:
+                start = time.perf_counter()
+                extras = telemeter.collectors.run_due(now)
+                profile.record('collect', time.perf_counter() - start)
+            else:
+                extras = None
+            
+            start = time.perf_counter()
+            sample = take_sample(missed, extras)
+            profile.record('sample', time.perf_counter() - start)
+            
+            # Alerts go out on their own thread, without waiting for a push
+            if telemeter.alert_rules is not None:
+                start = time.perf_counter()
+                events = telemeter.alert_rules.evaluate(sample)
+                if events:
+                    telemeter.alert_publisher.publish(events)
+                profile.record('alert', time.perf_counter() - start)
+            
+            # If a push has been stuck for long enough to fill the ring
+            # buffer, spool its oldest sample instead of dropping it.
+            samples = telemeter.samples
+            if (telemeter.spool is not None and
+                len(samples) == samples.maxlen):
+                try:
+                    telemeter.spool.extend([pack_status(samples.popleft())])
+                except IndexError:
+                    pass
+            samples.append(sample)
+            
+            if telemeter.deadband is None:
+                if now >= push_deadline:
+                    push_deadline += telemeter.interval
+                    # Don't try to catch up on pushes; just push once.
+                    if push_deadline <= now:
+                        push_deadline = now + telemeter.interval
+                    self.push_due.set()
+                    
+            else:
+                if pushed_sample is None or (
+                    telemeter.moved(pushed_sample, sample) and
+                    now - last_push >= telemeter.minimum_interval
+                ):
+                    quiet_interval = telemeter.interval
+                    push = True
+                elif now >= push_deadline:
+                    quiet_interval = telemeter.clamp_interval(
+                        min(quiet_interval * 2, telemeter.max_interval)
+                    )
+                    push = True
+                else:
+                    push = False
+                    
+                if push:
+                    pushed_sample = sample
+                    last_push = now
+                    push_deadline = now + quiet_interval
+                    self.push_due.set()
+            
+            deadline += interval
+            self._stopped.wait(max(deadline - time.monotonic(), 0))
+            
+    def stop(self):
+        self._stopped.set()
+        self.push_due.set()
+
+
+def read_fingerprints(path):
+    ''' Reads one fingerprint per line from path, ignoring blank lines
+    and #comments.
+    '''
+    fingerprints = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                fingerprints.append(hgx.Ghid.from_str(line))
+    return fingerprints
+
+
 class Telemeter:
     ''' Remote monitoring demo app sender.
     '''
     
-    def __init__(self, interval, minimum_interval=1):
+    def __init__(self, interval, minimum_interval=1, binary=False,
+                 sample_interval=None, buffer_size=3600, readers=None,
+                 collectors=None, cpu_budget=.01,
+                 deadband=None, max_interval=60, self_profile=False,
+                 spool=None, backfill_bytes=65536, backfill_interval=1,
+                 alerts=None):
         self.hgxlink = hgx.HGXLink()
         self._interval = interval
         self.minimum_interval = minimum_interval
+        # Push packed status records instead of formatted text
+        self.binary = binary
+        # If None, sample once per push
+        self.sample_interval = sample_interval
+        
+        # Samples since the last push. If pushes stall for long enough to
+        # fill it, the oldest samples are dropped.
+        self.samples = collections.deque(maxlen=buffer_size)
+        
+        # Samples that couldn't be pushed (a Spool, or None to drop them),
+        # and how quickly to backfill them once pushes work again.
+        self.spool = spool
+        self.backfill_bytes = backfill_bytes
+        self.backfill_interval = backfill_interval
+        self._backoff = 0
+        self._retry_at = 0
+        
+        # Every phase of the loop is timed. With self_profile, each push
+        # also reports the percentiles, in its last sample's extras.
+        self.profile = LoopProfile()
+        self.self_profile = self_profile
+        
+        # Adaptive pushing (see Sampler), if deadband isn't None. It's in
+        # percentage points of cpu (mean and max), memory and disk use.
+        self.deadband = deadband
+        self.max_interval = max_interval
+        
+        # Extra metrics, run by the sampler when they're due. Their cost is
+        # kept under cpu_budget (a fraction of one CPU).
+        if collectors:
+            self.collectors = CollectorSet(collectors, cpu_budget)
+        else:
+            self.collectors = None
+        
+        # Threshold alert rules, evaluated on every sample. Changes are
+        # pushed on their own alert object as soon as they happen.
+        if alerts:
+            self.alert_rules = AlertEngine(alerts)
+        else:
+            self.alert_rules = None
+        self.alert_publisher = None
         
         # These are the actual Hypergolix business parts
         self.status = None
-        self.paired_fingerprint = None
+        self.alerts = None
+        # Fingerprints allowed to pair. If None, the first to pair is the
+        # only one allowed (trust on first pair).
+        if readers is None:
+            self.allowed_readers = None
+        else:
+            self.allowed_readers = frozenset(readers)
+        # <paired fingerprint>: <ghid of the last pairing request we handled>
+        self.paired = {}
+        self._pairing_lock = threading.Lock()
         
+        self.sampler = None
         self.running = True
         
     def app_init(self):
         ''' Set up the application.
         '''
         # print('My fingerprint is: ' + self.hgxlink.whoami.as_str())
-        self.status = self.hgxlink.new_threadsafe(
-            cls = hgx.JsonObj,
-            state = 'Hello world!',
-            api_id = STATUS_API
-        )
+        if self.binary:
+            self.status = self.hgxlink.new_threadsafe(
+                cls = hgx.Obj,
+                state = b'',
+                api_id = BINARY_STATUS_API
+            )
+        else:
+            self.status = self.hgxlink.new_threadsafe(
+                cls = hgx.JsonObj,
+                state = 'Hello world!',
+                api_id = STATUS_API
+            )
+        
+        if self.alert_rules is not None:
+            self.alerts = self.hgxlink.new_threadsafe(
+                cls = hgx.JsonObj,
+                state = {'seq': 0, 'active': {}, 'events': []},
+                api_id = ALERT_API
+            )
+            self.alert_publisher = AlertPublisher(self.alerts)
         
         # Share handlers are called from within the HGXLink event loop, so they
         # must be wrapped before use
@@ -109,62 +593,181 @@ class Telemeter:
                                                        interval_handler)
         
     def app_run(self):
-        ''' Do the main application loop.
+        ''' Do the main application loop. The Sampler samples every
+        sampling_interval into the ring buffer, and we push everything in
+        it whenever it tells us a push is due (every interval).
         '''
-        while self.running:
-            timestamp = datetime.datetime.now()
-            timestr = timestamp.strftime('%Y.%m.%d @ %H:%M:%S\n==========\n')
-            cpustr = format_cpu(psutil.cpu_percent(interval=.1, percpu=True))
-            memstr = format_mem(psutil.virtual_memory())
-            diskstr = format_disk(psutil.disk_usage('/'))
+        if self.alert_publisher is not None:
+            self.alert_publisher.start()
+        self.sampler = Sampler(self)
+        self.sampler.start()
+        
+        try:
+            while self.running:
+                # Time out occasionally to notice self.running going False,
+                # and to backfill (or retry) the spool between pushes.
+                timeout = 1
+                if self.spool is not None and len(self.spool):
+                    timeout = min(max(self._retry_at - time.monotonic(), 0),
+                                  timeout)
+                    
+                if self.sampler.push_due.wait(timeout=timeout):
+                    self.sampler.push_due.clear()
+                    self.push_samples()
+                elif self.spool is not None and len(self.spool):
+                    self.push_samples()
+                    
+        finally:
+            self.sampler.stop()
+            if self.alert_publisher is not None:
+                self.alert_publisher.stop()
+            if self.spool is not None:
+                self.spool.close()
             
-            status = (timestr + cpustr + memstr + diskstr + '\n')
+    @property
+    def sampling_interval(self):
+        ''' Seconds between samples. Without a sample_interval, we take
+        one sample per push.
+        '''
+        if self.sample_interval is None:
+            return self.interval
+        return max(self.sample_interval, .01)
             
-            self.status.state = status
-            self.status.push_threadsafe()
+    def push_samples(self):
+        ''' Pushes the batch of samples since the last push as our status.
+        
+        With a spool, a batch that fails to push is spooled instead of
+        lost, and until the spool has drained, new batches are queued
+        behind it so that readers still get everything in order. The
+        spool is backfilled one batch of at most backfill_bytes per
+        backfill_interval, and after a failure we back off (with jitter)
+        before trying again.
+        '''
+        # The sampler appends concurrently, so drain one at a time instead
+        # of copying and clearing.
+        batch = []
+        while True:
+            try:
+                batch.append(self.samples.popleft())
+            except IndexError:
+                break
+        
+        spool = self.spool
+        if spool is None:
+            if batch:
+                self._push_batch(batch)
+            return
+        
+        if batch and (len(spool) or time.monotonic() < self._retry_at):
+            spool.extend(pack_status(sample) for sample in batch)
+            batch = []
             
-            elapsed = (datetime.datetime.now() - timestamp).total_seconds()
-            # print('Logged in {:.3f} seconds:\n{}'.format(elapsed, status))
-            # Make sure we clamp this to non-negative values, in case the
-            # update took longer than the current interval.
-            time.sleep(max(self.interval - elapsed, 0))
+        if len(spool):
+            if time.monotonic() < self._retry_at:
+                return
+            records, marker = spool.peek(self.backfill_bytes)
+            try:
+                self._push_batch([
+                    unpack_status(record)[0] for record in records
+                ])
+            except Exception:
+                self._push_failed()
+                return
+            spool.consume(marker)
+            self._backoff = 0
+            self._retry_at = time.monotonic() + self.backfill_interval
+            
+        elif batch:
+            try:
+                self._push_batch(batch)
+            except Exception:
+                # The sampler may have spilled newer samples into the
+                # spool while we were pushing.
+                spool.prepend(pack_status(sample) for sample in batch)
+                self._push_failed()
+                
+    def _push_failed(self):
+        self._backoff = min(max(self._backoff * 2, self.backfill_interval),
+                            self.max_interval)
+        # Jitter, so a fleet that lost the same link doesn't come back in
+        # lockstep.
+        self._retry_at = (time.monotonic() +
+                          self._backoff * random.uniform(.5, 1.5))
+        logger.warning('Push failed; ' + str(len(self.spool)) +
+                       ' samples spooled.', exc_info=True)
+        
+    def _push_batch(self, batch):
+        ''' Formats (or packs) batch into our status and pushes it.
+        '''
+        # Push timings can only go out with the push after them.
+        if self.self_profile:
+            extras = dict(batch[-1].extras)
+            extras.update(self.profile.extras())
+            batch[-1] = batch[-1]._replace(extras=extras)
+        
+        start = time.perf_counter()
+        # Formatting is left to the reader in binary mode
+        if self.binary:
+            status = pack_statuses(batch)
+        else:
+            status = ''.join(format_status(sample) for sample in batch)
+        formatted = time.perf_counter()
+        
+        # Just updates the local state; nothing is encrypted until the push
+        self.status.state = status
+        assigned = time.perf_counter()
+        
+        # IPC, crypto and network, all together
+        self.status.push_threadsafe()
+        pushed = time.perf_counter()
+        
+        self.profile.record('format', formatted - start)
+        self.profile.record('assign', assigned - formatted)
+        self.profile.record('push', pushed - assigned)
             
     def signal_handler(self, signum):
         self.running = False
         self.hgxlink.stop_threadsafe()
         
     def pair_handler(self, ghid, origin, api_id):
-        ''' Pair handlers ignore the object itself, instead setting up
-        the origin as the paired_fingerprint (unless one already exists,
-        in which case it is ignored) and sharing the status object with
-        them.
-        
-        This also doubles as a way to re-pair the same fingerprint, in
-        the event that they have gone offline for a long time and are no
-        longer receiving updates.
-        '''
-        # The initial pairing (pair/trust on first connect)
-        if self.paired_fingerprint is None:
-            self.paired_fingerprint = origin
+        ''' Pair handlers ignore the object itself, instead adding the
+        origin to our paired readers (if it's on the allow-list) and
+        sharing the status object with them. All readers share the same
+        status object, so pushing costs the same however many there are.
         
-        # Subsequent pairing requests from anyone else are ignored
-        elif self.paired_fingerprint != origin:
-            return
+        A new pairing request from a paired reader (one that's been
+        offline for a long time, say) is always shared with again; only
+        repeated deliveries of the same request are ignored.
+        '''
+        with self._pairing_lock:
+            if origin not in self.paired:
+                # Without an allow-list, pair/trust on first connect
+                if self.allowed_readers is None:
+                    if self.paired:
+                        return
+                elif origin not in self.allowed_readers:
+                    return
+                
+            elif self.paired[origin] == ghid:
+                return
+            
+            self.paired[origin] = ghid
             
         # Now we want to share the status reporter, if we have one, with the
         # origin
         if self.status is not None:
             self.status.share_threadsafe(origin)
+        if self.alerts is not None:
+            self.alerts.share_threadsafe(origin)
             
     def interval_handler(self, ghid, origin, api_id):
         ''' Interval handlers change our recording interval.
         '''
-        # Ignore requests that don't match our pairing.
-        # This will also catch un-paired requests.
-        if origin != self.paired_fingerprint:
+        # Ignore requests from anyone we haven't paired with.
+        if origin not in self.paired:
             return
         
-        # If the address matches our pairing, use it to change our interval.
+        # If the address matches a pairing, use it to change our interval.
         else:
             # We don't need to create an update callback here, because any
             # upstream modifications will automatically be passed to the
@@ -181,25 +784,52 @@ class Telemeter:
         ''' This provides some consumer-side protection against
         malicious interval proxies.
         '''
+        return self.clamp_interval(self._interval)
+        
+    def clamp_interval(self, interval):
+        ''' Clamps any push interval to at least minimum_interval, and
+        turns anything that isn't a number into minimum_interval.
+        '''
         try:
-            return float(max(self._interval, self.minimum_interval))
+            return float(max(interval, self.minimum_interval))
         
         except (ValueError, TypeError):
             return self.minimum_interval
+            
+    def moved(self, previous, sample):
+        ''' True if any of sample's core metrics have moved past the
+        deadband since previous. Extras (mostly counters) don't count.
+        '''
+        deadband = self.deadband
+        previous_cpus = previous.cpus or [0]
+        cpus = sample.cpus or [0]
+        return (
+            abs(sum(cpus) / len(cpus) -
+                sum(previous_cpus) / len(previous_cpus)) > deadband or
+            abs(max(cpus) - max(previous_cpus)) > deadband or
+            abs(sample.mem.percent - previous.mem.percent) > deadband or
+            abs(sample.disk.percent - previous.disk.percent) > deadband
+        )
 
 
 class Telereader:
     ''' Remote monitoring demo app receiver.
     '''
     
-    def __init__(self, telemeter_fingerprint):
+    def __init__(self, telemeter_fingerprint, store=None):
         self.hgxlink = hgx.HGXLink()
         self.telemeter_fingerprint = telemeter_fingerprint
+        # Optional TimeSeriesStore for binary samples
+        self.store = store
         
         # These are the actual Hypergolix business parts
         self.status = None
+        self.alerts = None
         self.pair = None
         self.interval = None
+        # <alert object ghid>: <seq of the last alert event we've shown>.
+        # A restarted Telemeter shares a new alert object, counting from 0.
+        self._alert_seqs = {}
         
     def app_init(self):
         ''' Set up the application.
@@ -208,6 +838,10 @@ class Telereader:
         # needs no wrapping.
         self.hgxlink.register_share_handler_threadsafe(STATUS_API,
                                                        self.status_handler)
+        self.hgxlink.register_share_handler_threadsafe(BINARY_STATUS_API,
+                                                       self.status_handler)
+        self.hgxlink.register_share_handler_threadsafe(ALERT_API,
+                                                       self.alert_handler)
         
         # Wait until after registering the share handler to avoid a race
         # condition with the Telemeter
@@ -230,8 +864,13 @@ class Telereader:
         callback to run every time the object is updated.
         '''
         print('Incoming status: ' + ghid.as_str())
+        if api_id == BINARY_STATUS_API:
+            cls = hgx.Obj
+        else:
+            cls = hgx.JsonObj
+        
         status = await self.hgxlink.get(
-            cls = hgx.JsonObj,
+            cls = cls,
             ghid = ghid
         )
         # This registers the update callback. It will be run in the hgxlink
@@ -245,8 +884,43 @@ class Telereader:
         ''' A very simple, **asynchronous** handler for status updates.
         This will be called every time the Telemeter changes their
         status.
+        
+        Binary status records are formatted here, instead of by the
+        Telemeter, and kept in the store if we have one.
+        '''
+        if obj.api_id == BINARY_STATUS_API:
+            # Nothing has been pushed yet
+            if not obj.state:
+                return
+            samples = unpack_statuses(obj.state)
+            if self.store is not None:
+                self.store.record(self.telemeter_fingerprint.as_str(),
+                                  samples)
+            for sample in samples:
+                print(format_status(sample))
+        else:
+            print(obj.state)
+        
+    async def alert_handler(self, ghid, origin, api_id):
+        ''' The Telemeter has alert rules, and shared their alert object
+        with us along with its status.
+        '''
+        alerts = await self.hgxlink.get(
+            cls = hgx.JsonObj,
+            ghid = ghid
+        )
+        alerts.callback = self.alert_update_handler
+        self.alerts = alerts
+        
+    async def alert_update_handler(self, obj):
+        ''' Prints every alert event we haven't already. Pushes can be
+        coalesced, so there may be several at once.
         '''
-        print(obj.state)
+        seen = self._alert_seqs.get(obj.ghid, 0)
+        for event in obj.state['events']:
+            if event['seq'] > seen:
+                print(format_alert(event))
+        self._alert_seqs[obj.ghid] = obj.state['seq']
         
     def set_interval(self, interval):
         ''' Set the recording interval remotely.
@@ -269,6 +943,208 @@ class Telereader:
             self.interval.hgx_push_threadsafe()
 
 
+class FleetReader(Telereader):
+    ''' Telereader for many Telemeters at once. Updates only replace the
+    latest status we have for that host, and a summary table of every
+    host is redrawn every refresh seconds, no matter how many updates
+    arrived in between.
+    '''
+    
+    def __init__(self, telemeter_fingerprints, refresh=1, pairing_workers=32,
+                 store=None):
+        super().__init__(telemeter_fingerprint=None, store=store)
+        self.telemeter_fingerprints = list(telemeter_fingerprints)
+        self.refresh = refresh
+        self.pairing_workers = pairing_workers
+        
+        # <status ghid>: <status object>, to prevent garbage collection
+        self.statuses = {}
+        # <status ghid>: <telemeter fingerprint>
+        self._hosts = {}
+        # <telemeter fingerprint>: (<latest status state>, <monotonic time>)
+        self._latest = {}
+        # <telemeter fingerprint>: <table row>, for the ones decoded
+        # since they last changed
+        self._rows = {}
+        # <alert ghid>: <alert object>, and <telemeter fingerprint>: <rules
+        # currently firing>
+        self.alert_objs = {}
+        self._alerts = {}
+        
+    def app_init(self):
+        ''' Set up the application, pairing with every Telemeter
+        concurrently.
+        '''
+        self.hgxlink.register_share_handler_threadsafe(STATUS_API,
+                                                       self.status_handler)
+        self.hgxlink.register_share_handler_threadsafe(BINARY_STATUS_API,
+                                                       self.status_handler)
+        self.hgxlink.register_share_handler_threadsafe(ALERT_API,
+                                                       self.alert_handler)
+        
+        # One pairing object is enough for everyone
+        self.pair = self.hgxlink.new_threadsafe(
+            cls = hgx.JsonObj,
+            state = 'Hello world!',
+            api_id = PAIR_API
+        )
+        self._share_with_all(self.pair.share_threadsafe)
+        
+    def _share_with_all(self, share):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers = self.pairing_workers
+        ) as executor:
+            futures = {
+                executor.submit(share, fingerprint): fingerprint
+                for fingerprint in self.telemeter_fingerprints
+            }
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    print('Failed to share with ' +
+                          futures[future].as_str() + ': ' +
+                          repr(future.exception()), file=sys.stderr)
+        
+    def app_run(self):
+        ''' Redraw the table every refresh seconds, on monotonic deadlines.
+        '''
+        deadline = time.monotonic()
+        while True:
+            self.redraw()
+            deadline += self.refresh
+            time.sleep(max(deadline - time.monotonic(), 0))
+            
+    async def status_handler(self, ghid, origin, api_id):
+        ''' Like Telereader.status_handler, but one per Telemeter.
+        '''
+        if api_id == BINARY_STATUS_API:
+            cls = hgx.Obj
+        else:
+            cls = hgx.JsonObj
+        
+        status = await self.hgxlink.get(
+            cls = cls,
+            ghid = ghid
+        )
+        self._hosts[ghid] = origin
+        status.callback = self.update_handler
+        self.statuses[ghid] = status
+        
+    async def update_handler(self, obj):
+        ''' Just keeps the state; it isn't decoded until the next redraw,
+        and then only if it's still the latest. Unless we're storing
+        every sample, of course.
+        '''
+        try:
+            host = self._hosts[obj.ghid]
+        except KeyError:
+            return
+        
+        state = obj.state
+        if self.store is not None and isinstance(state, bytes):
+            self.store.record(host.as_str(), unpack_statuses(state))
+        
+        self._latest[host] = (state, time.monotonic())
+        self._rows.pop(host, None)
+        
+    async def alert_handler(self, ghid, origin, api_id):
+        ''' Like Telereader.alert_handler, but one per Telemeter.
+        '''
+        alerts = await self.hgxlink.get(
+            cls = hgx.JsonObj,
+            ghid = ghid
+        )
+        self._hosts[ghid] = origin
+        alerts.callback = self.alert_update_handler
+        self.alert_objs[ghid] = alerts
+        
+    async def alert_update_handler(self, obj):
+        ''' Keeps which rules are firing, for the table.
+        '''
+        try:
+            host = self._hosts[obj.ghid]
+        except KeyError:
+            return
+        self._alerts[host] = sorted(obj.state['active'])
+        
+    def _row(self, host, state):
+        try:
+            return self._rows[host]
+        except KeyError:
+            pass
+        
+        if isinstance(state, bytes):
+            samples = unpack_statuses(state)
+        else:
+            samples = []
+        
+        if samples:
+            latest = samples[-1]
+            cpus = latest.cpus or [0]
+            row = (
+                '{:6.1f}'.format(sum(cpus) / len(cpus)),
+                '{:6.1f}'.format(max(cpus)),
+                '{:6.1f}'.format(latest.mem.percent),
+                '{:6.1f}'.format(latest.disk.percent),
+                '{:6d}'.format(sum(sample.missed for sample in samples)),
+            )
+        else:
+            # Text statuses are only meant for people to read
+            row = ('     -',) * 5
+            
+        self._rows[host] = row
+        return row
+        
+    def redraw(self):
+        ''' Clears the terminal and prints one line per Telemeter.
+        '''
+        now = time.monotonic()
+        lines = [
+            '\x1b[H\x1b[2J' +
+            '{:<24} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6} {}'.format(
+                'HOST', 'AGE', 'CPU', 'CPUMAX', 'MEM', 'DISK', 'MISSED',
+                'ALERTS'
+            )
+        ]
+        reporting = 0
+        for host in self.telemeter_fingerprints:
+            name = host.as_str()[:24]
+            try:
+                state, received = self._latest[host]
+            except KeyError:
+                lines.append('{:<24} {:>6}'.format(name, 'never'))
+                continue
+            
+            reporting += 1
+            lines.append(
+                '{:<24} {:6.0f} '.format(name, now - received) +
+                ' '.join(self._row(host, state)) + ' ' +
+                ','.join(self._alerts.get(host, ()))
+            )
+        
+        lines.append(
+            str(reporting) + '/' + str(len(self.telemeter_fingerprints)) +
+            ' reporting'
+        )
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+        
+    def set_interval(self, interval):
+        ''' Set the recording interval of every Telemeter remotely.
+        '''
+        interval = float(interval)
+        
+        if self.interval is None:
+            self.interval = self.hgxlink.new_threadsafe(
+                cls = hgx.JsonProxy,
+                state = interval,
+                api_id = INTERVAL_API
+            )
+            self._share_with_all(self.interval.hgx_share_threadsafe)
+        else:
+            self.interval.hgx_state = interval
+            self.interval.hgx_push_threadsafe()
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(
         description = 'A simple remote telemetry app.'
@@ -279,6 +1155,30 @@ if __name__ == "__main__":
         default = None,
         help = 'Pass a Telemeter fingerprint to run as a reader.'
     )
+    argparser.add_argument(
+        '--fleet',
+        action = 'store',
+        default = None,
+        type = str,
+        help = 'Pass a file of Telemeter fingerprints (one per line) to ' +
+               'run as a reader for all of them, showing a summary table.'
+    )
+    argparser.add_argument(
+        '--refresh',
+        action = 'store',
+        default = 1,
+        type = float,
+        help = 'Seconds between redraws of the --fleet table [default: 1]'
+    )
+    argparser.add_argument(
+        '--store',
+        action = 'store',
+        default = None,
+        type = str,
+        help = 'Keep every (binary) sample the Telereader receives in a ' +
+               'time-series store in this directory. Query it with ' +
+               'tsstore.py.'
+    )
     argparser.add_argument(
         '--interval',
         action = 'store',
@@ -287,6 +1187,120 @@ if __name__ == "__main__":
         help = 'Set the Telemeter recording interval from the Telereader. ' +
                'Ignored by a Telemeter.'
     )
+    argparser.add_argument(
+        '--push-interval',
+        action = 'store',
+        default = 5,
+        type = float,
+        help = 'Seconds between Telemeter status pushes [default: 5]. ' +
+               'Can be changed remotely with --interval.'
+    )
+    argparser.add_argument(
+        '--sample-interval',
+        action = 'store',
+        default = None,
+        type = float,
+        help = 'Seconds between Telemeter samples. Each push carries every ' +
+               'sample since the last one [default: one per push].'
+    )
+    argparser.add_argument(
+        '--readers',
+        action = 'store',
+        default = None,
+        type = str,
+        help = 'File of Telereader fingerprints (one per line) allowed to ' +
+               'pair with the Telemeter. Without it, only the first ' +
+               'Telereader to pair is.'
+    )
+    argparser.add_argument(
+        '--deadband',
+        action = 'store',
+        default = None,
+        type = float,
+        help = 'Push adaptively: right away when cpu, memory or disk use ' +
+               'moves more than this many percentage points, otherwise ' +
+               'backing off from the push interval to --max-interval.'
+    )
+    argparser.add_argument(
+        '--max-interval',
+        action = 'store',
+        default = 60,
+        type = float,
+        help = 'Longest a --deadband Telemeter goes without pushing (its ' +
+               'heartbeat) [default: 60]'
+    )
+    argparser.add_argument(
+        '--self-profile',
+        action = 'store_true',
+        help = 'Report percentiles of how long the Telemeter spends ' +
+               'collecting, sampling, alerting, formatting, assigning ' +
+               '(the local state update) and pushing (IPC, crypto and ' +
+               'network) in its status.'
+    )
+    argparser.add_argument(
+        '--collectors',
+        action = 'store',
+        default = '',
+        type = load_collectors,
+        help = 'Extra Telemeter metrics, as NAME[=INTERVAL],... Built in: ' +
+               'net, diskio, load, top, fs. Plugins are module:Class. ' +
+               'They run no more often than --sample-interval.'
+    )
+    argparser.add_argument(
+        '--cpu-budget',
+        action = 'store',
+        default = 1,
+        type = float,
+        help = 'Percent of one CPU the --collectors may use before the ' +
+               'most expensive ones are backed off [default: 1]'
+    )
+    argparser.add_argument(
+        '--alert',
+        action = 'store',
+        default = '',
+        type = parse_rules,
+        help = 'Telemeter alert rules, as METRIC>THRESHOLD[:COUNT],... eg. ' +
+               'disk>95,cpu_max>90:3. Checked on every sample and pushed ' +
+               'right away. See alerts.py.'
+    )
+    argparser.add_argument(
+        '--spool',
+        action = 'store',
+        default = None,
+        type = str,
+        help = 'Spool samples the Telemeter fails to push to this file, ' +
+               'and backfill them once pushes work again.'
+    )
+    argparser.add_argument(
+        '--spool-size',
+        action = 'store',
+        default = 16,
+        type = float,
+        help = 'MiB of samples the --spool keeps before dropping the ' +
+               'oldest [default: 16]'
+    )
+    argparser.add_argument(
+        '--backfill-bytes',
+        action = 'store',
+        default = 65536,
+        type = int,
+        help = 'Most (packed) bytes of spooled samples per backfill push ' +
+               '[default: 65536]'
+    )
+    argparser.add_argument(
+        '--backfill-interval',
+        action = 'store',
+        default = 1,
+        type = float,
+        help = 'Seconds between backfill pushes, and the shortest ' +
+               'backoff after a failed push [default: 1]'
+    )
+    argparser.add_argument(
+        '--binary',
+        action = 'store_true',
+        help = 'Push compact binary status records, formatted by the ' +
+               'Telereader, instead of text. Ignored by a Telereader.'
+    )
     argparser.add_argument(
         '--pidfile',
         action = 'store',
@@ -302,9 +1316,21 @@ if __name__ == "__main__":
     args = argparser.parse_args()
     
     # This is the READER
-    if args.telereader is not None:
-        telemeter_fingerprint = hgx.Ghid.from_str(args.telereader)
-        app = Telereader(telemeter_fingerprint)
+    if args.telereader is not None or args.fleet is not None:
+        if args.store is not None:
+            store = TimeSeriesStore(args.store)
+        else:
+            store = None
+            
+        if args.fleet is not None:
+            app = FleetReader(
+                read_fingerprints(args.fleet),
+                refresh = args.refresh,
+                store = store
+            )
+        else:
+            telemeter_fingerprint = hgx.Ghid.from_str(args.telereader)
+            app = Telereader(telemeter_fingerprint, store=store)
         
         try:
             app.app_init()
@@ -316,6 +1342,8 @@ if __name__ == "__main__":
             
         finally:
             app.hgxlink.stop_threadsafe()
+            if store is not None:
+                store.close()
     
     # This is the SENDER, but we're stopping it.
     elif args.stop:
@@ -323,19 +1351,54 @@ if __name__ == "__main__":
         
     # This is the SENDER, and we're starting it.
     else:
+        readers = None
+        spool_path = None
+        
         # We need to actually daemonize the app so that it persists without
         # an SSH connection
         with daemoniker.Daemonizer() as (is_setup, daemonizer):
-            is_parent, pidfile = daemonizer(
+            # Read the allow-list while we're still in the caller's cwd
+            if is_setup and args.readers is not None:
+                readers = [
+                    fingerprint.as_str()
+                    for fingerprint in read_fingerprints(args.readers)
+                ]
+            if is_setup and args.spool is not None:
+                spool_path = os.path.abspath(args.spool)
+            
+            is_parent, pidfile, readers, spool_path = daemonizer(
                 args.pidfile,
                 args.pidfile,
+                readers,
+                spool_path,
                 strip_cmd_args = False
             )
             
             # Parent exits here
         
         # Just the child from here
-        app = Telemeter(interval=5)
+        if readers is not None:
+            readers = [hgx.Ghid.from_str(reader) for reader in readers]
+        if spool_path is not None:
+            spool = Spool(spool_path, int(args.spool_size * 1048576))
+        else:
+            spool = None
+            
+        app = Telemeter(
+            interval = args.push_interval,
+            readers = readers,
+            binary = args.binary,
+            sample_interval = args.sample_interval,
+            collectors = args.collectors,
+            deadband = args.deadband,
+            self_profile = args.self_profile,
+            max_interval = args.max_interval,
+            cpu_budget = args.cpu_budget / 100,
+            spool = spool,
+            backfill_bytes = args.backfill_bytes,
+            backfill_interval = args.backfill_interval,
+            alerts = args.alert
+        )
             
         try:
             sighandler = daemoniker.SignalHandler1(
@@ -0,0 +1,120 @@
+''' Tests for the Telemeter's on-disk spool.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_drops_oldest_when_full(self):
+        spool = Spool(self.path, 100)
+        # 14 bytes apiece, so 7 fit
+        spool.extend([bytes([ii]) * 10 for ii in range(20)])
+
+        records, __ = spool.peek(1000)
+        self.assertEqual([record[0] for record in records],
+                         list(range(13, 20)))
+        self.assertEqual(spool.dropped, 13)
+        spool.close()
+
+    def test_wraps_and_reopens(self):
+        spool = Spool(self.path, 100)
+        spool.extend([bytes([ii]) * 10 for ii in range(5)])
+        __, marker = spool.peek(30)
+        spool.consume(marker)
+        # Wraps around the end of the ring
+        spool.extend([b'x' * 30, b'y' * 20])
+        expected, __ = spool.peek(1000)
+        spool.close()
+
+        # Capacity comes from the existing file
+        spool = Spool(self.path, 999)
+        self.assertEqual(spool.capacity, 100)
+        self.assertEqual(spool.peek(1000)[0], expected)
+        self.assertEqual(expected[-2:], [b'x' * 30, b'y' * 20])
+        spool.close()
+
+    def test_overflow_during_push(self):
+        ''' Records dropped to make room while a backfill push is in
+        flight must not make consume() remove newer, unsent ones.
+        '''
+        spool = Spool(self.path, 100)
+        spool.extend([bytes([ii]) * 10 for ii in range(7)])
+
+        # Backfill the oldest 3...
+        sent, marker = spool.peek(42)
+        self.assertEqual([record[0] for record in sent], [0, 1, 2])
+
+        # ...while the sampler spools 5 more, overflowing the spool and
+        # dropping 0 through 4.
+        spool.extend([bytes([ii]) * 10 for ii in range(7, 12)])
+        spool.consume(marker)
+
+        remaining, __ = spool.peek(1000)
+        self.assertEqual([record[0] for record in remaining],
+                         list(range(5, 12)))
+        spool.close()
+
+    def test_partial_overflow_during_push(self):
+        spool = Spool(self.path, 100)
+        spool.extend([bytes([ii]) * 10 for ii in range(7)])
+        sent, marker = spool.peek(42)
+
+        # Only drops 0, so 1 and 2 are still there to consume
+        spool.extend([b'\x07' * 10])
+        spool.consume(marker)
+
+        remaining, __ = spool.peek(1000)
+        self.assertEqual([record[0] for record in remaining],
+                         list(range(3, 8)))
+        spool.close()
+
+    def test_prepend_failed_push(self):
+        ''' A batch that failed to push goes back ahead of newer samples
+        the sampler spilled during the push, in order.
+        '''
+        spool = Spool(self.path, 100)
+        # Wrap the head, so that prepending wraps backwards around it
+        spool.extend([b'x' * 10])
+        spool.consume(spool.peek(1000)[1])
+        spool.extend([bytes([ii]) * 10 for ii in range(3, 5)])
+
+        spool.prepend([bytes([ii]) * 10 for ii in range(3)])
+        records, marker = spool.peek(1000)
+        self.assertEqual([record[0] for record in records], list(range(5)))
+        spool.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(spool.peek(1000)[0], records)
+        spool.consume(spool.peek(28)[1])
+        self.assertEqual([record[0] for record in spool.peek(1000)[0]],
+                         [2, 3, 4])
+        spool.close()
+
+    def test_prepend_when_full(self):
+        ''' Prepending never drops anything newer; the oldest of the
+        prepended records go instead.
+        '''
+        spool = Spool(self.path, 100)
+        spool.extend([bytes([ii]) * 10 for ii in range(5, 10)])
+        spool.prepend([bytes([ii]) * 10 for ii in range(5)])
+
+        records, __ = spool.peek(1000)
+        self.assertEqual([record[0] for record in records], list(range(3, 10)))
+        self.assertEqual(spool.dropped, 3)
+        spool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
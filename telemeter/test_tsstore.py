@@ -0,0 +1,96 @@
+''' Tests for the Telereader's time-series store.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tsstore import resource
+from tsstore import TimeSeriesStore
+from tsstore import _host_columns
+
+
+class _Mem:
+    percent = 50.
+    available = 1024
+
+
+class _Disk:
+    percent = 25.
+    free = 2048
+
+
+class _Sample:
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.cpus = [10., 30.]
+        self.mem = _Mem()
+        self.disk = _Disk()
+
+
+def _open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+@unittest.skipIf(resource is None or not os.path.isdir('/proc/self/fd'),
+                 'Needs resource limits and /proc/self/fd.')
+class FileLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    def tearDown(self):
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _limit(self, spare):
+        soft = _open_fds() + spare
+        resource.setrlimit(
+            resource.RLIMIT_NOFILE,
+            (soft, self.limits[1])
+        )
+        return soft
+
+    def test_more_hosts_than_fit(self):
+        soft = self._limit(4 * _host_columns())
+        store = TimeSeriesStore(self.tmpdir)
+        self.assertLessEqual(store.max_open * _host_columns(), soft // 2)
+
+        hosts = ['host' + str(ii) for ii in range(3 * store.max_open + 1)]
+        for timestamp in (1000, 2000):
+            for host in hosts:
+                self.assertEqual(store.record(host, [_Sample(timestamp)]), 1)
+        store.close()
+
+        self.assertEqual(store.hosts(), sorted(hosts))
+        for host in hosts:
+            self.assertEqual(
+                [row[0] for row in store.series(host, 'cpu', 0, 3000)],
+                [1000, 2000]
+            )
+
+    def test_out_of_files(self):
+        ''' Running out of descriptors partway through opening a host
+        closes whatever it had opened.
+        '''
+        store = TimeSeriesStore(self.tmpdir, max_open=8)
+        store.record('first', [_Sample(1000)])
+        opened = _open_fds()
+        self._limit(_host_columns() // 2)
+
+        # Closing the first host's writer makes room for the second...
+        self.assertEqual(store.record('second', [_Sample(1000)]), 1)
+        self.assertEqual(_open_fds(), opened)
+        store.close()
+        closed = _open_fds()
+
+        # ...but with nothing left to close, it fails cleanly.
+        self._limit(_host_columns() // 2)
+        with self.assertRaises(OSError):
+            store.record('third', [_Sample(1000)])
+        self.assertEqual(_open_fds(), closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,579 @@
+''' Reader-side time-series store for Telemeter samples.
+
+Every host gets a directory, with one append-only array file per column
+per resolution:
+
+    <host>/raw/t.q              sample timestamps (ms since the epoch)
+    <host>/raw/<metric>.d       one value per sample
+    <host>/1m/t.q               bucket start times
+    <host>/1m/n.q               samples per bucket
+    <host>/1m/<metric>.min.d    (and .max.d, .sum.d) per bucket
+    <host>/1h/...               same as 1m
+
+Columns are native-endian arrays (the array module's typecodes), so
+queries just mmap the couple of columns they need and bisect on the
+timestamps, instead of loading anything. Rollups are kept up to date as
+samples arrive: the last row of each is the bucket currently filling.
+
+Aggregates over long ranges use the coarsest rollup that fits inside
+the range, and finer ones (then raw samples) only for the ragged edges,
+so they're exact and cost about the same for a day as for a year.
+
+Run this file directly to query a store; see --help.
+'''
+
+import argparse
+import array
+import bisect
+import collections
+import datetime
+import errno
+import math
+import mmap
+import os
+import re
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+
+METRICS = ('cpu', 'cpu_max', 'mem', 'mem_available', 'disk', 'disk_free')
+
+# Name, bucket width (ms), finest first.
+ROLLUPS = (('1m', 60000), ('1h', 3600000))
+
+
+def sample_values(sample):
+    ''' Extracts the stored metrics from a StatusSample, in METRICS
+    order.
+    '''
+    cpus = sample.cpus or [0]
+    return (
+        sum(cpus) / len(cpus),
+        max(cpus),
+        sample.mem.percent,
+        sample.mem.available,
+        sample.disk.percent,
+        sample.disk.free,
+    )
+
+
+class Column:
+    ''' One append-only array file, written with pwrite.
+    '''
+    def __init__(self, path, typecode):
+        self.path = path
+        self.typecode = typecode
+        self.itemsize = array.array(typecode).itemsize
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.length = os.fstat(self._fd).st_size // self.itemsize
+
+    def _pack(self, value):
+        return array.array(self.typecode, [value]).tobytes()
+
+    def append(self, value):
+        os.pwrite(self._fd, self._pack(value), self.length * self.itemsize)
+        self.length += 1
+
+    def set(self, index, value):
+        os.pwrite(self._fd, self._pack(value), index * self.itemsize)
+
+    def get(self, index):
+        data = os.pread(self._fd, self.itemsize, index * self.itemsize)
+        return array.array(self.typecode, data)[0]
+
+    def truncate(self, length):
+        os.ftruncate(self._fd, length * self.itemsize)
+        self.length = length
+
+    def close(self):
+        os.close(self._fd)
+
+
+def map_column(path, typecode):
+    ''' Read-only memoryview of a column file, cast to typecode. Missing
+    or empty files map to an empty sequence.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return ()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return ()
+
+    itemsize = array.array(typecode).itemsize
+    # A writer may be halfway through appending an item
+    return memoryview(mapped)[:size - size % itemsize].cast(typecode)
+
+
+class _Series:
+    ''' A set of equal-length columns in one directory.
+    '''
+    def __init__(self, directory, columns):
+        os.makedirs(directory, exist_ok=True)
+        self.columns = collections.OrderedDict()
+        try:
+            for name, typecode in columns:
+                self.columns[name] = Column(
+                    os.path.join(directory, name),
+                    typecode
+                )
+        except:
+            self.close()
+            raise
+
+        # After a crash, some columns may have one more item than others.
+        length = min(column.length for column in self.columns.values())
+        for column in self.columns.values():
+            if column.length != length:
+                column.truncate(length)
+        self.length = length
+
+    def last(self):
+        if not self.length:
+            return None
+        return {
+            name: column.get(self.length - 1)
+            for name, column in self.columns.items()
+        }
+
+    def append(self, row):
+        # Timestamps go last, so readers never see a time without values.
+        for name, column in reversed(self.columns.items()):
+            column.append(row[name])
+        self.length += 1
+
+    def update_last(self, row):
+        for name, column in self.columns.items():
+            column.set(self.length - 1, row[name])
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+
+def _raw_columns():
+    return [('t.q', 'q')] + [(metric + '.d', 'd') for metric in METRICS]
+
+
+def _rollup_columns():
+    columns = [('t.q', 'q'), ('n.q', 'q')]
+    for metric in METRICS:
+        for stat in ('min', 'max', 'sum'):
+            columns.append((metric + '.' + stat + '.d', 'd'))
+    return columns
+
+
+def _host_columns():
+    return len(_raw_columns()) + len(ROLLUPS) * len(_rollup_columns())
+
+
+def default_max_open():
+    ''' How many hosts' writers fit in half of our file descriptor limit,
+    leaving the rest for connections and queries.
+    '''
+    if resource is None:
+        return 64
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+    return max(1, soft // 2 // _host_columns())
+
+
+class _HostWriter:
+    ''' Appends one host's samples, keeping its rollups current. Holds
+    _host_columns() files open.
+    '''
+    def __init__(self, directory):
+        self.raw = _Series(os.path.join(directory, 'raw'), _raw_columns())
+        self.rollups = []
+        try:
+            for name, width in ROLLUPS:
+                series = _Series(
+                    os.path.join(directory, name),
+                    _rollup_columns()
+                )
+                self.rollups.append((series, width, series.last()))
+        except:
+            self.close()
+            raise
+
+        last = self.raw.last()
+        if last is None:
+            self.latest = None
+        else:
+            self.latest = last['t.q']
+
+    def append(self, timestamp, values):
+        ''' Adds a sample. Samples that aren't newer than the latest one
+        (repeats after a Telemeter restart, say) are ignored, which keeps
+        every column sorted by time.
+        '''
+        if self.latest is not None and timestamp <= self.latest:
+            return False
+
+        row = {'t.q': timestamp}
+        for metric, value in zip(METRICS, values):
+            row[metric + '.d'] = value
+        self.raw.append(row)
+        self.latest = timestamp
+
+        for ii, (series, width, current) in enumerate(self.rollups):
+            bucket = timestamp - timestamp % width
+            if current is not None and current['t.q'] == bucket:
+                current['n.q'] += 1
+                for metric, value in zip(METRICS, values):
+                    current[metric + '.min.d'] = min(
+                        current[metric + '.min.d'],
+                        value
+                    )
+                    current[metric + '.max.d'] = max(
+                        current[metric + '.max.d'],
+                        value
+                    )
+                    current[metric + '.sum.d'] += value
+                series.update_last(current)
+
+            else:
+                current = {'t.q': bucket, 'n.q': 1}
+                for metric, value in zip(METRICS, values):
+                    current[metric + '.min.d'] = value
+                    current[metric + '.max.d'] = value
+                    current[metric + '.sum.d'] = value
+                series.append(current)
+                self.rollups[ii] = (series, width, current)
+
+        return True
+
+    def close(self):
+        self.raw.close()
+        for series, width, current in self.rollups:
+            series.close()
+
+
+class TimeSeriesStore:
+    ''' Stores samples per host under root, and answers range and
+    aggregate queries from the files. Only max_open hosts' files are
+    kept open for writing at once; by default, as many as fit in half
+    the file descriptor limit. If we still run out of descriptors,
+    writers are closed (least recently used first) until the new one
+    fits.
+    '''
+    def __init__(self, root, max_open=None):
+        if max_open is None:
+            max_open = default_max_open()
+
+        self.root = root
+        self.max_open = max_open
+        os.makedirs(root, exist_ok=True)
+        self._writers = collections.OrderedDict()
+
+    def _host_dir(self, host):
+        if not re.fullmatch(r'[A-Za-z0-9_=.~-]+', host) or host[0] == '.':
+            raise ValueError('Unusable host name: ' + repr(host))
+        return os.path.join(self.root, host)
+
+    def _evict(self):
+        __, evicted = self._writers.popitem(last=False)
+        evicted.close()
+
+    def _open(self, host):
+        directory = self._host_dir(host)
+        while len(self._writers) >= self.max_open:
+            self._evict()
+
+        while True:
+            try:
+                return _HostWriter(directory)
+            except OSError as exc:
+                if exc.errno not in {errno.EMFILE, errno.ENFILE}:
+                    raise
+                if not self._writers:
+                    raise
+                self._evict()
+
+    def _writer(self, host):
+        try:
+            writer = self._writers.pop(host)
+        except KeyError:
+            writer = self._open(host)
+
+        self._writers[host] = writer
+        return writer
+
+    def record(self, host, samples):
+        ''' Stores StatusSamples for host (a filename-safe string, like
+        a fingerprint's as_str()). Returns how many were new.
+        '''
+        writer = self._writer(host)
+        return sum(
+            writer.append(sample.timestamp, sample_values(sample))
+            for sample in samples
+        )
+
+    def hosts(self):
+        return sorted(
+            name for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name))
+        )
+
+    def _map(self, host, resolution, name, typecode):
+        return map_column(
+            os.path.join(self._host_dir(host), resolution, name),
+            typecode
+        )
+
+    def _range(self, times, start, end):
+        return bisect.bisect_left(times, start), bisect.bisect_left(times, end)
+
+    def series(self, host, metric, start, end, resolution='raw'):
+        ''' Returns rows for times in [start, end) (ms since the epoch).
+        Raw rows are (time, value); rollup rows are (bucket start, count,
+        min, mean, max).
+        '''
+        if metric not in METRICS:
+            raise ValueError('Unknown metric: ' + repr(metric))
+
+        times = self._map(host, resolution, 't.q', 'q')
+        lo, hi = self._range(times, start, end)
+
+        if resolution == 'raw':
+            values = self._map(host, resolution, metric + '.d', 'd')
+            hi = min(hi, len(values))
+            return list(zip(times[lo:hi], values[lo:hi]))
+
+        counts = self._map(host, resolution, 'n.q', 'q')
+        mins = self._map(host, resolution, metric + '.min.d', 'd')
+        maxes = self._map(host, resolution, metric + '.max.d', 'd')
+        sums = self._map(host, resolution, metric + '.sum.d', 'd')
+        hi = min(hi, len(counts), len(mins), len(maxes), len(sums))
+        return [
+            (times[ii], counts[ii], mins[ii], sums[ii] / counts[ii],
+             maxes[ii])
+            for ii in range(lo, hi)
+        ]
+
+    def aggregate(self, host, metric, start, end):
+        ''' Returns {'count', 'min', 'mean', 'max'} of metric over
+        [start, end). min, mean and max are None if there are no samples.
+        '''
+        if metric not in METRICS:
+            raise ValueError('Unknown metric: ' + repr(metric))
+
+        count, low, high, total = self._aggregate(
+            host,
+            metric,
+            start,
+            end,
+            len(ROLLUPS)
+        )
+        if not count:
+            return {'count': 0, 'min': None, 'mean': None, 'max': None}
+        return {
+            'count': count,
+            'min': low,
+            'mean': total / count,
+            'max': high
+        }
+
+    def _aggregate(self, host, metric, start, end, level):
+        ''' (count, min, max, sum) over [start, end), using whole buckets
+        of ROLLUPS[level - 1] where they fit and recursing for the rest.
+        '''
+        if start >= end:
+            return 0, math.inf, -math.inf, 0.
+
+        if level == 0:
+            times = self._map(host, 'raw', 't.q', 'q')
+            values = self._map(host, 'raw', metric + '.d', 'd')
+            lo, hi = self._range(times, start, end)
+            values = values[lo:min(hi, len(values))]
+            if not len(values):
+                return 0, math.inf, -math.inf, 0.
+            return len(values), min(values), max(values), sum(values)
+
+        name, width = ROLLUPS[level - 1]
+        inner_start = -(-start // width) * width
+        inner_end = end - end % width
+        if inner_start >= inner_end:
+            return self._aggregate(host, metric, start, end, level - 1)
+
+        times = self._map(host, name, 't.q', 'q')
+        counts = self._map(host, name, 'n.q', 'q')
+        mins = self._map(host, name, metric + '.min.d', 'd')
+        maxes = self._map(host, name, metric + '.max.d', 'd')
+        sums = self._map(host, name, metric + '.sum.d', 'd')
+        lo, hi = self._range(times, inner_start, inner_end)
+        hi = min(hi, len(counts), len(mins), len(maxes), len(sums))
+
+        parts = [
+            self._aggregate(host, metric, start, inner_start, level - 1),
+            self._aggregate(host, metric, inner_end, end, level - 1),
+        ]
+        if lo < hi:
+            parts.append((
+                sum(counts[lo:hi]),
+                min(mins[lo:hi]),
+                max(maxes[lo:hi]),
+                sum(sums[lo:hi])
+            ))
+
+        return (
+            sum(part[0] for part in parts),
+            min(part[1] for part in parts),
+            max(part[2] for part in parts),
+            sum(part[3] for part in parts)
+        )
+
+    def close(self):
+        while self._writers:
+            __, writer = self._writers.popitem()
+            writer.close()
+
+
+_RELATIVE = re.compile(r'-(\d+(?:\.\d+)?)([smhdw])')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_time(text):
+    ''' Parses "now", relative times like "-90m" or "-7d", ISO 8601 dates
+    and times (local time unless they say otherwise), or integer ms since
+    the epoch. Returns ms since the epoch.
+    '''
+    if text == 'now':
+        return int(time.time() * 1000)
+
+    match = _RELATIVE.fullmatch(text)
+    if match:
+        seconds = float(match.group(1)) * _UNITS[match.group(2)]
+        return int((time.time() - seconds) * 1000)
+
+    if text.isdigit():
+        return int(text)
+
+    return int(datetime.datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp / 1000).isoformat(
+        sep = ' ',
+        timespec = 'seconds'
+    )
+
+
+def pick_resolution(store, host, start, end, points):
+    ''' Finest resolution with at most points rows in [start, end).
+    '''
+    for resolution in ['raw'] + [name for name, width in ROLLUPS]:
+        times = store._map(host, resolution, 't.q', 'q')
+        lo, hi = store._range(times, start, end)
+        if hi - lo <= points:
+            return resolution
+    return ROLLUPS[-1][0]
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description = 'Query a Telereader --store.'
+    )
+    argparser.add_argument(
+        'store',
+        action = 'store',
+        type = str,
+        help = 'The store directory.'
+    )
+    argparser.add_argument(
+        'host',
+        action = 'store',
+        nargs = '?',
+        default = None,
+        type = str,
+        help = 'Telemeter fingerprint to query. Lists hosts if omitted.'
+    )
+    argparser.add_argument(
+        'metric',
+        action = 'store',
+        nargs = '?',
+        default = 'cpu',
+        choices = METRICS,
+        help = 'Metric to query [default: cpu]'
+    )
+    argparser.add_argument(
+        '--start',
+        action = 'store',
+        default = '-1h',
+        type = parse_time,
+        help = 'Start of the range: "now", "-90m", "-7d", an ISO date or ' +
+               'time, or ms since the epoch [default: -1h]'
+    )
+    argparser.add_argument(
+        '--end',
+        action = 'store',
+        default = 'now',
+        type = parse_time,
+        help = 'End of the range, like --start [default: now]'
+    )
+    argparser.add_argument(
+        '--resolution',
+        action = 'store',
+        default = None,
+        choices = ['raw'] + [name for name, width in ROLLUPS],
+        help = 'Rows to print [default: the finest with at most --points]'
+    )
+    argparser.add_argument(
+        '--points',
+        action = 'store',
+        default = 1000,
+        type = int,
+        help = 'Most rows to print without --resolution [default: 1000]'
+    )
+    argparser.add_argument(
+        '--aggregate',
+        action = 'store_true',
+        help = 'Just print the count, min, mean and max over the range.'
+    )
+    args = argparser.parse_args()
+
+    store = TimeSeriesStore(args.store)
+
+    if args.host is None:
+        for host in store.hosts():
+            print(host)
+
+    elif args.aggregate:
+        result = store.aggregate(args.host, args.metric, args.start, args.end)
+        print('\t'.join(
+            '{}={}'.format(key, result[key])
+            for key in ('count', 'min', 'mean', 'max')
+        ))
+
+    else:
+        resolution = args.resolution
+        if resolution is None:
+            resolution = pick_resolution(
+                store,
+                args.host,
+                args.start,
+                args.end,
+                args.points
+            )
+
+        rows = store.series(
+            args.host,
+            args.metric,
+            args.start,
+            args.end,
+            resolution
+        )
+        for row in rows:
+            print('\t'.join(
+                [format_time(row[0])] +
+                ['{:.6g}'.format(value) for value in row[1:]]
+            ))